@@ -0,0 +1,361 @@
+"""
+Бенчмарк захвата и кодирования без экрана.
+
+    python bench/encode_bench.py
+    python bench/encode_bench.py --scales 0.35,0.5,0.65 --qualities 30,50,70
+    python bench/encode_bench.py --scenes scroll,video --frames 120 --out enc.json
+    python bench/encode_bench.py --corpus recordings/      # свои записи *.npy
+    python bench/encode_bench.py --layers 3                # цена simulcast
+    python bench/encode_bench.py --codecs jpeg,h264        # нужен PyAV
+
+Прогоняет последовательности BGRA-кадров через capture_turbo /
+capture_pillow из orbdesk_host — тот же масштаб, дельта-тайлы и JPEG, —
+подставляя вместо mss объект, который отдаёт кадры из памяти.
+Синтетические сцены: статичный рабочий стол, прокрутка текста,
+перетаскивание окна, видео. Свои записи — файлы .npy формы
+(кадры, высота, ширина, 4) uint8 в BGRA.
+
+Для каждой конфигурации (кодек × энкодер × масштаб × качество × дельта)
+печатает кадров/с на ядро (по процессорному времени), байт на кадр и
+PSNR/SSIM того, что увидит зритель, относительно сжатого исходника.
+С --layers N кодируются N слоёв simulcast: байты — за все слои,
+PSNR/SSIM — по основному слою.
+"""
+import argparse
+import glob
+import io
+import itertools
+import json
+import os
+import struct
+import sys
+import time
+import types
+
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Экран и ввод здесь не нужны: без дисплея mss/pyautogui могут не загрузиться,
+# а orbdesk_host импортирует их при старте. Подставляем пустые модули.
+for _name in ("mss", "pyautogui"):
+    try:
+        __import__(_name)
+    except Exception:
+        sys.modules[_name] = types.ModuleType(_name)
+
+import orbdesk_host as host  # noqa: E402
+
+TURBO_AVAILABLE = host.USE_TURBOJPEG   # configure() его переключает
+
+
+# ═══ Синтетические сцены ═══
+
+def desktop(h, w, rng):
+    """Фон-градиент, панель задач и несколько «окон» с текстом."""
+    y = np.linspace(0, 1, h, dtype=np.float32)[:, None]
+    x = np.linspace(0, 1, w, dtype=np.float32)[None, :]
+    img = np.empty((h, w, 4), dtype=np.uint8)
+    img[..., 0] = (120 + 80 * y).astype(np.uint8)
+    img[..., 1] = (60 + 60 * x).astype(np.uint8)
+    img[..., 2] = (40 + 40 * (1 - y)).astype(np.uint8)
+    img[..., 3] = 255
+    img[h - 40:] = (48, 40, 32, 255)
+    for _ in range(3):
+        wh, ww = rng.integers(h // 4, h // 2), rng.integers(w // 4, w // 2)
+        y0, x0 = rng.integers(0, h - wh - 40), rng.integers(0, w - ww)
+        window(img, y0, x0, wh, ww, rng)
+    return img
+
+
+def text_block(h, w, rng, line=18):
+    """Белый лист со «строками»: тёмные штрихи разной длины, как глифы."""
+    img = np.full((h, w, 4), 250, dtype=np.uint8)
+    img[..., 3] = 255
+    for y in range(8, h - line, line):
+        x = 12
+        end = rng.integers(w // 3, w - 12)
+        while x < end:
+            word = min(int(rng.integers(3, 10)) * 7, w - x)
+            glyphs = rng.random((line - 6, word)) < 0.35
+            img[y:y + line - 6, x:x + word][glyphs] = (30, 30, 30, 255)
+            x += word + 7
+    return img
+
+
+def window(img, y0, x0, wh, ww, rng):
+    img[y0:y0 + wh, x0:x0 + ww] = (235, 235, 235, 255)
+    img[y0:y0 + 28, x0:x0 + ww] = (200, 120, 40, 255)   # заголовок
+    img[y0 + 28:y0 + wh, x0:x0 + ww] = text_block(wh - 28, ww, rng)
+
+
+def scene_static(h, w, n, rng):
+    frame = desktop(h, w, rng)
+    return [frame] * n
+
+
+def scene_scroll(h, w, n, rng, speed=12):
+    page = text_block(h + n * speed, w, rng)
+    return [np.ascontiguousarray(page[i * speed:i * speed + h]) for i in range(n)]
+
+
+def scene_drag(h, w, n, rng):
+    base = desktop(h, w, rng)
+    wh, ww = h // 3, w // 3
+    win = np.zeros((wh, ww, 4), dtype=np.uint8)
+    window(win, 0, 0, wh, ww, rng)
+    frames = []
+    for i in range(n):
+        f = base.copy()
+        y0 = int((h - wh - 40) * (0.5 + 0.4 * np.sin(i / 15)))
+        x0 = int((w - ww) * i / max(1, n - 1))
+        f[y0:y0 + wh, x0:x0 + ww] = win
+        frames.append(f)
+    return frames
+
+
+def scene_video(h, w, n, rng):
+    """Плеер на половину экрана: плавно движущиеся пятна и шум."""
+    base = desktop(h, w, rng)
+    vh, vw = h // 2, w // 2
+    y = np.arange(vh, dtype=np.float32)[:, None]
+    x = np.arange(vw, dtype=np.float32)[None, :]
+    frames = []
+    for i in range(n):
+        t = i / 10
+        f = base.copy()
+        for c, k in enumerate((0.013, 0.017, 0.011)):
+            plane = 128 + 90 * np.sin(x * k + t * (c + 1)) * np.cos(y * k * 1.3 - t)
+            plane += rng.normal(0, 6, plane.shape)
+            f[h // 4:h // 4 + vh, w // 4:w // 4 + vw, c] = np.clip(plane, 0, 255).astype(np.uint8)
+        frames.append(f)
+    return frames
+
+
+SCENES = {
+    "static": scene_static,
+    "scroll": scene_scroll,
+    "drag": scene_drag,
+    "video": scene_video,
+}
+
+
+def load_corpus(path):
+    """Записи *.npy (кадры, h, w, 4) BGRA — сцена на файл."""
+    corpus = {}
+    for f in sorted(glob.glob(os.path.join(path, "*.npy"))):
+        arr = np.load(f, mmap_mode="r")
+        if arr.ndim != 4 or arr.shape[3] != 4 or arr.dtype != np.uint8:
+            print(f"⚠️ {f}: нужен массив (кадры, h, w, 4) uint8, пропускаем")
+            continue
+        corpus[os.path.splitext(os.path.basename(f))[0]] = [np.ascontiguousarray(x) for x in arr]
+    return corpus
+
+
+# ═══ Подмена mss ═══
+
+class Shot:
+    """То, что отдаёт mss.grab: raw/bgra, size, width, height."""
+
+    def __init__(self, frame):
+        self.height, self.width = frame.shape[:2]
+        self.size = (self.width, self.height)
+        self.raw = self.bgra = frame.data
+
+
+class FrameSource:
+    """Вместо mss.mss(): grab() отдаёт кадры сцены по очереди."""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.pos = 0
+        h, w = frames[0].shape[:2]
+        mon = {"left": 0, "top": 0, "width": w, "height": h}
+        self.monitors = [mon, mon]
+
+    def grab(self, mon):
+        frame = self.frames[self.pos % len(self.frames)]
+        self.pos += 1
+        return Shot(frame)
+
+
+# ═══ Что увидит зритель ═══
+
+def decode(data):
+    return np.asarray(Image.open(io.BytesIO(data)).convert("RGB"))
+
+
+class ViewerCanvas:
+    """Собирает картинку так же, как клиент: полный кадр или тайлы поверх."""
+
+    def __init__(self):
+        self.img = None
+        self.video = None
+
+    def apply(self, data):
+        if data is None:
+            return              # статичный экран — у зрителя прежний кадр
+        if data[:4] == host.VIDEO_MAGIC:
+            if self.video is None:
+                self.video = host.av.CodecContext.create("h264", "r")
+            for frame in self.video.decode(host.av.Packet(data[host.VIDEO_HEADER.size:])):
+                self.img = frame.to_ndarray(format="rgb24")
+            return
+        if data[:4] != host.DELTA_MAGIC:
+            self.img = decode(data).copy()
+            return
+        _, _, count = struct.unpack_from("<HHH", data, 4)
+        pos = 10
+        for _ in range(count):
+            x, y, n = struct.unpack_from("<HHI", data, pos)
+            pos += 8
+            tile = decode(data[pos:pos + n])
+            pos += n
+            self.img[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+
+
+def reference(frame, encoder):
+    """Исходник после того же масштабирования, что у энкодера, в RGB."""
+    if encoder == "turbo":
+        src = host.downscale(frame, host.SCALE).copy() if host.SCALE < 1 else frame
+        return src[..., 2::-1]
+    img = Image.frombytes("RGB", (frame.shape[1], frame.shape[0]), frame.data, "raw", "BGRX")
+    if host.SCALE < 1:
+        img = img.resize((int(img.width * host.SCALE), int(img.height * host.SCALE)), Image.BILINEAR)
+    return np.asarray(img)
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float32) - b.astype(np.float32)) ** 2)
+    return 99.0 if mse == 0 else float(10 * np.log10(255 ** 2 / mse))
+
+
+def ssim(a, b, block=8):
+    """SSIM по яркости на блоках 8×8 без перекрытия — быстрое приближение."""
+    luma = lambda img: img.astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    x, y = luma(a), luma(b)
+    h, w = (x.shape[0] // block) * block, (x.shape[1] // block) * block
+    x = x[:h, :w].reshape(h // block, block, w // block, block)
+    y = y[:h, :w].reshape(h // block, block, w // block, block)
+    mx, my = x.mean(axis=(1, 3)), y.mean(axis=(1, 3))
+    vx, vy = x.var(axis=(1, 3)), y.var(axis=(1, 3))
+    cov = ((x - mx[:, None, :, None]) * (y - my[:, None, :, None])).mean(axis=(1, 3))
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    s = ((2 * mx * my + c1) * (2 * cov + c2)) / ((mx ** 2 + my ** 2 + c1) * (vx + vy + c2))
+    return float(s.mean())
+
+
+# ═══ Прогон ═══
+
+def configure(encoder, scale, quality, delta, layers=1, codec="jpeg"):
+    host.USE_TURBOJPEG = encoder == "turbo"
+    host.video_active = codec == "h264"
+    host.SCALE = scale
+    host.QUALITY = quality
+    host.DELTA_MODE = delta
+    host._resamplers.clear()
+    return host.MonitorStream(1, layers)
+
+
+def run_config(frames, encoder, scale, quality, delta, quality_every, layers=1, codec="jpeg"):
+    stream = configure(encoder, scale, quality, delta, layers, codec)
+    source = FrameSource(frames)
+    host.capture(source, stream)    # прогрев: ресэмплер, первый ключевой кадр
+    stream = configure(encoder, scale, quality, delta, layers, codec)
+    source.pos = 0
+
+    encoded = []
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    for _ in frames:
+        encoded.append(host.capture(source, stream))
+    cpu, wall = time.process_time() - cpu0, time.perf_counter() - wall0
+    out = [f[0] for f in encoded]
+
+    canvas = ViewerCanvas()
+    psnrs, ssims = [], []
+    for i, (frame, data) in enumerate(zip(frames, out)):
+        canvas.apply(data)
+        if i % quality_every == 0 and canvas.img is not None:
+            # H.264 отрезает нечётный край — сравниваем по картинке зрителя
+            ref = reference(frame, encoder)[:canvas.img.shape[0], :canvas.img.shape[1]]
+            psnrs.append(psnr(canvas.img, ref))
+            ssims.append(ssim(canvas.img, ref))
+
+    sizes = [len(d) for d in out if d is not None]
+    total = sum(len(d) for f in encoded for d in f if d is not None)
+    return {
+        "fps_per_core": round(len(frames) / cpu, 1) if cpu else None,
+        "fps_wall": round(len(frames) / wall, 1),
+        "bytes_per_frame": round(total / len(frames)),
+        "frames_sent": len(sizes),
+        "psnr": round(sum(psnrs) / len(psnrs), 2) if psnrs else None,
+        "psnr_min": round(min(psnrs), 2) if psnrs else None,
+        "ssim": round(sum(ssims) / len(ssims), 4) if ssims else None,
+    }
+
+
+def parse_list(text, cast):
+    return [cast(x) for x in text.split(",") if x.strip()]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--scenes", default=",".join(SCENES), help="через запятую: " + ", ".join(SCENES))
+    ap.add_argument("--corpus", help="папка с записями *.npy вместо синтетики")
+    ap.add_argument("--size", default="1920x1080", help="разрешение синтетических сцен")
+    ap.add_argument("--frames", type=int, default=60)
+    ap.add_argument("--codecs", default="jpeg", help="jpeg, h264 или оба")
+    ap.add_argument("--encoders", default="turbo,pillow")
+    ap.add_argument("--scales", default="0.5")
+    ap.add_argument("--qualities", default="50")
+    ap.add_argument("--delta", default="on,off", help="on, off или оба")
+    ap.add_argument("--layers", type=int, default=1, help="слоёв simulcast (1–3)")
+    ap.add_argument("--quality-every", type=int, default=5, help="PSNR/SSIM на каждом N-м кадре")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", help="куда записать JSON с итогами")
+    args = ap.parse_args()
+
+    if args.corpus:
+        scenes = load_corpus(args.corpus)
+    else:
+        w, h = (int(x) for x in args.size.lower().split("x"))
+        rng = np.random.default_rng(args.seed)
+        scenes = {name: SCENES[name](h, w, args.frames, rng) for name in parse_list(args.scenes, str)}
+
+    encoders = parse_list(args.encoders, str)
+    if "turbo" in encoders and not TURBO_AVAILABLE:
+        print("⚠️ TurboJPEG недоступен — только Pillow")
+        encoders.remove("turbo")
+    deltas = [d == "on" for d in parse_list(args.delta, str)]
+    if host.np is None:
+        deltas = [False]
+    codecs = parse_list(args.codecs, str)
+    if "h264" in codecs and host.av is None:
+        print("⚠️ PyAV не установлен — без H.264")
+        codecs.remove("h264")
+
+    results = []
+    print(f"{'сцена':8s} {'кодек':5s} {'энк.':6s} {'масш':>5s} {'Q':>3s} {'дельта':6s} "
+          f"{'к/с·ядро':>9s} {'байт/кадр':>10s} {'PSNR':>6s} {'SSIM':>7s}")
+    for (name, frames), codec, encoder, scale, quality, delta in itertools.product(
+            scenes.items(), codecs, encoders, parse_list(args.scales, float),
+            parse_list(args.qualities, int), deltas):
+        if codec == "h264" and delta != deltas[0]:
+            continue            # у видеокодека дельты нет, второй прогон ничего не даст
+        r = run_config(frames, encoder, scale, quality, delta, args.quality_every, args.layers, codec)
+        results.append({"scene": name, "codec": codec, "encoder": encoder, "scale": scale,
+                        "quality": quality, "delta": delta, **r})
+        print(f"{name:8s} {codec:5s} {encoder:6s} {scale:5.2f} {quality:3d} {'да' if delta else 'нет':6s} "
+              f"{r['fps_per_core']:9.1f} {r['bytes_per_frame']:10,d} "
+              f"{r['psnr'] if r['psnr'] is not None else '—':>6} "
+              f"{r['ssim'] if r['ssim'] is not None else '—':>7}")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
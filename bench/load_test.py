@@ -0,0 +1,400 @@
+"""
+Нагрузочный тест хаба целиком: uvicorn + настоящие WebSocket.
+
+    python bench/load_test.py
+    python bench/load_test.py --hosts 4 --viewers 5 --fps 30 --frame-kb 80
+    python bench/load_test.py --slow-viewers 1 --slow-ms 50 --out run.json
+    python bench/load_test.py --baseline run.json     # сравнить с прошлым прогоном
+    python bench/load_test.py --blip 3                # обрыв хостов на 3-й секунде
+
+Поднимает main:app под uvicorn на свободном порту, заводит N синтетических
+хостов (бинарные кадры заданного размера и частоты в /ws/host) и по M
+зрителей на сессию; часть зрителей можно сделать медленными. Меряет
+пропускную способность ретрансляции, задержку кадра до каждого зрителя
+(p50/p95/p99), долю потерянных кадров и CPU/RSS процесса хаба.
+
+С --blip каждый хост посреди замера рвёт соединение и возвращается в ту же
+сессию по токену возобновления. В отчёт идёт, за сколько он переподключился
+и сколько зрители простояли без кадров, и сколько зрителей пережили обрыв.
+
+Итог — JSON (--out). С --baseline сравнивает с прошлым прогоном и
+завершается с кодом 1, если что-то стало хуже больше чем на --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import time
+import urllib.request
+
+try:
+    import psutil
+except ImportError:
+    psutil = None  # без psutil CPU/RSS хаба читаются из /proc (только Linux)
+
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Кадр: JPEG-сигнатура (хаб считает его полным) | номер | время отправки
+FRAME_HEAD = struct.Struct("<2sQd")
+JPEG_SOI = b"\xff\xd8"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    vals = sorted(values)
+    pick = lambda q: round(vals[min(len(vals) - 1, int(q * len(vals)))], 2)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(vals[-1], 2)}
+
+
+class ProcessProbe:
+    """CPU (% одного ядра) и RSS процесса хаба раз в interval секунд."""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.cpu = []
+        self.rss = []
+        self.tick = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def times(self):
+        if psutil:
+            t = psutil.Process(self.pid).cpu_times()
+            return t.user + t.system
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.tick
+
+    def rss_mb(self):
+        if psutil:
+            return psutil.Process(self.pid).memory_info().rss / 2**20
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+        return 0.0
+
+    async def run(self):
+        try:
+            last, at = self.times(), time.perf_counter()
+            while True:
+                await asyncio.sleep(self.interval)
+                cur, now = self.times(), time.perf_counter()
+                self.cpu.append((cur - last) / (now - at) * 100)
+                self.rss.append(self.rss_mb())
+                last, at = cur, now
+        except (OSError, ValueError):
+            pass  # процесс хаба завершился или /proc недоступен
+
+    def summary(self):
+        return {
+            "cpu_avg": round(sum(self.cpu) / len(self.cpu), 1) if self.cpu else None,
+            "cpu_max": round(max(self.cpu), 1) if self.cpu else None,
+            "rss_max_mb": round(max(self.rss), 1) if self.rss else None,
+        }
+
+
+class Viewer:
+    def __init__(self, code, idx, slow_ms):
+        self.code = code
+        self.name = f"Load{idx}"
+        self.slow = slow_ms / 1000
+        self.latency = []        # мс, только после прогрева
+        self.received = 0
+        self.last_seq = -1
+        self.gaps = 0            # кадры, пропущенные хабом между полученными
+        self.last_at = None
+        self.stall = 0.0         # сек, самая долгая пауза между кадрами
+        self.close_code = None
+
+    async def run(self, base, measure_from):
+        async with websockets.connect(
+            f"{base}/ws/viewer?code={self.code}&password=&name={self.name}",
+            max_size=None, max_queue=4,
+        ) as ws:
+            async for msg in ws:
+                if isinstance(msg, str):
+                    continue
+                _, seq, sent = FRAME_HEAD.unpack_from(msg)
+                now = time.perf_counter()
+                if sent >= measure_from:
+                    self.received += 1
+                    self.latency.append((now - sent) * 1000)
+                    if self.last_seq >= 0 and seq > self.last_seq + 1:
+                        self.gaps += seq - self.last_seq - 1
+                    if self.last_at is not None:
+                        self.stall = max(self.stall, now - self.last_at)
+                    self.last_at = now
+                self.last_seq = seq
+                if self.slow:
+                    await asyncio.sleep(self.slow)
+            self.close_code = ws.close_code
+
+
+class Host:
+    def __init__(self, code, fps, frame_size, blip_at=None):
+        self.code = code
+        self.period = 1 / fps
+        self.padding = os.urandom(max(0, frame_size - FRAME_HEAD.size))
+        self.sent = 0            # после прогрева
+        self.lag = 0.0           # сек, насколько отправка отстала от расписания
+        self.blip_at = blip_at   # когда оборвать соединение и вернуться по токену
+        self.token = ""
+        self.reconnect = None    # сек от обрыва до нового соединения
+
+    async def run(self, base, measure_from, stop_at, connected):
+        seq = 0
+        next_at = time.perf_counter()
+        dropped = None
+        while next_at < stop_at:
+            url = f"{base}/ws/host?code={self.code}" + (f"&token={self.token}" if self.token else "")
+            async with websockets.connect(url, max_size=None) as ws:
+                if dropped is not None:
+                    self.reconnect = time.perf_counter() - dropped
+                    next_at = time.perf_counter()   # пропущенное за обрыв не догоняем
+                drain = asyncio.create_task(self.drain(ws))
+                connected.set()
+                try:
+                    while next_at < stop_at:
+                        if dropped is None and self.blip_at and next_at >= self.blip_at:
+                            break
+                        now = time.perf_counter()
+                        if now < next_at:
+                            await asyncio.sleep(next_at - now)
+                        else:
+                            self.lag = max(self.lag, now - next_at)
+                        sent = time.perf_counter()
+                        await ws.send(FRAME_HEAD.pack(JPEG_SOI, seq, sent) + self.padding)
+                        if sent >= measure_from:
+                            self.sent += 1
+                        seq += 1
+                        next_at += self.period
+                finally:
+                    drain.cancel()
+            if dropped is None:
+                dropped = time.perf_counter()
+
+    async def drain(self, ws):
+        # viewer_count, request_keyframe и прочее — читаем, чтобы хаб не упёрся в буфер
+        async for msg in ws:
+            if isinstance(msg, str) and '"session_resume"' in msg:
+                self.token = json.loads(msg)["token"]
+
+
+async def wait_ready(url, proc, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("uvicorn завершился при запуске")
+        try:
+            await asyncio.to_thread(urllib.request.urlopen, url, timeout=1)
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("хаб не поднялся за отведённое время")
+
+
+async def load(args):
+    port = args.port or free_port()
+    base = f"ws://127.0.0.1:{port}"
+    http = f"http://127.0.0.1:{port}"
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+         "--log-level", "warning", *(["--workers", str(args.workers)] if args.workers > 1 else [])],
+        cwd=ROOT, stdout=subprocess.DEVNULL if args.quiet else None,
+    )
+    try:
+        await wait_ready(f"{http}/session/check?code=000000", proc)
+        probe = ProcessProbe(proc.pid)
+        codes = [f"{random.randint(100000, 999999)}" for _ in range(args.hosts)]
+        start = time.perf_counter() + 1.0          # время на подключение всех
+        measure_from = start + args.warmup
+        stop_at = measure_from + args.duration
+
+        hosts, viewers, tasks = [], [], []
+        for code in codes:
+            host = Host(code, args.fps, args.frame_kb * 1024,
+                        measure_from + args.blip if args.blip else None)
+            hosts.append(host)
+            connected = asyncio.Event()
+            tasks.append(asyncio.create_task(host.run(base, measure_from, stop_at, connected)))
+            await connected.wait()
+            for i in range(args.viewers):
+                v = Viewer(code, i, args.slow_ms if i < args.slow_viewers else 0)
+                viewers.append(v)
+                tasks.append(asyncio.create_task(v.run(base, measure_from)))
+        probe_task = asyncio.create_task(probe.run())
+
+        await asyncio.sleep(max(0.0, stop_at - time.perf_counter()) + args.settle)
+        probe_task.cancel()
+        try:
+            metrics = await asyncio.to_thread(
+                lambda: urllib.request.urlopen(f"{http}/metrics", timeout=5).read().decode())
+        except OSError:
+            metrics = ""
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    return report(args, hosts, viewers, probe, metrics)
+
+
+def hub_counters(text):
+    """Итоговые счётчики воркера из /metrics (без меток сессий)."""
+    out = {}
+    for line in text.splitlines():
+        if line.startswith("orbdesk_") and "code=" not in line and "_bucket" not in line:
+            name, value = line.rsplit(" ", 1)
+            out[name.split("{", 1)[0]] = out.get(name.split("{", 1)[0], 0) + float(value)
+    return out
+
+
+def report(args, hosts, viewers, probe, metrics):
+    sent = {h.code: h.sent for h in hosts}
+    fast = [v for v in viewers if not v.slow]
+    slow = [v for v in viewers if v.slow]
+
+    def group(vs):
+        expected = sum(sent[v.code] for v in vs)
+        got = sum(v.received for v in vs)
+        return {
+            "viewers": len(vs),
+            "frames_expected": expected,
+            "frames_received": got,
+            "drop_rate": round(1 - got / expected, 4) if expected else None,
+            "latency_ms": percentiles([x for v in vs for x in v.latency]),
+        }
+
+    relayed = sum(v.received for v in viewers)
+    return {
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "quiet")},
+        "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "frames_sent": sum(sent.values()),
+        "relay_fps": round(relayed / args.duration, 1),
+        "relay_mbps": round(relayed * args.frame_kb * 8 / 1024 / args.duration, 1),
+        "host_lag_ms": round(max((h.lag for h in hosts), default=0) * 1000, 1),
+        "fast": group(fast),
+        "slow": group(slow) if slow else None,
+        "per_viewer": [
+            {"code": v.code, "name": v.name, "slow_ms": v.slow * 1000, "received": v.received,
+             "gaps": v.gaps, "latency_ms": percentiles(v.latency)}
+            for v in viewers
+        ],
+        "hub": {**probe.summary(), "counters": hub_counters(metrics)},
+        "blip": {
+            "host_reconnect_ms": percentiles([h.reconnect * 1000 for h in hosts if h.reconnect]),
+            "viewer_stall_ms": percentiles([v.stall * 1000 for v in viewers if v.received]),
+            "viewers_kept": sum(1 for v in viewers if v.close_code is None),
+            "viewers": len(viewers),
+        } if args.blip else None,
+    }
+
+
+# (путь в отчёте, больше — лучше)
+CHECKS = [
+    (("relay_fps",), True),
+    (("fast", "drop_rate"), False),
+    (("fast", "latency_ms", "p95"), False),
+    (("fast", "latency_ms", "p99"), False),
+    (("hub", "cpu_avg"), False),
+    (("hub", "rss_max_mb"), False),
+]
+
+
+def compare(result, baseline, tolerance):
+    """Список регрессий относительно базового прогона."""
+    regressions = []
+    for path, higher_better in CHECKS:
+        cur, base = result, baseline
+        for key in path:
+            cur = (cur or {}).get(key)
+            base = (base or {}).get(key)
+        if cur is None or base is None:
+            continue
+        name = ".".join(path)
+        if higher_better:
+            worse = cur < base * (1 - tolerance)
+        else:
+            # Доли и миллисекунды около нуля сравниваем с небольшим допуском
+            worse = cur > base * (1 + tolerance) + (0.01 if "drop" in name else 1.0)
+        mark = "✗" if worse else "✓"
+        print(f"  {mark} {name:24s} {base:>10} → {cur}")
+        if worse:
+            regressions.append({"metric": name, "baseline": base, "current": cur})
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--hosts", type=int, default=2, help="сессий (синтетических хостов)")
+    ap.add_argument("--viewers", type=int, default=3, help="зрителей на сессию")
+    ap.add_argument("--fps", type=float, default=30)
+    ap.add_argument("--frame-kb", type=int, default=60, help="размер кадра, КБ")
+    ap.add_argument("--duration", type=float, default=10, help="сек измерения")
+    ap.add_argument("--warmup", type=float, default=2, help="сек прогрева без замеров")
+    ap.add_argument("--settle", type=float, default=1, help="сек ожидания хвоста после конца")
+    ap.add_argument("--slow-viewers", type=int, default=0, help="медленных зрителей на сессию")
+    ap.add_argument("--slow-ms", type=float, default=100, help="пауза медленного зрителя на кадр")
+    ap.add_argument("--blip", type=float, default=0, help="сек замера до обрыва хостов, 0 — без обрыва")
+    ap.add_argument("--workers", type=int, default=1, help="воркеров uvicorn (нужен ORBDESK_BACKEND_URL)")
+    ap.add_argument("--port", type=int, default=0)
+    ap.add_argument("--out", help="куда записать JSON с итогами")
+    ap.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    ap.add_argument("--tolerance", type=float, default=0.15, help="допустимое ухудшение, доля")
+    ap.add_argument("--quiet", action="store_true", help="не показывать вывод uvicorn")
+    args = ap.parse_args()
+
+    result = asyncio.run(load(args))
+    fast = result["fast"]
+    print(f"\n{args.hosts} сессий × {args.viewers} зрителей, {args.fps:g} FPS × {args.frame_kb} КБ")
+    print(f"  ретрансляция   {result['relay_fps']:,.0f} кадров/с, {result['relay_mbps']:,.0f} Мбит/с")
+    print(f"  потери         {fast['drop_rate']:.2%}" if fast["drop_rate"] is not None else "  потери —")
+    print(f"  задержка, мс   p50 {fast['latency_ms']['p50']}  p95 {fast['latency_ms']['p95']}"
+          f"  p99 {fast['latency_ms']['p99']}")
+    if result["slow"]:
+        print(f"  медленные      потери {result['slow']['drop_rate']:.2%}, "
+              f"p95 {result['slow']['latency_ms']['p95']} мс")
+    hub = result["hub"]
+    print(f"  хаб            CPU {hub['cpu_avg']}% (макс {hub['cpu_max']}%), RSS {hub['rss_max_mb']} МБ")
+    blip = result["blip"]
+    if blip:
+        print(f"  обрыв хоста    переподключение p50 {blip['host_reconnect_ms']['p50']} мс, "
+              f"простой у зрителей p50 {blip['viewer_stall_ms']['p50']} / макс {blip['viewer_stall_ms']['max']} мс, "
+              f"остались {blip['viewers_kept']}/{blip['viewers']}")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\nСравнение с {args.baseline}:")
+        result["regressions"] = compare(result, baseline, args.tolerance)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+        if result["regressions"]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Микро-бенчмарк маршрутизации текстовых сообщений хаба.
+
+    python bench/router_bench.py
+    python bench/router_bench.py --messages 50000 --viewers 8
+    python bench/router_bench.py --slow-ms 2     # плюс один медленный зритель
+
+Запускает ws_host / ws_viewer из main.py на фейковых сокетах в одном
+процессе — без сети и uvicorn — и печатает сообщений/сек для основных
+видов трафика. Меряется только работа хаба: разбор, проверки, рассылка.
+С --slow-ms к сессии добавляется зритель, у которого каждая отправка
+занимает столько миллисекунд; его доставки не ждём — смотрим, насколько
+он тормозит остальных.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # main.py монтирует static/ относительно текущей папки
+
+from fastapi import WebSocketDisconnect  # noqa: E402
+
+import main  # noqa: E402
+
+CODE = "424242"
+
+
+class Counter:
+    """Считает доставленные сообщения и будит, когда набралось нужное число."""
+
+    def __init__(self):
+        self.n = 0
+        self.target = None
+        self.done = None
+
+    def arm(self, target):
+        self.n = 0
+        self.target = target
+        self.done = asyncio.Event()
+
+    def hit(self):
+        self.n += 1
+        if self.target is not None and self.n >= self.target:
+            self.done.set()
+
+
+class FakeSocket:
+    """Минимальный WebSocket для обработчиков хаба."""
+
+    def __init__(self, counter, delay=0.0):
+        self.inbox = asyncio.Queue()
+        self.counter = counter
+        self.delay = delay
+
+    async def accept(self):
+        pass
+
+    async def close(self, code=1000, reason=None):
+        pass
+
+    async def receive(self):
+        # Настоящий сокет отдаёт управление циклу на каждом сообщении
+        await asyncio.sleep(0)
+        text = await self.inbox.get()
+        if text is None:
+            raise WebSocketDisconnect()
+        return {"type": "websocket.receive", "text": text}
+
+    async def receive_text(self):
+        return (await self.receive())["text"]
+
+    async def send_text(self, text):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.counter.hit()
+
+    async def send_bytes(self, data):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.counter.hit()
+
+
+SCENARIOS = [
+    # имя, кто шлёт, сообщение, сколько доставок на одно сообщение (v — зрителей).
+    # None — хаб копит и шлёт пачкой по тику, меряем только приём.
+    ("cursor_pos  viewer→hub    ", "viewer",
+     {"type": "cursor_pos", "x": 0.5, "y": 0.25}, lambda v: None),
+    ("draw        viewer→hub    ", "viewer",
+     {"type": "draw", "tool": "pen", "x1": 0.1, "y1": 0.2, "x2": 0.3, "y2": 0.4,
+      "color": "#ff6b6b", "size": 3}, lambda v: None),
+    ("move        viewer→host   ", "viewer",
+     {"action": "move", "x": 0.5, "y": 0.5}, lambda v: 1),
+    ("chat        viewer→all    ", "viewer",
+     {"type": "chat", "text": "привет"}, lambda v: v),
+    ("process_list host→viewers ", "host",
+     {"type": "process_list", "processes": [
+         {"pid": i, "name": f"proc{i}.exe", "cpu": 1.5, "ram_mb": 42} for i in range(30)
+     ]}, lambda v: v),
+]
+
+
+async def run(messages, viewers, slow_ms=0):
+    host_counter = Counter()
+    viewer_counter = Counter()
+    host = FakeSocket(host_counter)
+    tasks = [asyncio.create_task(main.ws_host(host, code=CODE, token=""))]
+    await asyncio.sleep(0.05)
+    socks = []
+    for i in range(viewers):
+        v = FakeSocket(viewer_counter)
+        socks.append(v)
+        tasks.append(asyncio.create_task(main.ws_viewer(v, code=CODE, password="", name=f"Bench{i}")))
+    if slow_ms:
+        slow = FakeSocket(Counter(), slow_ms / 1000)
+        socks.append(slow)
+        tasks.append(asyncio.create_task(main.ws_viewer(slow, code=CODE, password="", name="Slow")))
+    await asyncio.sleep(0.2)
+
+    print(f"{messages} сообщений, зрителей: {viewers}"
+          + (f" + медленный ({slow_ms} мс на отправку)" if slow_ms else ""))
+    results = {}
+    for name, source, msg, fanout in SCENARIOS:
+        text = json.dumps(msg)
+        host_counter.arm(None)
+        viewer_counter.arm(None)
+        if fanout(viewers) is None:
+            waits = []
+        elif source == "host":
+            viewer_counter.arm(messages * fanout(viewers))
+            waits = [viewer_counter.done]
+        elif msg.get("type") == "chat":
+            host_counter.arm(messages)
+            viewer_counter.arm(messages * (viewers - 1))
+            waits = [host_counter.done, viewer_counter.done]
+        elif fanout(viewers) == 1:
+            host_counter.arm(messages)
+            waits = [host_counter.done]
+        else:
+            viewer_counter.arm(messages * fanout(viewers))
+            waits = [viewer_counter.done]
+        src = host if source == "host" else socks[0]
+
+        t0 = time.perf_counter()
+        for _ in range(messages):
+            src.inbox.put_nowait(text)
+        for w in waits:
+            await asyncio.wait_for(w.wait(), 120)
+        while not src.inbox.empty():
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - t0
+        results[name.strip()] = round(messages / elapsed)
+        print(f"  {name}  {messages / elapsed:10,.0f} msg/s")
+
+    for s in socks + [host]:
+        s.inbox.put_nowait(None)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return results
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--messages", type=int, default=20000)
+    ap.add_argument("--viewers", type=int, default=4)
+    ap.add_argument("--slow-ms", type=float, default=0)
+    args = ap.parse_args()
+    asyncio.run(run(args.messages, args.viewers, args.slow_ms))
@@ -2,26 +2,106 @@ import asyncio
 import json
 import os
 import random
-import string
 import zipfile
 import io
 import time
 import uuid
 import shutil
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, Request, UploadFile, File
+import sqlite3
+import sys
+import hashlib
+import hmac
+import secrets
+import struct
+import mimetypes
+import math
+import bisect
+from array import array
+from collections import deque
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.requests import ClientDisconnect
 
-app = FastAPI()
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None  # без redis — только один воркер (MemoryBackend)
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # Остановка: последняя пачка аудита ещё в памяти — на диск
+    await audit_log.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # ═══════════════════════════════════════════════════════
 # Сессии
 # ═══════════════════════════════════════════════════════
 
+# Локальные сокеты этого воркера. Общие поля сессии живут в реестре (backend).
 sessions: dict = {}
+CODE_DIGITS = 6
+# Сессия без хоста и зрителей живёт не дольше: CLAIM — код выдан, а хост
+# так и не пришёл; IDLE — хост был, но сессия осталась пустой
+SESSION_CLAIM_TTL = int(os.environ.get("ORBDESK_SESSION_CLAIM_TTL", 300))  # сек
+SESSION_IDLE_TTL = int(os.environ.get("ORBDESK_SESSION_IDLE_TTL", 600))    # сек
+SESSION_SWEEP_INTERVAL = 30         # сек между проходами чистильщика сессий
+# Сколько сессия ждёт хоста после обрыва: зрители остаются, код держится за ним
+HOST_GRACE = int(os.environ.get("ORBDESK_HOST_GRACE", 30))   # сек, 0 — закрывать сразу
 MAX_VIEWERS = 5
+VIEWER_QUEUE_SIZE = 2    # кадров в очереди зрителя, старые выбрасываются
+VIEWER_MESSAGE_LIMIT = 1024  # текстов и кусков файлов в очереди зрителя, дальше — потери
+CURSOR_TICK = 1 / 30     # сек, Ghost Cursors уходят пачкой не чаще 30 раз в секунду
+BOARD_TICK = 1 / 30      # сек, штрихи доски уходят зрителям пачкой раз в кадр
+BOARD_MAX_POINTS = 100_000   # координат на доске сессии, дальше вытесняются старые фигуры
+BOARD_POINT_BYTES = 32       # координата в списке: float + указатель — для учёта памяти
+BOARD_SYNC_INTERVAL = 1.0    # сек, не чаще пишем снимок доски в реестр
+DELTA_MAGIC = b"ODTL"    # дельта-кадр из тайлов (см. orbdesk_host.DeltaEncoder)
+VIDEO_MAGIC = b"ODVC"    # кадр H.264: "ODVC" | флаги u8 | ширина u16 | высота u16 | Annex B
+VIDEO_KEY = 1            # флаг ключевого кадра (IDR) — с него декодер начинает
+MONITOR_MAGIC = b"ODMN"  # кадр: "ODMN" | монитор u8 | слой u8 | JPEG, дельта или видео
+MONITOR_HEADER = struct.Struct("<4sBB")
+LAYER_CHECK_INTERVAL = 1.0  # сек, как часто хаб пересматривает слой simulcast зрителя
+LAYER_UP_PERIODS = 3        # столько периодов без переполнения — и слой получше
+PRIMARY_MONITOR = 1      # номер mss основного монитора — подписка зрителя по умолчанию
+MAX_MONITORS = 16
+KEYFRAME_REQUEST_INTERVAL = 1.0  # сек, не чаще просим у хоста полный кадр
+# Бинарный канал OrbExplorer: magic | transfer_id u32 | offset u64 | flags u8 | данные
+FILE_MAGIC = b"ODFT"
+FILE_HEADER = struct.Struct("<4sIQB")
+FILE_META, FILE_END, FILE_ERROR = 1, 2, 4
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+UPLOAD_CHUNK = 1024 * 1024          # запись на диск кусками по 1 MB
+UPLOAD_PART = 8 * 1024 * 1024       # размер куска для докачки (PUT)
+UPLOAD_FORM_OVERHEAD = 64 * 1024    # заголовки multipart поверх самого файла
+UPLOAD_MAX_FILE = int(os.environ.get("ORBDESK_UPLOAD_MAX_FILE", 2 * 1024 ** 3))
+UPLOAD_MAX_SESSION = int(os.environ.get("ORBDESK_UPLOAD_MAX_SESSION", 4 * 1024 ** 3))
+active_uploads = set()              # upload_id, в которые сейчас идёт PUT
+UPLOAD_TTL = int(os.environ.get("ORBDESK_UPLOAD_TTL", 6 * 3600))        # сек
+UPLOAD_DISK_BUDGET = int(os.environ.get("ORBDESK_UPLOAD_DISK_BUDGET", 20 * 1024 ** 3))
+UPLOAD_SWEEP_INTERVAL = 60          # сек между проходами чистильщика
+
+# Реестр и шина между воркерами: redis://host:6379/0 для uvicorn --workers N
+BACKEND_URL = os.environ.get("ORBDESK_BACKEND_URL", "")
+WORKER_ID = uuid.uuid4().hex[:8]
+AUDIT_TAIL = 50          # событий аудита в реестре на сессию
+
+# Аудит на диске: SQLite в режиме WAL, один файл на все воркеры.
+# По умолчанию — в домашней папке, подальше от отдаваемых наружу static/ и uploads/
+AUDIT_DB = os.environ.get("ORBDESK_AUDIT_DB",
+                          os.path.join(os.path.expanduser("~"), ".orbdesk", "audit.db"))
+AUDIT_RETENTION = int(os.environ.get("ORBDESK_AUDIT_RETENTION", 30 * 86400))  # сек
+AUDIT_PRUNE_INTERVAL = 3600  # сек между чистками журнала старше AUDIT_RETENTION
+AUDIT_TICK = 0.25            # сек: события уходят зрителям и в реестр пачкой
+AUDIT_FLUSH_INTERVAL = 1.0   # сек между транзакциями записи на диск
+AUDIT_QUEUE_LIMIT = 10_000   # событий в очереди на диск, дальше теряем самые старые
+AUDIT_PAGE_MAX = 1000        # событий на страницу /api/audit
+BUS_QUEUE_SIZE = 256     # кадров в очереди публикации на шину
 
 # Цвета для Ghost Cursors
 CURSOR_COLORS = [
@@ -29,11 +109,1050 @@ CURSOR_COLORS = [
     "#fd79a8", "#00cec9", "#fab1a0", "#6c5ce7",
 ]
 
-def gen_code():
+class CodePool:
+    """Свободные коды сессий: выдача и возврат за O(1), без повторных попыток.
+
+    free[:size] — свободные коды, pos[код] — индекс кода в free.
+    Выдача — случайный из свободных; на его место встаёт последний
+    свободный, а он сам уходит за границу size. Возврат — обратно.
+    """
+
+    def __init__(self, digits=CODE_DIGITS):
+        n = 10 ** digits
+        self.digits = digits
+        self.free = array("I", range(n))
+        self.pos = array("I", range(n))
+        self.size = n
+
+    def _swap(self, i, j):
+        a, b = self.free[i], self.free[j]
+        self.free[i], self.free[j] = b, a
+        self.pos[a], self.pos[b] = j, i
+
+    def _index(self, code):
+        if len(code) != self.digits or not code.isdigit():
+            return None
+        return self.pos[int(code)]
+
+    def take(self, code=None):
+        """Занимает code или случайный свободный. None — занимать нечего."""
+        if code is None:
+            if not self.size:
+                return None
+            i = random.randrange(self.size)
+        else:
+            i = self._index(code)
+            if i is None or i >= self.size:
+                return None      # чужой формат или уже занят
+        self.size -= 1
+        self._swap(i, self.size)
+        return f"{self.free[self.size]:0{self.digits}d}"
+
+    def release(self, code):
+        i = self._index(code)
+        if i is None or i < self.size:
+            return
+        self._swap(i, self.size)
+        self.size += 1
+
+
+code_pool = CodePool()
+
+
+class Session:
+    """Локальное состояние сессии на этом воркере.
+
+    __slots__ — у сессии нет dict: меньше памяти, а опечатка в имени поля
+    падает сразу, а не заводит новое поле.
+    """
+
+    __slots__ = (
+        "code", "host", "remote", "claimed", "seen", "viewers", "viewer_meta",
+        "control_allowed", "password", "chat_history", "monitors", "metrics",
+        "last_metrics", "abr_state", "stage_timing", "next_color_idx", "privacy_shield",
+        "senders", "transfers", "cursors", "cursor_task", "keyframe_requested", "layers",
+        "keyframes", "board", "board_pending", "board_task", "board_synced", "stats",
+        "bus_handlers", "grace_task",
+    )
+
+    def __init__(self, code, **fields):
+        self.code = code
+        self.host = None             # ws хоста, если он подключён к этому воркеру
+        self.remote = False          # True — хост на другом воркере, здесь только зрители
+        self.claimed = False         # хост хоть раз подключался
+        self.seen = time.monotonic()  # когда в последний раз был хост или зрители
+        self.viewers = []
+        self.viewer_meta = {}        # ws -> {id, color, name, video}
+        self.control_allowed = True
+        self.password = None
+        self.chat_history = []
+        self.monitors = []
+        self.metrics = None          # MetricsStore, заводится с первой точкой от хоста
+        self.last_metrics = None
+        self.abr_state = None
+        self.stage_timing = None
+        self.next_color_idx = 0
+        self.privacy_shield = False
+        self.senders = {}            # ws -> ViewerSender
+        self.transfers = {}          # transfer_id -> ws зрителя, который скачивает файл
+        self.cursors = {}            # viewer_id -> [x, y], изменившиеся с прошлого тика
+        self.cursor_task = None
+        self.keyframe_requested = {}  # (монитор, слой) -> когда последний раз просили полный кадр
+        self.layers = 1              # слоёв simulcast у хоста (по номерам пришедших кадров)
+        self.keyframes = {}          # (монитор, слой) -> последний полный кадр, сразу новому зрителю
+        self.board = Whiteboard()    # рисунки зрителей с последнего draw_clear
+        self.board_pending = {}      # viewer_id -> (ws, Whiteboard) — ещё не разосланные штрихи
+        self.board_task = None
+        self.board_synced = 0
+        self.stats = RelayStats()    # счётчики для /metrics
+        self.bus_handlers = {}
+        self.grace_task = None       # ждём переподключения хоста, см. hold_session
+        self.update(fields)
+
+    def update(self, fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def memory(self):
+        """Примерный объём сессии в байтах по частям. Кадры — по длине,
+        контейнеры — по sys.getsizeof без содержимого сокетов."""
+        size = sys.getsizeof
+        return {
+            "session": size(self) + sum(size(getattr(self, f)) for f in (
+                "viewers", "viewer_meta", "senders", "transfers", "cursors",
+                "keyframe_requested", "keyframes", "board_pending")),
+            "keyframes": sum(len(f) for f in self.keyframes.values()),
+            "queues": sum(x.queued_bytes for x in self.senders.values()),
+            "board": self.board.points * BOARD_POINT_BYTES,
+            "chat": sum(len(json.dumps(m)) for m in self.chat_history),
+            "metrics": self.metrics.nbytes() if self.metrics else 0,
+        }
+
+
+def add_session(code, **fields):
+    """Заводит сессию на этом воркере: код занят в пуле, чистильщик запущен."""
+    code_pool.take(code)
+    s = sessions[code] = Session(code, **fields)
+    ensure_session_sweeper()
+    return s
+
+
+def drop_session(s):
+    """Убирает сессию с воркера: счётчики — в общие, код — обратно в пул."""
+    if sessions.get(s.code) is s:
+        del sessions[s.code]
+        retired_stats.absorb(s.stats)
+        code_pool.release(s.code)
+
+
+# ═══════════════════════════════════════════════════════
+# Реестр сессий и шина между воркерами
+# ═══════════════════════════════════════════════════════
+
+# Поля сессии, которые видят все воркеры
+SHARED_FIELDS = ("password", "control_allowed", "monitors", "privacy_shield",
+                 "last_metrics", "abr_state", "stage_timing")
+
+
+class Broker:
+    """Интерфейс реестра сессий и шины сообщений.
+
+    Реестр — общие поля сессии: на каком воркере хост, пароль, контроль,
+    мониторы, число зрителей и хвост аудита. Шина — каналы pub/sub,
+    по которым кадры и сообщения ходят между воркерами.
+    Публикация не ждёт сети: сообщения уходят по порядку одной задачей.
+    Предел BUS_QUEUE_SIZE — только для кадров (droppable): лишний кадр
+    выбрасывается, а служебные сообщения ждут своей очереди, сколько бы
+    их ни было, — потерянный S оставил бы зеркалу кадр из-под шторки.
+    """
+
+    distributed = False
+
+    def __init__(self):
+        self.handlers = {}       # channel -> set(callback)
+        self.outbox = None       # deque (channel, payload, droppable) по порядку
+        self.wake = None
+        self.queued_frames = 0
+        self.dropped = 0
+        self.receivers = {}      # channel -> сколько подписчиков насчитал последний PUBLISH
+
+    # ─── Реестр ───
+    async def get(self, code):
+        raise NotImplementedError
+
+    async def update(self, code, fields):
+        raise NotImplementedError
+
+    async def delete(self, code):
+        raise NotImplementedError
+
+    async def incr(self, code, field, n=1):
+        raise NotImplementedError
+
+    async def push_audit(self, code, entries):
+        raise NotImplementedError
+
+    async def audit_tail(self, code, n=AUDIT_TAIL):
+        raise NotImplementedError
+
+    # ─── Шина ───
+    async def _publish(self, channel, payload):
+        raise NotImplementedError
+
+    async def _listen(self, channel):
+        pass
+
+    async def _unlisten(self, channel):
+        pass
+
+    def publish(self, channel, payload, droppable=False):
+        if self.outbox is None:
+            self.outbox = deque()
+            self.wake = asyncio.Event()
+            asyncio.ensure_future(self._pump())
+        if droppable:
+            if self.queued_frames >= BUS_QUEUE_SIZE:
+                self.dropped += 1
+                return
+            self.queued_frames += 1
+        self.outbox.append((channel, payload, droppable))
+        self.wake.set()
+
+    async def _pump(self):
+        while True:
+            if not self.outbox:
+                self.wake.clear()
+                await self.wake.wait()
+                continue
+            channel, payload, droppable = self.outbox.popleft()
+            if droppable:
+                self.queued_frames -= 1
+            try:
+                n = await self._publish(channel, payload)
+                if n is not None:
+                    self.receivers[channel] = n
+            except Exception as e:
+                print(f"[Hub] Broker publish error: {e}")
+
+    def has_listeners(self, channel):
+        """Слушает ли канал кто-то, кроме этого воркера. Пока не знаем — да."""
+        n = self.receivers.get(channel)
+        return n is None or n > (channel in self.handlers)
+
+    def forget_listeners(self, channel):
+        self.receivers.pop(channel, None)
+
+    async def subscribe(self, channel, callback):
+        first = channel not in self.handlers
+        self.handlers.setdefault(channel, set()).add(callback)
+        if first:
+            await self._listen(channel)
+
+    async def unsubscribe(self, channel, callback):
+        handlers = self.handlers.get(channel)
+        if not handlers:
+            return
+        handlers.discard(callback)
+        if not handlers:
+            del self.handlers[channel]
+            await self._unlisten(channel)
+
+    def dispatch(self, channel, payload):
+        for callback in list(self.handlers.get(channel, ())):
+            try:
+                callback(payload)
+            except Exception as e:
+                print(f"[Hub] Broker handler error: {e}")
+
+
+class MemoryBackend(Broker):
+    """Реестр и шина в памяти процесса — один воркер, локальная замена Redis."""
+
+    def __init__(self, distributed=False):
+        super().__init__()
+        self.distributed = distributed
+        self.data = {}
+        self.audit = {}
+
+    async def get(self, code):
+        d = self.data.get(code)
+        return dict(d) if d is not None else None
+
+    async def update(self, code, fields):
+        self.data.setdefault(code, {}).update(fields)
+
+    async def delete(self, code):
+        self.data.pop(code, None)
+        self.audit.pop(code, None)
+
+    async def incr(self, code, field, n=1):
+        d = self.data.setdefault(code, {})
+        d[field] = d.get(field, 0) + n
+        return d[field]
+
+    async def push_audit(self, code, entries):
+        self.audit.setdefault(code, deque(maxlen=AUDIT_TAIL)).extend(entries)
+
+    async def audit_tail(self, code, n=AUDIT_TAIL):
+        return list(self.audit.get(code, ()))[-n:]
+
+    async def _publish(self, channel, payload):
+        self.dispatch(channel, payload)
+
+
+class RedisBackend(Broker):
+    """Реестр в Redis-хэшах, шина на Redis pub/sub.
+
+    Подходит любой совместимый сервер; клиент можно передать готовый
+    (например, fakeredis.aioredis.FakeRedis для проверки без сервера).
+    """
+
+    distributed = True
+
+    def __init__(self, client):
+        super().__init__()
+        self.r = client
+        self.pubsub = client.pubsub()
+        self.reader = None
+
+    @staticmethod
+    def _key(code):
+        return f"orbdesk:session:{code}"
+
+    async def get(self, code):
+        raw = await self.r.hgetall(self._key(code))
+        if not raw:
+            return None
+        return {k.decode(): json.loads(v) for k, v in raw.items()}
+
+    async def update(self, code, fields):
+        await self.r.hset(self._key(code),
+                          mapping={k: json.dumps(v) for k, v in fields.items()})
+
+    async def delete(self, code):
+        await self.r.delete(self._key(code), f"orbdesk:audit:{code}")
+
+    async def incr(self, code, field, n=1):
+        return await self.r.hincrby(self._key(code), field, n)
+
+    async def push_audit(self, code, entries):
+        key = f"orbdesk:audit:{code}"
+        async with self.r.pipeline(transaction=False) as p:
+            p.rpush(key, *(json.dumps(e) for e in entries))
+            p.ltrim(key, -AUDIT_TAIL, -1)
+            await p.execute()
+
+    async def audit_tail(self, code, n=AUDIT_TAIL):
+        return [json.loads(e) for e in await self.r.lrange(f"orbdesk:audit:{code}", -n, -1)]
+
+    async def _publish(self, channel, payload):
+        return await self.r.publish(channel, payload)
+
+    async def _listen(self, channel):
+        await self.pubsub.subscribe(channel)
+        if self.reader is None:
+            self.reader = asyncio.ensure_future(self._read())
+
+    async def _unlisten(self, channel):
+        await self.pubsub.unsubscribe(channel)
+
+    async def _read(self):
+        while True:
+            try:
+                msg = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except Exception as e:
+                print(f"[Hub] Broker read error: {e}")
+                await asyncio.sleep(1)
+                continue
+            if msg and msg["type"] == "message":
+                self.dispatch(msg["channel"].decode(), msg["data"])
+
+
+def make_backend(url=BACKEND_URL):
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        if aioredis is None:
+            raise RuntimeError("ORBDESK_BACKEND_URL требует пакет redis: pip install redis")
+        return RedisBackend(aioredis.from_url(url))
+    return MemoryBackend()
+
+
+backend = make_backend()
+WORKER_TAG = WORKER_ID.encode()
+
+
+def channel(code, side):
+    """Канал сессии: side="v" — к зрителям, "h" — к хосту."""
+    return f"orbdesk:{code}:{side}"
+
+
+def bus_send(code, side, kind, body):
+    """Публикует на шину: kind (1 байт) | id воркера (8 байт) | тело.
+    Кадр (F) уходит, только если у сессии есть зеркало на другом воркере."""
+    if not backend.distributed:
+        return
+    ch = channel(code, side)
+    if kind == b"F":
+        if backend.has_listeners(ch):
+            backend.publish(ch, kind + WORKER_TAG + body, droppable=True)
+    else:
+        backend.publish(ch, kind + WORKER_TAG + body)
+
+
+async def share(code, **fields):
+    """Меняет общие поля сессии: локально, в реестре и на других воркерах."""
+    s = sessions.get(code)
+    if s:
+        s.update(fields)
+    await backend.update(code, fields)
+    bus_send(code, "v", b"S", json.dumps(fields).encode())
+
+
+async def send_to_host(code, text):
+    """Сообщение хосту — напрямую или через воркер, где он подключён."""
+    s = sessions.get(code)
+    if s and s.host:
+        try:
+            await s.host.send_text(text)
+        except: pass
+    else:
+        bus_send(code, "h", b"T", text.encode())
+
+
+def deliver(session, text, exclude=None):
+    """Текст локальным зрителям — в их очереди, без ожидания сокетов."""
+    for v, sender in session.senders.items():
+        if v is not exclude:
+            sender.push_message(text)
+
+
+def broadcast(code, text, exclude=None):
+    """Текст всем зрителям сессии на всех воркерах. Кодируется один раз вызывающим."""
+    s = sessions.get(code)
+    if s:
+        deliver(s, text, exclude)
+    bus_send(code, "v", b"T", text.encode())
+
+
+async def send_quiet(ws, text):
+    """Отправка «в фоне»: ошибки закрытого сокета не интересны."""
+    try:
+        await ws.send_text(text)
+    except Exception:
+        pass
+
+
+def on_viewer_bus(code, payload):
+    """Кадры и события с других воркеров для локальных зрителей."""
+    kind, origin, body = payload[:1], payload[1:9], payload[9:]
+    s = sessions.get(code)
+    if origin == WORKER_TAG or not s:
+        return
+    if kind == b"F":
+        s.stats.received(len(body))
+        fan_out(s, body)
+    elif kind == b"T":
+        deliver(s, body.decode())
+    elif kind == b"S":
+        fields = json.loads(body)
+        s.update(fields)
+        if fields.get("privacy_shield"):
+            s.keyframes.clear()
+        elif fields.get("privacy_shield") is False:
+            for sender in s.senders.values():
+                sender.need_keyframe = set(sender.monitors)
+    elif kind == b"D":
+        route_file(s, body)
+    elif kind == b"W":
+        text = body.decode()
+        apply_board(s, json.loads(text))
+        deliver(s, text)
+    elif kind == b"K":
+        asyncio.ensure_future(drop_local_viewers(s, 4020, "Kicked"))
+    elif kind == b"X" and s.remote:
+        asyncio.ensure_future(close_mirror(s))
+    elif kind == b"R":
+        # Хост вернулся на другой воркер: если ждали его здесь — теперь мы зеркало
+        if s.grace_task:
+            s.grace_task.cancel()
+            s.grace_task = None
+            s.remote = True
+        asyncio.ensure_future(resync_host(s))
+
+
+def on_host_bus(code, payload):
+    """Сообщения хосту от зрителей с других воркеров."""
+    s = sessions.get(code)
+    if payload[1:9] == WORKER_TAG or not s or not s.host:
+        return
+    # С другого воркера пишут зрители — у канала кадров, видимо, новый подписчик
+    backend.forget_listeners(channel(code, "v"))
+    asyncio.ensure_future(send_quiet(s.host, payload[9:].decode()))
+
+
+async def attach_bus(s):
+    if not backend.distributed:
+        return
+    code = s.code
+    s.bus_handlers = {
+        channel(code, "v"): lambda p: on_viewer_bus(code, p),
+    }
+    if s.host:
+        s.bus_handlers[channel(code, "h")] = lambda p: on_host_bus(code, p)
+    for ch, cb in s.bus_handlers.items():
+        await backend.subscribe(ch, cb)
+
+
+async def detach_bus(s):
+    handlers, s.bus_handlers = s.bus_handlers, {}
+    for ch, cb in handlers.items():
+        await backend.unsubscribe(ch, cb)
+
+
+async def resync_host(s):
+    """Хост после обрыва начал с чистого листа: заново шлём ему, что смотрят
+    и что умеют декодировать зрители этого воркера."""
+    for ws, sender in list(s.senders.items()):
+        meta = s.viewer_meta.get(ws)
+        if not meta or not sender.monitors:
+            continue
+        if "video" in meta:
+            await send_to_host(s.code, json.dumps({
+                "type": "codec_support", "viewer_id": meta["id"], "video": meta["video"],
+            }))
+        await send_to_host(s.code, json.dumps({
+            "type": "monitor_subscriptions", "viewer_id": meta["id"],
+            "monitors": sorted(sender.monitors),
+        }))
+
+
+async def close_mirror(s):
+    """Хост ушёл с другого воркера — закрываем локальных зрителей."""
+    viewers = list(s.viewers)
+    clear_viewers(s)
+    for v in viewers:
+        try:
+            await v.close(code=4010, reason="Host left")
+        except: pass
+    drop_session(s)
+    await detach_bus(s)
+
+
+# ═══════════════════════════════════════════════════════
+# Отправка кадров зрителям
+# ═══════════════════════════════════════════════════════
+
+def frame_info(frame):
+    """(монитор, слой, полный ли кадр). Кадр без заголовка ODMN — основного монитора.
+    Дельта и видеокадр без флага ключевого опираются на прошлые кадры."""
+    monitor, layer, base = PRIMARY_MONITOR, 0, 0
+    if frame[:4] == MONITOR_MAGIC:
+        monitor, layer, base = frame[4], frame[5], MONITOR_HEADER.size
+    magic = frame[base:base + 4]
+    if magic == VIDEO_MAGIC:
+        return monitor, layer, bool(frame[base + 4] & VIDEO_KEY)
+    return monitor, layer, magic != DELTA_MAGIC
+
+
+class ViewerSender:
+    """Своя задача отправки и маленькая очередь на каждого зрителя.
+
+    Если зритель не успевает, старые кадры выбрасываются и остаётся
+    только самый свежий — медленный канал не тормозит остальных.
+    Дельту выбросить нельзя, поэтому при переполнении зритель ждёт
+    следующий полный кадр этого монитора (need_keyframe).
+    monitors — на какие мониторы хоста зритель подписан. Если хост шлёт
+    несколько слоёв качества (simulcast), зрителю идёт один — layer;
+    pick_layer выбирает его по переполнениям очереди.
+    Тексты и куски файлов идут отдельной очередью по порядку и
+    чередуются с кадрами; объём файлов ограничивает окно кредитов на хосте.
+    """
+
+    def __init__(self, ws, stats, maxsize=VIEWER_QUEUE_SIZE):
+        self.ws = ws
+        self.stats_ = stats      # RelayStats сессии
+        self.queue = asyncio.Queue(maxsize)  # (кадр, когда пришёл на хаб)
+        self.messages = deque()  # str — текст, bytes — кусок файла
+        self.wake = asyncio.Event()
+        self.delivered = 0
+        self.dropped = 0
+        self.dropped_messages = 0
+        self.queued_bytes = 0    # кадры и сообщения в очередях — для учёта памяти
+        self.alive = True
+        self.monitors = set()
+        self.need_keyframe = set()
+        self.layer = 0           # 0 — лучший слой
+        self.overflows = 0       # переполнения очереди — давление на канал зрителя
+        self.overflows_seen = 0
+        self.layer_checked = 0.0
+        self.calm_periods = 0
+        self.task = asyncio.create_task(self._run())
+
+    def subscribe(self, monitors):
+        """Новые мониторы начинаются с полного кадра. Возвращает их."""
+        added = set(monitors) - self.monitors
+        self.monitors = set(monitors)
+        self.need_keyframe = (self.need_keyframe & self.monitors) | added
+        return added
+
+    def push(self, frame, monitor, keyframe=True):
+        """Кладёт кадр в очередь, не дожидаясь сокета.
+
+        Возвращает мониторы, для которых зрителю теперь нужен полный кадр.
+        """
+        if monitor in self.need_keyframe:
+            if not keyframe:
+                self._dropped(1)
+                return {monitor}
+            self.need_keyframe.discard(monitor)
+        lost = set()
+        if self.queue.full():
+            self.overflows += 1
+            # Полный кадр заменяет старые кадры своего монитора; остальные — на пересинхронизацию
+            lost = self._drain(keep=monitor if keyframe else None)
+            if not keyframe:
+                self._dropped(1)
+                lost.add(monitor)
+            self.need_keyframe |= lost
+            if not keyframe:
+                return lost
+        self.queue.put_nowait((frame, time.perf_counter(), monitor))
+        self.queued_bytes += len(frame)
+        self.wake.set()
+        return lost
+
+    def preload(self, frame, monitor):
+        """Полный кадр из кэша хаба — зритель сразу видит экран. need_keyframe
+        не снимается: дельты после кэша к нему не подходят, ждём свежий."""
+        if not self.queue.full():
+            self.queue.put_nowait((frame, time.perf_counter(), monitor))
+            self.queued_bytes += len(frame)
+            self.wake.set()
+
+    def push_message(self, data):
+        if len(self.messages) >= VIEWER_MESSAGE_LIMIT:
+            self.dropped_messages += 1
+            self.stats_.messages_dropped += 1
+            return
+        self.messages.append(data)
+        self.queued_bytes += len(data)
+        self.wake.set()
+
+    def pick_layer(self, now, layers):
+        """Раз в LAYER_CHECK_INTERVAL: были переполнения — слой ниже,
+        LAYER_UP_PERIODS спокойных периодов — выше. True — слой сменился,
+        и зрителю нужны полные кадры нового слоя."""
+        if now - self.layer_checked < LAYER_CHECK_INTERVAL:
+            return False
+        self.layer_checked = now
+        pressure = self.overflows - self.overflows_seen
+        self.overflows_seen = self.overflows
+        layer = self.layer
+        if pressure:
+            self.calm_periods = 0
+            layer += 1
+        else:
+            self.calm_periods += 1
+            if self.calm_periods >= LAYER_UP_PERIODS:
+                self.calm_periods = 0
+                layer -= 1
+        layer = max(0, min(layer, layers - 1))
+        if layer == self.layer:
+            return False
+        self.layer = layer
+        self.need_keyframe = set(self.monitors)
+        return True
+
+    def _drain(self, keep=None):
+        lost = set()
+        while not self.queue.empty():
+            frame, _, monitor = self.queue.get_nowait()
+            self.queued_bytes -= len(frame)
+            self._dropped(1)
+            if monitor != keep:
+                lost.add(monitor)
+        return lost
+
+    def _dropped(self, n):
+        self.dropped += n
+        self.stats_.frames_dropped += n
+
+    async def _run(self):
+        try:
+            while True:
+                if self.queue.empty() and not self.messages:
+                    self.wake.clear()
+                    await self.wake.wait()
+                if not self.queue.empty():
+                    frame, queued_at, _ = self.queue.get_nowait()
+                    self.queued_bytes -= len(frame)
+                    await self.ws.send_bytes(frame)
+                    self.delivered += 1
+                    self.stats_.sent_frame(len(frame), time.perf_counter() - queued_at)
+                if self.messages:
+                    data = self.messages.popleft()
+                    self.queued_bytes -= len(data)
+                    if isinstance(data, str):
+                        await self.ws.send_text(data)
+                    else:
+                        await self.ws.send_bytes(data)
+                    self.stats_.bytes_out += len(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.alive = False
+
+    def stats(self):
+        return {
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "queued": self.queue.qsize(),
+            "layer": self.layer,
+            "messages_queued": len(self.messages),
+            "messages_dropped": self.dropped_messages,
+        }
+
+    def close(self):
+        self.alive = False
+        self.task.cancel()
+
+
+def fan_out(session, frame):
+    """Раскладывает кадр по очередям подписчиков его монитора (без ожидания сокетов)."""
+    monitor, layer, key = frame_info(frame)
+    if layer >= session.layers:
+        session.layers = layer + 1
+    if key:
+        # Тот же объект bytes уходит и в очереди зрителей — без копий
+        session.keyframes[(monitor, layer)] = frame
+    now = time.monotonic()
+    dead = []
+    resync = set()
+    for v, sender in session.senders.items():
+        if not sender.alive:
+            dead.append(v)
+        elif monitor in sender.monitors:
+            if sender.pick_layer(now, session.layers):
+                resync |= {(m, sender.layer) for m in sender.monitors}
+            if layer == sender.layer:
+                resync |= {(m, layer) for m in sender.push(frame, monitor, key)}
+    for d in dead:
+        remove_viewer(session, d)
+    for m, l in resync:
+        request_keyframe(session, m, l)
+
+
+def route_file(session, chunk):
+    """Кусок файла — только тому зрителю, который его запросил."""
+    _, tid, _, flags = FILE_HEADER.unpack_from(chunk)
+    ws = session.transfers.get(tid)
+    if ws is None:
+        return False
+    sender = session.senders.get(ws)
+    if sender:
+        sender.push_message(chunk)
+    if flags & (FILE_END | FILE_ERROR):
+        del session.transfers[tid]
+    return True
+
+
+def remove_viewer(session, ws):
+    """Убирает зрителя из сессии и останавливает его отправщик.
+
+    Зрителя убирает либо fan_out (сокет умер), либо его собственный
+    обработчик — кто первым. Уборку в реестре и уведомления делает
+    viewer_left; её задачу возвращает только первый вызов, дальше — None."""
+    for tid in [t for t, v in session.transfers.items() if v is ws]:
+        # Зритель ушёл посреди скачивания — хосту незачем читать файл дальше
+        del session.transfers[tid]
+        asyncio.ensure_future(send_to_host(session.code, json.dumps({
+            "type": "file_cancel", "transfer_id": tid,
+        })))
+    if ws in session.viewers:
+        session.viewers.remove(ws)
+    meta = session.viewer_meta.pop(ws, None)
+    sender = session.senders.pop(ws, None)
+    if sender:
+        sender.close()
+    if meta is None:
+        return None
+    return asyncio.ensure_future(viewer_left(session, meta, sender.stats() if sender else {}))
+
+
+async def viewer_left(session, meta, stats):
+    """Списывает ушедшего зрителя: счётчик и курсор в реестре, хост, аудит."""
+    code, viewer_id = session.code, meta["id"]
+    # Даже выгнанный зритель больше ничего не смотрит — хост может не захватывать
+    await send_to_host(code, json.dumps({
+        "type": "monitor_subscriptions", "viewer_id": viewer_id, "monitors": [],
+    }))
+    online = await lookup(code)
+    cnt = await backend.incr(code, "viewers", -1) if online else 0
+    print(f"[Hub] Viewer- {code} ({cnt}) "
+          f"delivered={stats.get('delivered', 0)} dropped={stats.get('dropped', 0)}")
+    add_audit(code, "viewer_disconnect", f"{meta['name']} отключился")
+    # Сообщаем другим зрителям что этот курсор ушёл
+    session.cursors.pop(viewer_id, None)
+    if online:
+        await backend.update(code, {f"cursor:{viewer_id}": None})
+    broadcast(code, json.dumps({
+        "type": "cursor_remove",
+        "viewer_id": viewer_id,
+    }))
+    await send_to_host(code, json.dumps({
+        "type": "viewer_count", "count": cnt
+    }))
+    # Последний зритель зеркала ушёл — отписываемся от шины
+    if session.remote and not session.viewers and sessions.get(code) is session:
+        drop_session(session)
+        await detach_bus(session)
+
+
+def request_keyframe(session, monitor, layer=0, force=False):
+    """Просит хоста прислать полный кадр монитора и слоя (не чаще KEYFRAME_REQUEST_INTERVAL)."""
+    now = time.monotonic()
+    key = (monitor, layer)
+    if not force and now - session.keyframe_requested.get(key, 0) < KEYFRAME_REQUEST_INTERVAL:
+        return
+    session.keyframe_requested[key] = now
+    asyncio.ensure_future(send_to_host(session.code, json.dumps({
+        "type": "request_keyframe", "monitor": monitor, "layer": layer,
+    })))
+
+
+def clear_viewers(session):
+    for sender in session.senders.values():
+        sender.close()
+    session.senders.clear()
+    session.viewers.clear()
+    session.viewer_meta.clear()
+
+
+async def drop_local_viewers(session, close_code, reason):
+    """Закрывает всех зрителей этого воркера и списывает их из реестра."""
+    viewers = list(session.viewers)
+    n = len(viewers)
+    ids = [meta["id"] for meta in session.viewer_meta.values()]
+    # Сначала забираем зрителей из сессии: их обработчики, проснувшись
+    # от close, не спишут их из реестра второй раз
+    clear_viewers(session)
+    for v in viewers:
+        try:
+            await v.close(code=close_code, reason=reason)
+        except: pass
+    # Выгнанные больше ничего не смотрят — хост может не захватывать
+    for viewer_id in ids:
+        await send_to_host(session.code, json.dumps({
+            "type": "monitor_subscriptions", "viewer_id": viewer_id, "monitors": [],
+        }))
+    if n:
+        await backend.incr(session.code, "viewers", -n)
+
+
+async def kick_all(code):
+    s = sessions.get(code)
+    if s:
+        await drop_local_viewers(s, 4020, "Kicked")
+    bus_send(code, "v", b"K", b"")
+
+
+def host_lost(shared):
+    """Когда оборвался хост, если сессия ещё ждёт его переподключения."""
+    lost = shared.get("lost_at") if shared else None
+    if lost and time.time() - lost < HOST_GRACE:
+        return lost
+    return None
+
+
+async def lookup(code):
+    """Общие поля сессии из реестра, если хост онлайн (на любом воркере)
+    или сессия ждёт его переподключения."""
+    if not code:
+        return None
+    shared = await backend.get(code)
+    if not shared or not (shared.get("host") or host_lost(shared)):
+        return None
+    return shared
+
+
+session_sweeper_task = None
+
+
+async def expire_session(s):
+    """Пустая сессия отжила TTL: убираем с воркера, а из реестра — если
+    код за это время не занял хост на другом воркере."""
+    drop_session(s)
+    await detach_bus(s)
+    if s.remote:
+        return               # реестр ведёт воркер хоста
+    shared = await backend.get(s.code)
+    if sessions.get(s.code) is None and not (shared and shared.get("host")):
+        await backend.delete(s.code)
+    print(f"[Hub] Session expired: {s.code}")
+
+
+async def sweep_sessions():
+    """Фоновая чистка сессий, где давно нет ни хоста, ни зрителей."""
     while True:
-        c = ''.join(random.choices(string.digits, k=6))
-        if c not in sessions:
-            return c
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        now = time.monotonic()
+        for s in list(sessions.values()):
+            if s.host or s.viewers or s.grace_task:
+                s.seen = now
+                continue
+            ttl = SESSION_IDLE_TTL if s.claimed else SESSION_CLAIM_TTL
+            if now - s.seen > ttl:
+                try:
+                    await expire_session(s)
+                except Exception as e:
+                    print(f"[Hub] Session sweep error: {e}")
+
+
+def ensure_session_sweeper():
+    global session_sweeper_task
+    if session_sweeper_task is None or session_sweeper_task.done():
+        session_sweeper_task = asyncio.ensure_future(sweep_sessions())
+
+
+# ═══════════════════════════════════════════════════════
+# Метрики хаба (/metrics)
+# ═══════════════════════════════════════════════════════
+
+# Границы корзин задержки кадра на хабе: от очереди зрителя до ухода в сокет, сек
+RELAY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class RelayStats:
+    """Счётчики одной сессии на этом воркере.
+
+    Обычные int: всё пишется из event loop воркера, блокировки не нужны.
+    Скорости (кадров/с, байт/с) Prometheus считает сам через rate().
+    """
+
+    __slots__ = ("frames_in", "bytes_in", "frames_out", "bytes_out", "frames_dropped",
+                 "messages_dropped", "upload_bytes", "host_resumes", "host_downtime",
+                 "texts", "latency", "latency_sum")
+
+    def __init__(self):
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.frames_dropped = 0
+        self.messages_dropped = 0
+        self.upload_bytes = 0
+        self.host_resumes = 0
+        self.host_downtime = 0.0     # сек без хоста до его возвращения, сумма
+        self.texts = {}          # тип сообщения -> сколько
+        self.latency = [0] * (len(RELAY_BUCKETS) + 1)   # последняя — +Inf
+        self.latency_sum = 0.0
+
+    def received(self, size):
+        self.frames_in += 1
+        self.bytes_in += size
+
+    def sent_frame(self, size, delay):
+        self.frames_out += 1
+        self.bytes_out += size
+        self.latency[bisect.bisect_left(RELAY_BUCKETS, delay)] += 1
+        self.latency_sum += delay
+
+    def text(self, kind):
+        self.texts[kind] = self.texts.get(kind, 0) + 1
+
+    def absorb(self, other):
+        """Итоги закрытой сессии — в общие, чтобы счётчики воркера не убывали."""
+        for name in self.__slots__:
+            if name == "texts":
+                for kind, n in other.texts.items():
+                    self.texts[kind] = self.texts.get(kind, 0) + n
+            elif name == "latency":
+                self.latency = [a + b for a, b in zip(self.latency, other.latency)]
+            else:
+                setattr(self, name, getattr(self, name) + getattr(other, name))
+
+
+retired_stats = RelayStats()     # сессии этого воркера, которых уже нет
+METRICS_TOKEN = os.environ.get("ORBDESK_METRICS_TOKEN", "")
+
+
+def count_upload(code, n):
+    s = sessions.get(code)
+    (s.stats if s else retired_stats).upload_bytes += n
+
+
+COUNTERS = (
+    ("frames_in", "orbdesk_frames_in_total", "Кадров от хостов"),
+    ("bytes_in", "orbdesk_bytes_in_total", "Байт кадров от хостов"),
+    ("frames_out", "orbdesk_frames_out_total", "Кадров отправлено зрителям"),
+    ("bytes_out", "orbdesk_bytes_out_total", "Байт отправлено зрителям (кадры, тексты, файлы)"),
+    ("frames_dropped", "orbdesk_frames_dropped_total", "Кадров выброшено из очередей зрителей"),
+    ("messages_dropped", "orbdesk_messages_dropped_total", "Сообщений выброшено из очередей зрителей"),
+    ("upload_bytes", "orbdesk_upload_bytes_total", "Байт принято загрузками OrbDrop"),
+    ("host_resumes", "orbdesk_host_resumes_total", "Хостов, вернувшихся в сессию после обрыва"),
+    ("host_downtime", "orbdesk_host_downtime_seconds_total", "Секунд от обрыва хоста до его возвращения"),
+)
+
+
+def render_metrics(per_session):
+    """Текстовый формат Prometheus. Общие ряды — сумма по сессиям и закрытым.
+    per_session — ещё и ряды с меткой code (сами коды доступа, не для всех)."""
+    worker = f'worker="{WORKER_ID}"'
+    live = list(sessions.items())
+    shown = live if per_session else []
+    total = RelayStats()
+    total.absorb(retired_stats)
+    for _, s in live:
+        total.absorb(s.stats)
+    out = []
+
+    def family(name, kind, help_):
+        out.append(f"# HELP {name} {help_}")
+        out.append(f"# TYPE {name} {kind}")
+
+    for attr, name, help_ in COUNTERS:
+        family(name, "counter", help_)
+        out.append(f"{name}{{{worker}}} {getattr(total, attr)}")
+        for code, s in shown:
+            out.append(f'{name}{{{worker},code="{code}"}} {getattr(s.stats, attr)}')
+
+    family("orbdesk_text_messages_total", "counter", "Текстовых сообщений по типу")
+    for kind, n in sorted(total.texts.items()):
+        out.append(f'orbdesk_text_messages_total{{{worker},type="{kind}"}} {n}')
+
+    name = "orbdesk_relay_latency_seconds"
+    family(name, "histogram", "От прихода кадра на хаб до отправки зрителю")
+    for labels, st in [(worker, total)] + [(f'{worker},code="{c}"', s.stats) for c, s in shown]:
+        acc = 0
+        for bound, n in zip(RELAY_BUCKETS + ("+Inf",), st.latency):
+            acc += n
+            out.append(f'{name}_bucket{{{labels},le="{bound}"}} {acc}')
+        out.append(f"{name}_sum{{{labels}}} {st.latency_sum:.6f}")
+        out.append(f"{name}_count{{{labels}}} {acc}")
+
+    family("orbdesk_viewer_queue_depth", "gauge", "Кадров и сообщений в очередях зрителей")
+    depth = {code: sum(x.queue.qsize() + len(x.messages) for x in s.senders.values())
+             for code, s in live}
+    out.append(f"orbdesk_viewer_queue_depth{{{worker}}} {sum(depth.values())}")
+    for code, _ in shown:
+        out.append(f'orbdesk_viewer_queue_depth{{{worker},code="{code}"}} {depth[code]}')
+
+    family("orbdesk_session_memory_bytes", "gauge", "Примерная память сессий по частям")
+    memory = {code: s.memory() for code, s in live}
+    for part in ("session", "keyframes", "queues", "board", "chat", "metrics"):
+        out.append(f'orbdesk_session_memory_bytes{{{worker},part="{part}"}} '
+                   f'{sum(m[part] for m in memory.values())}')
+    for code, _ in shown:
+        out.append(f'orbdesk_session_memory_bytes{{{worker},code="{code}"}} {sum(memory[code].values())}')
+    family("orbdesk_free_codes", "gauge", "Свободных кодов сессий в пуле воркера")
+    out.append(f"orbdesk_free_codes{{{worker}}} {code_pool.size}")
+
+    family("orbdesk_sessions", "gauge", "Сессий с хостом на этом воркере")
+    out.append(f"orbdesk_sessions{{{worker}}} {sum(1 for _, s in live if s.host)}")
+    family("orbdesk_viewers", "gauge", "Зрителей на этом воркере")
+    out.append(f"orbdesk_viewers{{{worker}}} {sum(len(s.viewers) for _, s in live)}")
+    for code, s in shown:
+        out.append(f'orbdesk_viewers{{{worker},code="{code}"}} {len(s.viewers)}')
+    return "\n".join(out) + "\n"
 
 
 # ═══════════════════════════════════════════════════════
@@ -42,32 +1161,27 @@ def gen_code():
 
 @app.get("/session/create")
 async def create_session():
-    code = gen_code()
-    sessions[code] = {
-        "host": None,
-        "viewers": [],
-        "viewer_meta": {},       # ws -> {id, color, name}
-        "control_allowed": True,
-        "password": None,
-        "chat_history": [],
-        "monitors": [],
-        "metrics_history": [],   # последние 60 точек CPU/RAM
-        "last_metrics": None,
-        "next_color_idx": 0,
-        "privacy_shield": False,
-        "audit_log": [],         # журнал событий
-    }
+    while True:
+        code = code_pool.take()
+        if code is None:
+            return JSONResponse({"error": "No free codes"}, status_code=503)
+        if not backend.distributed or not await backend.get(code):
+            break
+        # Код занят сессией другого воркера — пусть остаётся занятым и здесь
+    add_session(code)
+    await backend.update(code, {"host": None})
     return {"code": code}
 
 @app.get("/session/check")
 async def check_session(code: str = Query("")):
-    s = sessions.get(code)
-    if s and s["host"]:
+    shared = await lookup(code)
+    if shared:
         return {
             "online": True,
-            "viewers": len(s["viewers"]),
-            "control": s["control_allowed"],
-            "has_password": s.get("password") is not None,
+            "viewers": shared.get("viewers", 0),
+            "control": shared.get("control_allowed", True),
+            "has_password": shared.get("password") is not None,
+            "reconnecting": not shared.get("host"),
         }
     return {"online": False}
 
@@ -84,7 +1198,7 @@ async def download_host():
     exe_path = "OrbDesk_Host.exe"
     if not os.path.exists(exe_path):
         exe_path = os.path.join("dist", "OrbDesk_Host.exe")
-    
+
     if os.path.exists(exe_path):
         return FileResponse(
             exe_path,
@@ -110,115 +1224,603 @@ async def download_host():
 # File Upload API (OrbDrop)
 # ═══════════════════════════════════════════════════════
 
+# Индекс файлов сессий: code -> {file_id: запись}. Заполняется при загрузке;
+# файл, загруженный через другой воркер, подхватывается с диска при первом запросе.
+file_index: dict = {}
+sweeper_task = None
+
+
+def index_file(code, file_id, path, filename, size, sha256=None, created=None):
+    entry = {
+        "path": path,
+        "filename": filename,
+        "size": size,
+        "mime": mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        "sha256": sha256,
+        "created": created or time.time(),
+    }
+    file_index.setdefault(code, {})[file_id] = entry
+    ensure_sweeper()
+    return entry
+
+
+def valid_code(code):
+    """Код сессии идёт в путь на диске — пускаем только CODE_DIGITS цифр."""
+    return len(code) == CODE_DIGITS and code.isascii() and code.isdigit()
+
+
+def inside_uploads(path):
+    """Путь после разворачивания «..» и ссылок всё ещё лежит в UPLOAD_DIR."""
+    root = os.path.realpath(UPLOAD_DIR)
+    return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+
+def find_file(code, file_id):
+    """Запись индекса; при промахе — один проход по папке сессии."""
+    if not valid_code(code):
+        return None
+    entry = file_index.get(code, {}).get(file_id)
+    if entry or not file_id.isalnum():
+        return entry
+    save_dir = os.path.join(UPLOAD_DIR, code)
+    try:
+        names = os.listdir(save_dir)
+    except OSError:
+        return None
+    for fname in names:
+        if fname.startswith(file_id + "_"):
+            path = os.path.join(save_dir, fname)
+            st = os.stat(path)
+            return index_file(code, file_id, path, fname[len(file_id) + 1:],
+                              st.st_size, created=st.st_mtime)
+    return None
+
+
+def sweep_dir(save_dir, now):
+    """Брошенные докачки старше TTL: [(upload_id, size)] удалённых."""
+    removed = []
+    try:
+        names = os.listdir(save_dir)
+    except OSError:
+        return removed
+    for fname in names:
+        if not (fname.startswith(".") and fname.endswith(".json")):
+            continue
+        meta_path = os.path.join(save_dir, fname)
+        try:
+            meta = read_json(meta_path)
+        except (OSError, ValueError):
+            continue
+        if now - meta.get("created", now) > UPLOAD_TTL:
+            upload_id = fname[1:-5]
+            remove_files(meta_path, os.path.join(save_dir, f".{upload_id}.part"))
+            removed.append((upload_id, meta.get("size", 0)))
+    return removed
+
+
+async def release_quota(code, n):
+    """Возвращает место в квоте. Записи ушедшей сессии уже нет — не заводим её."""
+    if n and await backend.get(code):
+        await backend.incr(code, "upload_bytes", -n)
+
+
+async def evict(code, file_id):
+    entry = file_index.get(code, {}).pop(file_id, None)
+    if entry:
+        await asyncio.to_thread(remove_files, entry["path"])
+        await release_quota(code, entry["size"])
+
+
+async def sweep_uploads():
+    """Фоновая чистка: файлы старше UPLOAD_TTL и сверх UPLOAD_DISK_BUDGET."""
+    while True:
+        await asyncio.sleep(UPLOAD_SWEEP_INTERVAL)
+        try:
+            await sweep_once(time.time())
+        except Exception as e:
+            print(f"[Hub] Upload sweep error: {e}")
+
+
+async def sweep_once(now):
+    """Один проход чистильщика. Брошенная докачка лежит и в папке сессии,
+    у которой в индексе нет ни одного готового файла, — обходим все папки."""
+    codes = set(file_index)
+    codes.update(c for c in await asyncio.to_thread(os.listdir, UPLOAD_DIR) if valid_code(c))
+    for code in codes:
+        for file_id, entry in list(file_index.get(code, {}).items()):
+            if now - entry["created"] > UPLOAD_TTL:
+                await evict(code, file_id)
+        for upload_id, size in await asyncio.to_thread(
+                sweep_dir, os.path.join(UPLOAD_DIR, code), now):
+            await release_quota(code, size)
+        if not file_index.get(code):
+            file_index.pop(code, None)
+
+    # Бюджет диска — выселяем самые старые файлы
+    files = [(e["created"], code, file_id, e["size"])
+             for code, entries in file_index.items()
+             for file_id, e in entries.items()]
+    total = sum(f[3] for f in files)
+    for created, code, file_id, size in sorted(files):
+        if total <= UPLOAD_DISK_BUDGET:
+            break
+        await evict(code, file_id)
+        total -= size
+
+
+def ensure_sweeper():
+    global sweeper_task
+    if sweeper_task is None or sweeper_task.done():
+        sweeper_task = asyncio.ensure_future(sweep_uploads())
+
+
+def upload_paths(code, upload_id):
+    """Пути недокачанного файла и его описания в папке сессии."""
+    save_dir = os.path.join(UPLOAD_DIR, code)
+    return (os.path.join(save_dir, f".{upload_id}.part"),
+            os.path.join(save_dir, f".{upload_id}.json"))
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+def write_bytes(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def write_hashed(f, h, data):
+    f.write(data)
+    h.update(data)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(UPLOAD_CHUNK)
+            if not chunk:
+                return h.hexdigest()
+            h.update(chunk)
+
+
+def remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+async def reserve_quota(code, n):
+    """Занимает n байт квоты сессии. False — квота исчерпана."""
+    used = await backend.incr(code, "upload_bytes", n)
+    if used > UPLOAD_MAX_SESSION:
+        await backend.incr(code, "upload_bytes", -n)
+        return False
+    return True
+
+
+async def json_body(request):
+    """Тело запроса, если это JSON-объект, иначе None."""
+    try:
+        body = await request.json()
+    except ValueError:
+        return None
+    return body if isinstance(body, dict) else None
+
+
+async def load_upload(code, upload_id):
+    """Описание загрузки или None, если такой нет."""
+    if not valid_code(code) or not upload_id.isalnum():
+        return None
+    part_path, meta_path = upload_paths(code, upload_id)
+    try:
+        meta = await asyncio.to_thread(read_json, meta_path)
+    except (OSError, ValueError):
+        return None
+    meta["offset"] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    return meta
+
+
+async def file_uploaded(code, file_id, safe_name, path, size, sha256):
+    """Файл целиком на диске — в индекс, аудит и уведомление хоста."""
+    index_file(code, file_id, path, safe_name, size, sha256)
+    size_kb = round(size / 1024, 1)
+    add_audit(code, "file_upload", f"Файл: {safe_name} ({size_kb} KB)")
+    await send_to_host(code, json.dumps({
+        "type": "file_incoming",
+        "file_id": file_id,
+        "filename": safe_name,
+        "size_kb": size_kb,
+    }))
+    return {"file_id": file_id, "filename": safe_name, "size_kb": size_kb}
+
+
 @app.post("/api/upload/{code}")
-async def upload_file(code: str, file: UploadFile = File(...)):
-    s = sessions.get(code)
-    if not s or not s["host"]:
+async def upload_file(code: str, request: Request):
+    """Загрузка одним запросом: пишем на диск кусками, квота по мере записи.
+    Размер сверяем с лимитами по Content-Length до чтения тела — разбирая
+    форму, Starlette складывает файл во временный на диске целиком."""
+    shared = await lookup(code)
+    if not shared:
         return JSONResponse({"error": "Session not found"}, status_code=404)
+    try:
+        length = int(request.headers["content-length"])
+    except (KeyError, ValueError):
+        return JSONResponse({"error": "Content-Length required"}, status_code=411)
+    if length > UPLOAD_MAX_FILE + UPLOAD_FORM_OVERHEAD:
+        return JSONResponse({"error": "File too large", "limit": UPLOAD_MAX_FILE},
+                            status_code=413)
+    if shared.get("upload_bytes", 0) + length > UPLOAD_MAX_SESSION + UPLOAD_FORM_OVERHEAD:
+        return JSONResponse({"error": "Session quota exceeded"}, status_code=413)
+
+    form = await request.form(max_files=1)
+    try:
+        file = form.get("file")
+        if file is None or isinstance(file, str):
+            return JSONResponse({"error": "No file"}, status_code=400)
+        return await save_upload(code, file)
+    finally:
+        await form.close()
 
+
+async def save_upload(code, file):
     file_id = str(uuid.uuid4())[:8]
     safe_name = os.path.basename(file.filename or "file")
     save_dir = os.path.join(UPLOAD_DIR, code)
     os.makedirs(save_dir, exist_ok=True)
     save_path = os.path.join(save_dir, f"{file_id}_{safe_name}")
 
-    with open(save_path, "wb") as f:
-        content = await file.read()
-        f.write(content)
+    size = 0
+    error = None
+    h = hashlib.sha256()
+    f = await asyncio.to_thread(open, save_path, "wb")
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK)
+            if not chunk:
+                break
+            if size + len(chunk) > UPLOAD_MAX_FILE:
+                error = "File too large"
+                break
+            if not await reserve_quota(code, len(chunk)):
+                error = "Session quota exceeded"
+                break
+            size += len(chunk)
+            count_upload(code, len(chunk))
+            await asyncio.to_thread(write_hashed, f, h, chunk)
+    finally:
+        await asyncio.to_thread(f.close)
 
-    size_kb = len(content) / 1024
+    if error:
+        await backend.incr(code, "upload_bytes", -size)
+        await asyncio.to_thread(remove_files, save_path)
+        return JSONResponse({"error": error}, status_code=413)
 
-    # Аудит
-    add_audit(s, "file_upload", f"Файл: {safe_name} ({round(size_kb, 1)} KB)")
+    return await file_uploaded(code, file_id, safe_name, save_path, size, h.hexdigest())
 
-    # Уведомляем хоста о файле
-    try:
-        await s["host"].send_text(json.dumps({
-            "type": "file_incoming",
-            "file_id": file_id,
-            "filename": safe_name,
-            "size_kb": round(size_kb, 1),
-        }))
-    except:
-        pass
 
-    return {"file_id": file_id, "filename": safe_name, "size_kb": round(size_kb, 1)}
+# ─── Докачка: init → PUT кусков по смещению → finalize ───
+
+@app.post("/api/upload/{code}/init")
+async def upload_init(code: str, request: Request):
+    if not await lookup(code):
+        return JSONResponse({"error": "Session not found"}, status_code=404)
+    body = await json_body(request)
+    size = body.get("size", 0) if body is not None else None
+    if isinstance(size, str) and size.isdigit():
+        size = int(size)
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        return JSONResponse({"error": "Bad size"}, status_code=400)
+    filename = body.get("filename") or "file"
+    if not isinstance(filename, str):
+        return JSONResponse({"error": "Bad filename"}, status_code=400)
+    if size > UPLOAD_MAX_FILE:
+        return JSONResponse({"error": "File too large", "limit": UPLOAD_MAX_FILE},
+                            status_code=413)
+    # Квоту занимаем сразу на весь файл, чтобы не упереться в неё на середине
+    if not await reserve_quota(code, size):
+        return JSONResponse({"error": "Session quota exceeded"}, status_code=413)
+
+    upload_id = uuid.uuid4().hex[:8]
+    os.makedirs(os.path.join(UPLOAD_DIR, code), exist_ok=True)
+    ensure_sweeper()  # брошенную докачку и её квоту снимет чистильщик
+    part_path, meta_path = upload_paths(code, upload_id)
+    meta = {
+        "filename": os.path.basename(filename),
+        "size": size,
+        "created": time.time(),
+    }
+    await asyncio.to_thread(write_json, meta_path, meta)
+    await asyncio.to_thread(write_bytes, part_path, b"")
+    return {"upload_id": upload_id, "offset": 0, "part_size": UPLOAD_PART}
+
+
+@app.get("/api/upload/{code}/{upload_id}")
+async def upload_status(code: str, upload_id: str):
+    """Сколько байт уже на хабе — отсюда клиент продолжает после обрыва."""
+    meta = await load_upload(code, upload_id)
+    if not meta:
+        return JSONResponse({"error": "Upload not found"}, status_code=404)
+    return {"upload_id": upload_id, "offset": meta["offset"], "size": meta["size"]}
+
+
+@app.put("/api/upload/{code}/{upload_id}")
+async def upload_part(code: str, upload_id: str, request: Request, offset: int = Query(...)):
+    meta = await load_upload(code, upload_id)
+    if not meta:
+        return JSONResponse({"error": "Upload not found"}, status_code=404)
+    if offset != meta["offset"] or upload_id in active_uploads:
+        # Клиент не в курсе, докуда дошло — пусть спросит и продолжит
+        return JSONResponse({"error": "Offset mismatch", "offset": meta["offset"]},
+                            status_code=409)
+
+    part_path, _ = upload_paths(code, upload_id)
+    expected = request.headers.get("x-chunk-sha256")
+    h = hashlib.sha256() if expected else None
+    written = 0
+    buf = bytearray()
+    error = None
+    active_uploads.add(upload_id)
+    f = await asyncio.to_thread(open, part_path, "ab")
+    try:
+        async for chunk in request.stream():
+            written += len(chunk)
+            count_upload(code, len(chunk))
+            if offset + written > meta["size"]:
+                error = ("Part exceeds declared size", 413)
+                break
+            if h:
+                h.update(chunk)
+            buf += chunk
+            if len(buf) >= UPLOAD_CHUNK:
+                await asyncio.to_thread(f.write, bytes(buf))
+                buf.clear()
+        if not error and h and h.hexdigest() != expected.lower():
+            error = ("Chunk checksum mismatch", 400)
+        if not error and buf:
+            await asyncio.to_thread(f.write, bytes(buf))
+    except ClientDisconnect:
+        error = ("Upload interrupted", 400)
+    finally:
+        # Обрыв или битый кусок — откатываемся к началу куска
+        if error:
+            await asyncio.to_thread(f.truncate, offset)
+        await asyncio.to_thread(f.close)
+        active_uploads.discard(upload_id)
+
+    if error:
+        return JSONResponse({"error": error[0], "offset": offset}, status_code=error[1])
+    return {"upload_id": upload_id, "offset": offset + written}
+
+
+@app.post("/api/upload/{code}/{upload_id}/finalize")
+async def upload_finalize(code: str, upload_id: str, request: Request):
+    meta = await load_upload(code, upload_id)
+    if not meta:
+        return JSONResponse({"error": "Upload not found"}, status_code=404)
+    if meta["offset"] != meta["size"] or upload_id in active_uploads:
+        return JSONResponse({"error": "Upload incomplete", "offset": meta["offset"]},
+                            status_code=409)
+
+    body = await json_body(request)
+    if body is None:
+        return JSONResponse({"error": "Bad request"}, status_code=400)
+    part_path, meta_path = upload_paths(code, upload_id)
+    digest = await asyncio.to_thread(file_sha256, part_path)
+    expected = str(body.get("sha256") or "").lower()
+    if expected and expected != digest:
+        await asyncio.to_thread(remove_files, part_path, meta_path)
+        await backend.incr(code, "upload_bytes", -meta["size"])
+        return JSONResponse({"error": "Checksum mismatch", "sha256": digest},
+                            status_code=422)
+
+    safe_name = meta["filename"]
+    save_path = os.path.join(UPLOAD_DIR, code, f"{upload_id}_{safe_name}")
+    await asyncio.to_thread(os.replace, part_path, save_path)
+    await asyncio.to_thread(remove_files, meta_path)
+    result = await file_uploaded(code, upload_id, safe_name, save_path, meta["size"], digest)
+    result["sha256"] = digest
+    return result
+
+
+@app.delete("/api/upload/{code}/{upload_id}")
+async def upload_cancel(code: str, upload_id: str):
+    meta = await load_upload(code, upload_id)
+    if not meta or upload_id in active_uploads:
+        return JSONResponse({"error": "Upload not found"}, status_code=404)
+    await asyncio.to_thread(remove_files, *upload_paths(code, upload_id))
+    await backend.incr(code, "upload_bytes", -meta["size"])
+    return {"cancelled": True}
 
 @app.get("/api/download_file/{code}/{file_id}")
 async def download_file(code: str, file_id: str):
-    save_dir = os.path.join(UPLOAD_DIR, code)
-    if not os.path.exists(save_dir):
-        return JSONResponse({"error": "Not found"}, status_code=404)
-    for fname in os.listdir(save_dir):
-        if fname.startswith(file_id):
-            return FileResponse(
-                os.path.join(save_dir, fname),
-                filename=fname[len(file_id) + 1:],
-            )
-    return JSONResponse({"error": "File not found"}, status_code=404)
+    """Отдаёт файл из индекса. Range поддерживает FileResponse, а на серверах
+    с расширением pathsend файл уходит без копирования через процесс."""
+    if not valid_code(code) or not await lookup(code):
+        return JSONResponse({"error": "File not found"}, status_code=404)
+    entry = find_file(code, file_id)
+    if not entry or not inside_uploads(entry["path"]):
+        return JSONResponse({"error": "File not found"}, status_code=404)
+    try:
+        st = os.stat(entry["path"])
+    except OSError:
+        file_index.get(code, {}).pop(file_id, None)
+        return JSONResponse({"error": "File not found"}, status_code=404)
+    headers = {"X-Content-SHA256": entry["sha256"]} if entry["sha256"] else None
+    return FileResponse(
+        entry["path"],
+        stat_result=st,
+        media_type=entry["mime"],
+        filename=entry["filename"],
+        headers=headers,
+    )
 
 
 # ═══════════════════════════════════════════════════════
 # Dashboard API
 # ═══════════════════════════════════════════════════════
 
+# Поля system_metrics, которые хранятся рядами
+METRIC_FIELDS = ("cpu", "ram", "proc_cpu", "net_in", "net_out", "fps", "capture_ms", "send_ms")
+# (шаг в секундах, точек) — 10 мин посекундно, час по 10 с, 6 часов поминутно
+METRIC_TIERS = ((1, 600), (10, 360), (60, 360))
+
+
+class MetricsTier:
+    """Кольцевой буфер одного разрешения на заранее выделенных массивах.
+
+    Точки, попавшие в один интервал step, усредняются; интервал
+    записывается в кольцо, когда приходит точка из следующего.
+    """
+
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+        self.t = array("d", bytes(8 * size))
+        self.cols = [array("f", bytes(4 * size)) for _ in METRIC_FIELDS]
+        self.head = 0            # куда пишем следующую точку
+        self.count = 0
+        self.bucket = None       # начало текущего интервала
+        self.sums = [0.0] * len(METRIC_FIELDS)
+        self.hits = [0] * len(METRIC_FIELDS)
+
+    def add(self, t, values):
+        bucket = t - t % self.step
+        if bucket != self.bucket:
+            self.commit()
+            self.bucket = bucket
+        for i, v in enumerate(values):
+            if v is not None:
+                self.sums[i] += v
+                self.hits[i] += 1
+
+    def commit(self):
+        if self.bucket is None:
+            return
+        i = self.head
+        self.t[i] = self.bucket
+        for col, total, n, k in zip(self.cols, self.sums, self.hits, range(len(self.sums))):
+            col[i] = total / n if n else math.nan
+            self.sums[k] = 0.0
+            self.hits[k] = 0
+        self.head = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.bucket = None
+
+    def since(self, after):
+        """Точки новее after — столбцами, от старых к новым."""
+        start = self.head - self.count
+        idx = [(start + k) % self.size for k in range(self.count)]
+        idx = [i for i in idx if self.t[i] > after]
+        return {
+            "t": [self.t[i] for i in idx],
+            **{
+                name: [None if math.isnan(col[i]) else round(col[i], 2) for i in idx]
+                for name, col in zip(METRIC_FIELDS, self.cols)
+            },
+        }
+
+
+class MetricsStore:
+    """Метрики хоста сессии: один поток точек, несколько разрешений."""
+
+    def __init__(self):
+        self.tiers = {step: MetricsTier(step, size) for step, size in METRIC_TIERS}
+
+    def add(self, msg, t=None):
+        t = int(time.time() if t is None else t)
+        values = [msg.get(name) for name in METRIC_FIELDS]
+        values = [v if isinstance(v, (int, float)) else None for v in values]
+        for tier in self.tiers.values():
+            tier.add(t, values)
+
+    def query(self, since=0.0, resolution=1):
+        # Самый мелкий шаг, не меньше запрошенного
+        step = min((st for st in self.tiers if st >= resolution), default=max(self.tiers))
+        return {"resolution": step, **self.tiers[step].since(since)}
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for tier in self.tiers.values() for a in (tier.t, *tier.cols))
+
+
 @app.get("/api/dashboard")
 async def dashboard_info(code: str = Query("")):
-    s = sessions.get(code)
-    if not s or not s["host"]:
+    shared = await lookup(code)
+    if not shared:
         return JSONResponse({"error": "Session not found"}, status_code=404)
+    s = sessions.get(code)
     return {
         "code": code,
-        "viewers": len(s["viewers"]),
-        "control_allowed": s["control_allowed"],
-        "has_password": s.get("password") is not None,
-        "monitors": s.get("monitors", []),
-        "last_metrics": s.get("last_metrics"),
+        "viewers": shared.get("viewers", 0),
+        "control_allowed": shared.get("control_allowed", True),
+        "has_password": shared.get("password") is not None,
+        "monitors": shared.get("monitors") or [],
+        "last_metrics": shared.get("last_metrics"),
+        "abr_state": shared.get("abr_state"),
+        "stage_timing": shared.get("stage_timing"),
+        "memory": s.memory() if s else None,
+        # Очереди отправки — только зрители этого воркера
+        "viewer_stats": [
+            {"name": s.viewer_meta.get(ws, {}).get("name", "Viewer"), **sender.stats()}
+            for ws, sender in s.senders.items()
+        ] if s else [],
     }
 
+@app.get("/metrics")
+async def prometheus_metrics(request: Request):
+    """Счётчики воркера для Prometheus. При нескольких воркерах каждый
+    отдаёт свои (метка worker) — суммирует уже Prometheus.
+    Ряды по сессиям — только с заголовком Authorization: Bearer METRICS_TOKEN."""
+    per_session = bool(METRICS_TOKEN) and \
+        request.headers.get("authorization") == f"Bearer {METRICS_TOKEN}"
+    return PlainTextResponse(render_metrics(per_session), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/api/dashboard/metrics")
-async def dashboard_metrics(code: str = Query("")):
-    s = sessions.get(code)
-    if not s or not s["host"]:
+async def dashboard_metrics(code: str = Query(""), since: float = Query(0.0), resolution: int = Query(1)):
+    """Ряды метрик хоста. since — отметка последней полученной точки:
+    приходят только более новые; resolution — шаг в секундах (1, 10, 60)."""
+    if not await lookup(code):
         return JSONResponse({"error": "Not found"}, status_code=404)
-    return {"metrics": s.get("metrics_history", [])}
+    s = sessions.get(code)
+    if not s or s.metrics is None:
+        return {"resolution": resolution, "t": [], **{name: [] for name in METRIC_FIELDS}}
+    return s.metrics.query(since, resolution)
 
 @app.post("/api/dashboard/toggle_control")
 async def dashboard_toggle(request: Request):
     body = await request.json()
     code = body.get("code", "")
-    s = sessions.get(code)
-    if not s or not s["host"]:
+    shared = await lookup(code)
+    if not shared:
         return JSONResponse({"error": "Not found"}, status_code=404)
 
-    s["control_allowed"] = not s["control_allowed"]
-    allowed = s["control_allowed"]
-    for v in s["viewers"]:
-        try:
-            await v.send_text(json.dumps({
-                "type": "control_status", "allowed": allowed
-            }))
-        except: pass
-    try:
-        await s["host"].send_text(json.dumps({
-            "type": "control_toggled", "allowed": allowed
-        }))
-    except: pass
+    allowed = not shared.get("control_allowed", True)
+    await share(code, control_allowed=allowed)
+    broadcast(code, json.dumps({
+        "type": "control_status", "allowed": allowed
+    }))
+    await send_to_host(code, json.dumps({
+        "type": "control_toggled", "allowed": allowed
+    }))
     return {"allowed": allowed}
 
 @app.post("/api/dashboard/kick")
 async def dashboard_kick(request: Request):
     body = await request.json()
     code = body.get("code", "")
-    s = sessions.get(code)
-    if not s:
+    if not sessions.get(code) and not await backend.get(code):
         return JSONResponse({"error": "Not found"}, status_code=404)
-    for v in list(s["viewers"]):
-        try:
-            await v.close(code=4020, reason="Kicked")
-        except: pass
-    s["viewers"].clear()
-    s["viewer_meta"].clear()
+    await kick_all(code)
     return {"kicked": True}
 
 
@@ -226,22 +1828,553 @@ async def dashboard_kick(request: Request):
 # Audit Log Helper
 # ═══════════════════════════════════════════════════════
 
-def add_audit(session, event_type, detail=""):
-    entry = {
+class AuditLog:
+    """Аудит сессий: очередь в памяти, запись на диск пачками.
+
+    add() только кладёт событие в очереди и ничего не ждёт — ретрансляция
+    кадров от аудита не тормозит. Раз в AUDIT_TICK накопленное по сессии
+    уходит зрителям одним audit_batch и одной командой в реестр; раз в
+    AUDIT_FLUSH_INTERVAL — одной транзакцией в SQLite (WAL) в отдельном
+    потоке. Журнал переживает сессию и читается через /api/audit.
+    Старше AUDIT_RETENTION события удаляет тот же писатель, раз в
+    AUDIT_PRUNE_INTERVAL; close() при остановке дописывает остаток.
+    """
+
+    def __init__(self, path=AUDIT_DB):
+        self.path = path
+        self.pending = deque()   # (code, entry) — ещё не на диске
+        self.outbox = {}         # code -> [entry] — ещё не разосланы
+        self.dropped = 0
+        self.ready = False
+        self.closing = False
+        self.task = None
+        self.db = None           # соединение писателя, только из его потока
+        self.pruned = None       # monotonic последней чистки
+
+    def add(self, code, entry):
+        if len(self.pending) >= AUDIT_QUEUE_LIMIT:
+            self.pending.popleft()
+            self.dropped += 1
+        self.pending.append((code, entry))
+        self.outbox.setdefault(code, []).append(entry)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        flushed = time.monotonic()
+        while self.outbox or self.pending:
+            await asyncio.sleep(AUDIT_TICK)
+            outbox, self.outbox = self.outbox, {}
+            for code, entries in outbox.items():
+                broadcast(code, json.dumps({"type": "audit_batch", "events": entries}))
+                asyncio.ensure_future(backend.push_audit(code, entries))
+            if self.pending and (self.closing or
+                                 time.monotonic() - flushed >= AUDIT_FLUSH_INTERVAL):
+                batch = list(self.pending)
+                self.pending.clear()
+                flushed = time.monotonic()
+                try:
+                    await asyncio.to_thread(self._write, batch)
+                except Exception as e:
+                    print(f"[Hub] Audit write error: {e}")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        if not self.ready:
+            db.execute("CREATE TABLE IF NOT EXISTS audit (id INTEGER PRIMARY KEY,"
+                       " code TEXT NOT NULL, time REAL NOT NULL, type TEXT NOT NULL, detail TEXT)")
+            db.execute("CREATE INDEX IF NOT EXISTS audit_code_time ON audit (code, time)")
+            db.commit()
+            self.ready = True
+        return db
+
+    def _write(self, batch):
+        if self.db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.db = self._connect()
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO audit (code, time, type, detail) VALUES (?, ?, ?, ?)",
+                [(code, e["time"], e["type"], e["detail"]) for code, e in batch])
+        now = time.monotonic()
+        if self.pruned is None or now - self.pruned >= AUDIT_PRUNE_INTERVAL:
+            self.pruned = now
+            with self.db:
+                self.db.execute("DELETE FROM audit WHERE time < ?",
+                                (time.time() - AUDIT_RETENTION,))
+
+    async def close(self):
+        """Остановка сервера: дожидаемся записи всего, что ещё в очереди."""
+        self.closing = True
+        if self.task is not None and not self.task.done():
+            await self.task
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def query(self, code, since, until, after, limit):
+        """События сессии по времени, страницами: after — id последнего
+        полученного события. Из потока, своим соединением."""
+        if not os.path.exists(self.path):
+            return []
+        db = self._connect()
+        try:
+            rows = db.execute(
+                "SELECT id, time, type, detail FROM audit WHERE code = ? AND time >= ?"
+                " AND time < ? AND id > ? ORDER BY id LIMIT ?",
+                (code, since, until, after, limit)).fetchall()
+        finally:
+            db.close()
+        return [{"id": i, "time": t, "type": kind, "detail": detail} for i, t, kind, detail in rows]
+
+
+audit_log = AuditLog()
+
+
+def add_audit(code, event_type, detail=""):
+    audit_log.add(code, {
         "type": event_type,
         "detail": detail,
         "time": time.time(),
-    }
-    session["audit_log"].append(entry)
-    if len(session["audit_log"]) > 200:
-        session["audit_log"] = session["audit_log"][-100:]
-    # Рассылаем всем зрителям
-    msg = json.dumps({"type": "audit_event", **entry})
-    for v in session["viewers"]:
-        try:
-            asyncio.ensure_future(v.send_text(msg))
-        except:
-            pass
+    })
+
+
+@app.get("/api/audit")
+async def audit_query(request: Request, code: str = Query(""), since: float = Query(0.0),
+                      until: float = Query(0.0), after: int = Query(0), limit: int = Query(100)):
+    """Журнал аудита сессии: время [since, until), по limit событий; next —
+    что передать в after за следующей страницей (null — больше нет).
+    Без токена — только текущая сессия с хостом онлайн и только с её начала:
+    коды переиспользуются, прошлые владельцы кода чужие."""
+    admin = bool(METRICS_TOKEN) and \
+        request.headers.get("authorization") == f"Bearer {METRICS_TOKEN}"
+    if not admin:
+        shared = await lookup(code)
+        if not shared:
+            return JSONResponse({"error": "Session not found"}, status_code=404)
+        since = max(since, shared.get("started") or 0)
+    limit = max(1, min(limit, AUDIT_PAGE_MAX))
+    events = await asyncio.to_thread(audit_log.query, code, since, until or time.time() + 1,
+                                     after, limit)
+    return {"events": events, "next": events[-1]["id"] if len(events) == limit else None}
+
+
+# ═══════════════════════════════════════════════════════
+# Доска для рисования
+# ═══════════════════════════════════════════════════════
+
+SHAPE_KEYS = ("tool", "x1", "y1", "x2", "y2", "x", "y", "text", "color", "size")
+
+
+class Whiteboard:
+    """Фигуры доски в порядке рисования.
+
+    Отрезок пера, который продолжает последнюю ломаную того же автора
+    (тот же цвет и толщина, начало в её конце), дописывается в неё —
+    так сотни draw от росчерка хранятся и уходят одной фигурой.
+    Больше max_points координат не держим: вытесняются старые фигуры.
+    Длинная ломаная режется на куски по segment координат, иначе
+    один бесконечный росчерк было бы нечем вытеснять.
+    """
+
+    def __init__(self, shapes=(), max_points=BOARD_MAX_POINTS):
+        self.shapes = deque()
+        self.open = {}           # автор -> его последняя ломаная
+        self.points = 0
+        self.max_points = max_points
+        self.segment = max(4, max_points // 8)
+        self.dirty = False
+        for shape in shapes:
+            self.add(None, shape)
+
+    @staticmethod
+    def weight(shape):
+        return len(shape.get("points", ())) or 4 + len(shape.get("text", "")) // 8
+
+    def add(self, author, op):
+        """op — draw от зрителя или фигура из draw_batch (перо с points)."""
+        self.dirty = True
+        if op.get("tool", "pen") == "pen":
+            pts = op.get("points") or [op.get(k, 0) for k in ("x1", "y1", "x2", "y2")]
+            pts = [round(v, 4) for v in pts]
+            if len(pts) > self.max_points:
+                pts = pts[len(pts) - self.max_points + self.max_points % 2:]
+            line = self.open.get(author)
+            if (line is not None and line["color"] == op.get("color")
+                    and line["size"] == op.get("size") and line["points"][-2:] == pts[:2]
+                    and len(line["points"]) < self.segment):
+                line["points"] += pts[2:]
+                self.points += len(pts) - 2
+            else:
+                line = {"tool": "pen", "color": op.get("color"), "size": op.get("size"), "points": pts}
+                self.open[author] = line
+                self.shapes.append(line)
+                self.points += len(pts)
+        else:
+            shape = {k: op[k] for k in SHAPE_KEYS if k in op}
+            self.open.pop(author, None)
+            self.shapes.append(shape)
+            self.points += self.weight(shape)
+        while self.points > self.max_points and len(self.shapes) > 1:
+            old = self.shapes.popleft()
+            self.points -= self.weight(old)
+            self.open = {a: line for a, line in self.open.items() if line is not old}
+
+    def clear(self):
+        self.shapes.clear()
+        self.open.clear()
+        self.points = 0
+        self.dirty = True
+
+    def snapshot(self):
+        return list(self.shapes)
+
+
+def apply_board(s, msg):
+    """draw_batch / draw_clear с другого воркера — в локальную доску."""
+    if msg.get("type") == "draw_clear":
+        s.board.clear()
+    else:
+        for shape in msg.get("shapes", ()):
+            s.board.add(msg.get("by"), shape)
+
+
+def flush_board(s):
+    """Рассылает накопленные штрихи: по сообщению на автора, без него самого."""
+    pending, s.board_pending = s.board_pending, {}
+    for author, (ws, batch) in pending.items():
+        text = json.dumps({"type": "draw_batch", "by": author, "shapes": batch.snapshot()})
+        deliver(s, text, exclude=ws)
+        bus_send(s.code, "v", b"W", text.encode())
+
+
+async def sync_board(s):
+    """Снимок доски в реестр — его получит зеркало сессии на другом воркере.
+    Пишет только воркер хоста: через шину к нему приходят все штрихи."""
+    board = s.board
+    if not (backend.distributed and s.host and board.dirty):
+        return
+    board.dirty = False
+    s.board_synced = time.monotonic()
+    await backend.update(s.code, {"board": board.snapshot()})
+
+
+async def board_ticker(s):
+    """Раз в BOARD_TICK — пачка штрихов; пустой тик останавливает задачу."""
+    try:
+        while True:
+            await asyncio.sleep(BOARD_TICK)
+            if not s.board_pending:
+                break
+            flush_board(s)
+            if time.monotonic() - s.board_synced >= BOARD_SYNC_INTERVAL:
+                await sync_board(s)
+        await sync_board(s)
+    finally:
+        s.board_task = None
+
+
+# ═══════════════════════════════════════════════════════
+# Маршрутизация текстовых сообщений
+# ═══════════════════════════════════════════════════════
+
+TO_HOST, TO_VIEWERS, TO_OTHERS = 1, 2, 4   # TO_OTHERS — все зрители, кроме отправителя
+
+
+class Route:
+    """Как хаб обращается с сообщением одного типа.
+
+    to — куда отправить; permission — поле сессии, без которого сообщение
+    отбрасывается; handler(s, ws, msg) — побочные эффекты на хабе.
+    passthrough: дальше уходит исходный текст без повторного json.dumps,
+    иначе — строка, которую вернул handler (None — никуда).
+    """
+
+    def __init__(self, to=0, handler=None, passthrough=True, permission=None):
+        self.to = to
+        self.handler = handler
+        self.passthrough = passthrough
+        self.permission = permission
+
+
+async def route(routes, s, ws, text):
+    msg = json.loads(text)
+    kind = msg.get("type")
+    if kind is None:
+        kind = msg.get("action", "")
+    elif "action" in msg:
+        # Ввод — только сообщение без type: хост исполнил бы action из
+        # любого другого, в обход прав, проверенных здесь по type
+        s.stats.text("other")
+        return
+    s.stats.text(kind if kind in routes else "other")
+    r = routes.get(kind)
+    if r is None or (r.permission and not getattr(s, r.permission)):
+        return
+    out = text
+    if r.handler:
+        result = await r.handler(s, ws, msg)
+        if not r.passthrough:
+            out = result
+    if out is None:
+        return
+    if r.to & TO_HOST:
+        await send_to_host(s.code, out)
+    if r.to & (TO_VIEWERS | TO_OTHERS):
+        broadcast(s.code, out, exclude=ws if r.to & TO_OTHERS else None)
+
+
+def add_chat(s, msg):
+    s.chat_history.append(msg)
+    if len(s.chat_history) > 100:
+        s.chat_history = s.chat_history[-50:]
+
+
+# ─── От хоста ───
+
+async def host_control_toggle(s, ws, msg):
+    await share(s.code, control_allowed=msg["allowed"])
+    add_audit(s.code, "control_toggle", "Разрешено" if msg["allowed"] else "Запрещено")
+    return json.dumps({"type": "control_status", "allowed": msg["allowed"]})
+
+
+async def host_kick(s, ws, msg):
+    add_audit(s.code, "kick", "Все зрители выгнаны")
+    await kick_all(s.code)
+
+
+async def host_set_password(s, ws, msg):
+    await share(s.code, password=msg.get("password"))
+
+
+async def host_monitor_list(s, ws, msg):
+    await share(s.code, monitors=msg.get("monitors", []))
+
+
+async def host_chat(s, ws, msg):
+    msg["from"] = "host"
+    add_chat(s, msg)
+    return json.dumps(msg)
+
+
+async def host_metrics(s, ws, msg):
+    await share(s.code, last_metrics=msg)
+    if s.metrics is None:
+        s.metrics = MetricsStore()
+    s.metrics.add(msg)
+
+
+async def host_stage_timing(s, ws, msg):
+    # p50/p95/p99 стадий кадра на хосте — для дашборда
+    await share(s.code, stage_timing=msg["stages"])
+
+
+async def host_abr_state(s, ws, msg):
+    # Решения адаптивного битрейта хоста
+    await share(s.code, abr_state=msg)
+
+
+async def host_privacy_shield(s, ws, msg):
+    if msg.get("enabled"):
+        s.keyframes.clear()  # закрытый экран не должен достаться новому зрителю
+    await share(s.code, privacy_shield=msg.get("enabled", False))
+    if not msg.get("enabled"):
+        watched = set()
+        for sender in s.senders.values():
+            sender.need_keyframe = set(sender.monitors)
+            watched |= {(m, sender.layer) for m in sender.monitors}
+        for m, layer in watched:
+            request_keyframe(s, m, layer, force=True)
+    add_audit(s.code, "privacy_shield", "Включён" if msg.get("enabled") else "Выключен")
+
+
+HOST_ROUTES = {
+    "control_toggle":    Route(TO_VIEWERS, host_control_toggle, passthrough=False),
+    "kick":              Route(0, host_kick),
+    "set_password":      Route(0, host_set_password),
+    "monitor_list":      Route(TO_VIEWERS, host_monitor_list),
+    "chat":              Route(TO_VIEWERS, host_chat, passthrough=False),
+    "clipboard_sync":    Route(TO_VIEWERS),
+    "system_metrics":    Route(0, host_metrics),
+    "abr_state":         Route(TO_VIEWERS, host_abr_state),
+    "stage_timing":      Route(0, host_stage_timing),
+    "screenshot_result": Route(TO_VIEWERS),
+    "privacy_shield":    Route(TO_VIEWERS, host_privacy_shield),
+    "process_list":      Route(TO_VIEWERS),      # Task Manager Pro
+    "browse_result":     Route(TO_VIEWERS),      # OrbExplorer
+}
+
+
+# ─── От зрителя ───
+
+async def viewer_chat(s, ws, msg):
+    msg["from"] = "viewer"
+    msg["viewer_name"] = s.viewer_meta[ws]["name"]
+    add_chat(s, msg)
+    return json.dumps(msg)
+
+
+async def viewer_cursor(s, ws, msg):
+    # Ghost Cursors: запоминаем последнюю позицию, рассылает cursor_ticker
+    meta = s.viewer_meta.get(ws)
+    if not meta:
+        return
+    s.cursors[meta["id"]] = [round(msg.get("x", 0), 4), round(msg.get("y", 0), 4)]
+    if s.cursor_task is None:
+        s.cursor_task = asyncio.ensure_future(cursor_ticker(s))
+
+
+async def cursor_ticker(s):
+    """Раз в CURSOR_TICK — одна пачка cursor_batch с курсорами, которые сдвинулись.
+
+    Имя и цвет ушли зрителям один раз при входе (cursor_meta). Тик без
+    движения останавливает задачу, следующий cursor_pos запустит её снова.
+    """
+    try:
+        while True:
+            await asyncio.sleep(CURSOR_TICK)
+            if not s.cursors:
+                break
+            batch = [[vid, x, y] for vid, (x, y) in s.cursors.items()]
+            s.cursors.clear()
+            broadcast(s.code, json.dumps({"type": "cursor_batch", "cursors": batch}))
+    finally:
+        s.cursor_task = None
+
+
+async def viewer_draw(s, ws, msg):
+    # Штрих — в доску сессии и в пачку автора; рассылает board_ticker
+    meta = s.viewer_meta.get(ws)
+    if not meta:
+        return
+    author = meta["id"]
+    s.board.add(author, msg)
+    if author not in s.board_pending:
+        s.board_pending[author] = (ws, Whiteboard())
+    s.board_pending[author][1].add(author, msg)
+    if s.board_task is None:
+        s.board_task = asyncio.ensure_future(board_ticker(s))
+
+
+async def viewer_draw_clear(s, ws, msg):
+    # Сначала дорисовываем то, что было до очистки, потом чистим
+    flush_board(s)
+    s.board.clear()
+    text = json.dumps({"type": "draw_clear"})
+    deliver(s, text, exclude=ws)
+    bus_send(s.code, "v", b"W", text.encode())
+    await sync_board(s)
+
+
+async def subscribe_monitors(s, ws, monitors):
+    """Подписка зрителя: хабу — куда слать кадры, хосту — что захватывать."""
+    sender = s.senders.get(ws)
+    meta = s.viewer_meta.get(ws)
+    if not sender or not meta:
+        return
+    for m in sender.subscribe(monitors):
+        cached = s.keyframes.get((m, sender.layer))
+        if cached is not None:
+            sender.preload(cached, m)
+        request_keyframe(s, m, sender.layer, force=True)
+    # Хост сам собирает объединение подписок всех зрителей
+    await send_to_host(s.code, json.dumps({
+        "type": "monitor_subscriptions", "viewer_id": meta["id"], "monitors": sorted(monitors),
+    }))
+
+
+async def viewer_subscribe(s, ws, msg):
+    monitors = {m for m in msg.get("monitors", ())
+                if isinstance(m, int) and 1 <= m <= MAX_MONITORS}
+    await subscribe_monitors(s, ws, monitors)
+
+
+async def viewer_set_monitor(s, ws, msg):
+    # Старый клиент: переключение монитора — подписка только на него
+    await viewer_subscribe(s, ws, {"monitors": [msg.get("index", PRIMARY_MONITOR)]})
+
+
+async def viewer_recv_stats(s, ws, msg):
+    # Отчёт зрителя о приёме + потери в его очереди на хабе
+    sender = s.senders.get(ws)
+    msg["viewer_id"] = s.viewer_meta[ws]["id"]
+    if sender:
+        msg["dropped"] = sender.dropped
+        msg["queued"] = sender.queue.qsize()
+        msg["layer"] = sender.layer
+    return json.dumps(msg)
+
+
+async def viewer_codec_support(s, ws, msg):
+    # Умеет ли браузер зрителя декодировать H.264: хост включает видеокодек, только если умеют все
+    meta = s.viewer_meta[ws]
+    meta["video"] = bool(msg.get("video"))   # повторим хосту после его переподключения
+    return json.dumps({
+        "type": "codec_support",
+        "viewer_id": meta["id"],
+        "video": meta["video"],
+    })
+
+
+async def viewer_download(s, ws, msg):
+    # transfer_id выбирает зритель; повтор с тем же id и offset — докачка
+    tid = msg.get("transfer_id")
+    if not isinstance(tid, int) or not 0 <= tid < 2 ** 32:
+        return None
+    if s.transfers.get(tid, ws) is not ws:
+        return None
+    s.transfers[tid] = ws
+    return json.dumps({
+        "type": "download_remote_file",
+        "path": msg.get("path", ""),
+        "transfer_id": tid,
+        "offset": max(0, int(msg.get("offset", 0))),
+    })
+
+
+async def viewer_file_control(s, ws, msg):
+    # Кредиты окна и отмена — только от владельца передачи
+    tid = msg.get("transfer_id")
+    if s.transfers.get(tid) is not ws:
+        return None
+    if msg["type"] == "file_cancel":
+        del s.transfers[tid]
+    return json.dumps(msg)
+
+
+async def viewer_kill_process(s, ws, msg):
+    add_audit(s.code, "kill_process", f"PID: {msg.get('pid', '?')}")
+
+
+# Управление (ввод, качество) уходит хосту как есть, если оно разрешено
+VIEWER_CONTROL = Route(TO_HOST, permission="control_allowed")
+VIEWER_ACTIONS = ("move", "click", "dblclick", "scroll", "key", "hotkey", "keydown", "keyup",
+                  "type", "quick_action", "set_quality")
+
+# Только эти типы зритель может слать; остальное хаб отбрасывает. Служебные
+# сообщения хаба хосту (session_resume, request_keyframe, monitor_subscriptions)
+# зритель подделать не может, codec_support хаб пересобирает с его viewer_id
+VIEWER_ROUTES = {
+    **dict.fromkeys(VIEWER_ACTIONS, VIEWER_CONTROL),
+    "chat":                 Route(TO_HOST | TO_OTHERS, viewer_chat, passthrough=False),
+    "draw":                 Route(0, viewer_draw),
+    "draw_clear":           Route(0, viewer_draw_clear),
+    "cursor_pos":           Route(0, viewer_cursor),
+    "subscribe_monitors":   Route(0, viewer_subscribe),
+    "set_monitor":          Route(0, viewer_set_monitor),
+    "clipboard_sync":       Route(TO_HOST),
+    "recv_stats":           Route(TO_HOST, viewer_recv_stats, passthrough=False),
+    "codec_support":        Route(TO_HOST, viewer_codec_support, passthrough=False),
+    "browse_dir":           Route(TO_HOST),  # OrbExplorer
+    "download_remote_file": Route(TO_HOST, viewer_download, passthrough=False),
+    "file_ack":             Route(TO_HOST, viewer_file_control, passthrough=False),
+    "file_cancel":          Route(TO_HOST, viewer_file_control, passthrough=False),
+    "request_processes":    Route(TO_HOST),  # Task Manager Pro
+    "kill_process":         Route(TO_HOST, viewer_kill_process, permission="control_allowed"),
+    "privacy_shield":       Route(TO_HOST),
+}
 
 
 # ═══════════════════════════════════════════════════════
@@ -249,192 +2382,210 @@ def add_audit(session, event_type, detail=""):
 # ═══════════════════════════════════════════════════════
 
 @app.websocket("/ws/host")
-async def ws_host(ws: WebSocket, code: str = Query("")):
-    if not code or len(code) != 6:
+async def ws_host(ws: WebSocket, code: str = Query(""), token: str = Query("")):
+    if not code or len(code) != CODE_DIGITS:
         await ws.close(code=4000, reason="Bad code")
         return
-    if code not in sessions:
-        sessions[code] = {
-            "host": None, "viewers": [], "viewer_meta": {},
-            "control_allowed": True, "password": None,
-            "chat_history": [], "monitors": [],
-            "metrics_history": [], "last_metrics": None,
-            "next_color_idx": 0, "privacy_shield": False,
-            "audit_log": [],
-        }
-    if sessions[code]["host"]:
-        await ws.close(code=4003, reason="Already connected")
+    shared = await backend.get(code)
+    s = sessions.get(code)
+    # Токен возобновления выдаётся хосту при подключении: с ним он вернётся
+    # в ту же сессию, пока она его ждёт, без него код занять нельзя
+    resumable = bool(token) and hmac.compare_digest(
+        token.encode(), ((shared or {}).get("resume") or "").encode())
+    lost = host_lost(shared)
+    if (shared and shared.get("host")) or (s and s.host):
+        # Тот же хост с верным токеном: старый сокет мёртв, хаб просто ещё не заметил
+        stale = s.host if s and s.host and resumable else None
+        if stale is None:
+            await ws.close(code=4003, reason="Already connected")
+            return
+        s.host = None
+        asyncio.ensure_future(close_quiet(stale))
+        lost = time.time()
+    elif lost and not resumable:
+        await ws.close(code=4003, reason="Session reserved")
         return
 
     await ws.accept()
-    sessions[code]["host"] = ws
-    print(f"[Hub] Host ON: {code}")
-    add_audit(sessions[code], "host_connect", "Хост подключился")
+    if s is None or (s.remote and not lost):
+        s = add_session(code)
+    if s.grace_task:
+        s.grace_task.cancel()
+        s.grace_task = None
+    if lost:
+        # Сессия пережила обрыв; если хост пришёл на другой воркер — берём её поля из реестра
+        s.update({k: shared[k] for k in SHARED_FIELDS if k in shared})
+    s.remote = False
+    s.host = ws
+    s.claimed = True
+    fields = {"host": WORKER_ID, "lost_at": None, "resume": secrets.token_urlsafe(16)}
+    if not lost:
+        fields.update(viewers=0, started=time.time(), **{k: getattr(s, k) for k in SHARED_FIELDS})
+    await backend.update(code, fields)
+    await detach_bus(s)
+    await attach_bus(s)
+    try:
+        await ws.send_text(json.dumps({
+            "type": "session_resume", "token": fields["resume"], "grace": HOST_GRACE,
+        }))
+    except: pass
+    if lost:
+        downtime = time.time() - lost
+        s.stats.host_resumes += 1
+        s.stats.host_downtime += downtime
+        print(f"[Hub] Host BACK: {code} after {downtime:.2f}s")
+        add_audit(code, "host_resume", f"Хост вернулся через {downtime:.1f} с")
+        broadcast(code, json.dumps({"type": "host_state", "state": "online"}))
+        bus_send(code, "v", b"R", b"")
+        await resync_host(s)
+        shared = await backend.get(code)
+        await send_to_host(code, json.dumps({
+            "type": "viewer_count", "count": (shared or {}).get("viewers", 0),
+        }))
+    else:
+        print(f"[Hub] Host ON: {code}")
+        add_audit(code, "host_connect", "Хост подключился")
 
     try:
         while True:
             data = await ws.receive()
             if "bytes" in data:
                 frame = data["bytes"]
+                # Куски файлов OrbExplorer — адресно, мимо кадров
+                if frame[:4] == FILE_MAGIC and len(frame) >= FILE_HEADER.size:
+                    if not route_file(s, frame):
+                        bus_send(code, "v", b"D", frame)
+                    continue
                 # Если Privacy Shield активен, не отправляем кадры
-                if sessions[code].get("privacy_shield"):
+                if s.privacy_shield:
                     continue
-                viewers = sessions[code]["viewers"]
-                if viewers:
-                    async def _send(v):
-                        try:
-                            await v.send_bytes(frame)
-                            return True
-                        except:
-                            return False
-                    results = await asyncio.gather(*[_send(v) for v in viewers])
-                    dead = [v for v, ok in zip(viewers, results) if not ok]
-                    for d in dead:
-                        viewers.remove(d)
-                        sessions[code]["viewer_meta"].pop(d, None)
+                s.stats.received(len(frame))
+                # Только кладём в очереди — сокеты зрителей здесь не ждём
+                fan_out(s, frame)
+                bus_send(code, "v", b"F", frame)
 
             elif "text" in data:
-                msg = json.loads(data["text"])
-                t = msg.get("type")
-
-                if t == "control_toggle":
-                    sessions[code]["control_allowed"] = msg["allowed"]
-                    add_audit(sessions[code], "control_toggle",
-                              "Разрешено" if msg["allowed"] else "Запрещено")
-                    for v in sessions[code]["viewers"]:
-                        try:
-                            await v.send_text(json.dumps({
-                                "type": "control_status",
-                                "allowed": msg["allowed"]
-                            }))
-                        except: pass
-
-                elif t == "kick":
-                    add_audit(sessions[code], "kick", "Все зрители выгнаны")
-                    for v in list(sessions[code]["viewers"]):
-                        try:
-                            await v.close(code=4020, reason="Kicked")
-                        except: pass
-                    sessions[code]["viewers"].clear()
-                    sessions[code]["viewer_meta"].clear()
-
-                elif t == "set_password":
-                    sessions[code]["password"] = msg.get("password")
-
-                elif t == "monitor_list":
-                    sessions[code]["monitors"] = msg.get("monitors", [])
-                    for v in sessions[code]["viewers"]:
-                        try:
-                            await v.send_text(json.dumps(msg))
-                        except: pass
-
-                elif t == "chat":
-                    msg["from"] = "host"
-                    sessions[code]["chat_history"].append(msg)
-                    if len(sessions[code]["chat_history"]) > 100:
-                        sessions[code]["chat_history"] = sessions[code]["chat_history"][-50:]
-                    for v in sessions[code]["viewers"]:
-                        try:
-                            await v.send_text(json.dumps(msg))
-                        except: pass
-
-                elif t == "clipboard_sync":
-                    for v in sessions[code]["viewers"]:
-                        try:
-                            await v.send_text(json.dumps(msg))
-                        except: pass
-
-                elif t == "system_metrics":
-                    sessions[code]["last_metrics"] = msg
-                    hist = sessions[code]["metrics_history"]
-                    hist.append(msg)
-                    if len(hist) > 60:
-                        sessions[code]["metrics_history"] = hist[-60:]
-
-                elif t == "screenshot_result":
-                    for v in sessions[code]["viewers"]:
-                        try:
-                            await v.send_text(json.dumps(msg))
-                        except: pass
-
-                elif t == "privacy_shield":
-                    sessions[code]["privacy_shield"] = msg.get("enabled", False)
-                    add_audit(sessions[code], "privacy_shield",
-                              "Включён" if msg.get("enabled") else "Выключен")
-                    for v in sessions[code]["viewers"]:
-                        try:
-                            await v.send_text(json.dumps(msg))
-                        except: pass
-
-                # ═══ Process List (Task Manager Pro) ═══
-                elif t == "process_list":
-                    for v in sessions[code]["viewers"]:
-                        try:
-                            await v.send_text(json.dumps(msg))
-                        except: pass
-
-                # ═══ OrbExplorer: file browser response ═══
-                elif t == "browse_result":
-                    for v in sessions[code]["viewers"]:
-                        try:
-                            await v.send_text(json.dumps(msg))
-                        except: pass
-
-                elif t == "file_chunk":
-                    for v in sessions[code]["viewers"]:
-                        try:
-                            await v.send_text(json.dumps(msg))
-                        except: pass
+                await route(HOST_ROUTES, s, ws, data["text"])
 
     except (WebSocketDisconnect, Exception):
         pass
     finally:
-        if code in sessions:
-            add_audit(sessions[code], "host_disconnect", "Хост отключился")
-            for v in sessions[code]["viewers"]:
-                try:
-                    await v.close(code=4010, reason="Host left")
-                except: pass
-            # Чистим загруженные файлы
-            upload_dir = os.path.join(UPLOAD_DIR, code)
-            if os.path.exists(upload_dir):
-                shutil.rmtree(upload_dir, ignore_errors=True)
-            del sessions[code]
+        # Сокет, который уже сменил вернувшийся хост, сессию не трогает
+        if sessions.get(code) is s and s.host is ws:
+            s.host = None
+            if HOST_GRACE > 0:
+                await hold_session(s)
+            else:
+                add_audit(code, "host_disconnect", "Хост отключился")
+                await end_session(s)
         print(f"[Hub] Host OFF: {code}")
 
 
+async def close_quiet(ws):
+    try:
+        await ws.close(code=4011, reason="Host replaced")
+    except Exception:
+        pass
+
+
+async def hold_session(s):
+    """Хост оборвался: HOST_GRACE секунд сессия ждёт его по токену.
+    Зрители остаются подключёнными и видят «хост переподключается»."""
+    code = s.code
+    add_audit(code, "host_disconnect", "Хост отключился, ждём переподключения")
+    await backend.update(code, {"host": None, "lost_at": time.time()})
+    # Без хоста канал «h» этому воркеру не нужен, зрителям хватит «v»
+    await detach_bus(s)
+    await attach_bus(s)
+    broadcast(code, json.dumps({"type": "host_state", "state": "reconnecting", "grace": HOST_GRACE}))
+    s.grace_task = asyncio.ensure_future(host_grace(s))
+
+
+async def host_grace(s):
+    await asyncio.sleep(HOST_GRACE)
+    s.grace_task = None
+    if sessions.get(s.code) is not s or s.host:
+        return
+    shared = await backend.get(s.code)
+    if shared and shared.get("host"):
+        s.remote = True      # хост вернулся через другой воркер, а R до нас не дошёл
+        return
+    add_audit(s.code, "host_left", f"Хост не вернулся за {HOST_GRACE} с")
+    await end_session(s)
+
+
+async def end_session(s):
+    """Хост ушёл насовсем: закрываем зрителей и убираем сессию с её файлами."""
+    code = s.code
+    viewers = list(s.viewers)
+    clear_viewers(s)
+    for v in viewers:
+        try:
+            await v.close(code=4010, reason="Host left")
+        except: pass
+    bus_send(code, "v", b"X", b"")
+    await detach_bus(s)
+    await backend.delete(code)
+    # Чистим загруженные файлы
+    upload_dir = os.path.join(UPLOAD_DIR, code)
+    if os.path.exists(upload_dir):
+        shutil.rmtree(upload_dir, ignore_errors=True)
+    file_index.pop(code, None)
+    drop_session(s)
+    print(f"[Hub] Session closed: {code}")
+
+
 # ═══════════════════════════════════════════════════════
 # WebSocket: Зритель
 # ═══════════════════════════════════════════════════════
 
 @app.websocket("/ws/viewer")
 async def ws_viewer(ws: WebSocket, code: str = Query(""), password: str = Query(""), name: str = Query("Viewer")):
-    s = sessions.get(code)
-    if not s or not s["host"]:
+    shared = await lookup(code)
+    if not shared:
         await ws.close(code=4001, reason="Offline")
         return
-    if len(s["viewers"]) >= MAX_VIEWERS:
+    if shared.get("viewers", 0) >= MAX_VIEWERS:
         await ws.close(code=4002, reason="Full")
         return
 
-    if s.get("password") and password != s["password"]:
+    if shared.get("password") and password != shared["password"]:
         await ws.close(code=4003, reason="Wrong password")
         return
 
+    cnt = await backend.incr(code, "viewers", 1)
+    if cnt > MAX_VIEWERS:
+        await backend.incr(code, "viewers", -1)
+        await ws.close(code=4002, reason="Full")
+        return
+
+    s = sessions.get(code)
+    if s is None:
+        # Хост на другом воркере — заводим здесь зеркало сессии для зрителей
+        s = add_session(code, remote=True, **{
+            k: shared[k] for k in SHARED_FIELDS if k in shared
+        })
+        s.board = Whiteboard(shared.get("board") or ())
+        await attach_bus(s)
+
     await ws.accept()
-    s["viewers"].append(ws)
+    s.viewers.append(ws)
+    s.senders[ws] = ViewerSender(ws, s.stats)
 
     # Назначаем viewer_id и цвет для Ghost Cursors
     viewer_id = str(uuid.uuid4())[:6]
-    color_idx = s["next_color_idx"] % len(CURSOR_COLORS)
-    s["next_color_idx"] += 1
+    color_idx = s.next_color_idx % len(CURSOR_COLORS)
+    s.next_color_idx += 1
     viewer_color = CURSOR_COLORS[color_idx]
     viewer_name = name[:20] if name else "Viewer"
-    s["viewer_meta"][ws] = {"id": viewer_id, "color": viewer_color, "name": viewer_name}
+    s.viewer_meta[ws] = {"id": viewer_id, "color": viewer_color, "name": viewer_name}
 
-    cnt = len(s["viewers"])
     print(f"[Hub] Viewer+ {code} ({cnt}) id={viewer_id} name={viewer_name}")
-    add_audit(s, "viewer_connect", f"{viewer_name} подключился")
+    add_audit(code, "viewer_connect", f"{viewer_name} подключился")
+
+    # По умолчанию — основной монитор. Первым уходит кадр из кэша хаба,
+    # дальше — свежий полный кадр от хоста: дельты без него не нарисовать
+    await subscribe_monitors(s, ws, {PRIMARY_MONITOR})
 
     # Отправляем viewer_id, цвет и имя новому зрителю
     try:
@@ -446,25 +2597,40 @@ async def ws_viewer(ws: WebSocket, code: str = Query(""), password: str = Query(
         }))
     except: pass
 
+    # Имена и цвета Ghost Cursors: новому — все, остальным — его.
+    # Хранятся в реестре по полю на зрителя, чтобы видеть и соседние воркеры.
+    cursor_meta = {"viewer_id": viewer_id, "color": viewer_color, "name": viewer_name}
+    await backend.update(code, {f"cursor:{viewer_id}": cursor_meta})
+    known = [m for k, m in shared.items() if k.startswith("cursor:") and m]
+    if known:
+        s.senders[ws].push_message(json.dumps({"type": "cursor_meta", "cursors": known}))
+    broadcast(code, json.dumps({"type": "cursor_meta", "cursors": [cursor_meta]}), exclude=ws)
+
+    # Всё, что уже нарисовано на доске, — одним снимком
+    if s.board.shapes:
+        s.senders[ws].push_message(json.dumps({
+            "type": "draw_snapshot", "shapes": s.board.snapshot(),
+        }))
+
     # Отправляем текущий статус контроля
     try:
         await ws.send_text(json.dumps({
             "type": "control_status",
-            "allowed": s["control_allowed"]
+            "allowed": s.control_allowed
         }))
     except: pass
 
     # Отправляем список мониторов
-    if s.get("monitors"):
+    if s.monitors:
         try:
             await ws.send_text(json.dumps({
                 "type": "monitor_list",
-                "monitors": s["monitors"]
+                "monitors": s.monitors
             }))
         except: pass
 
     # Отправляем статус Privacy Shield
-    if s.get("privacy_shield"):
+    if s.privacy_shield:
         try:
             await ws.send_text(json.dumps({
                 "type": "privacy_shield",
@@ -472,136 +2638,41 @@ async def ws_viewer(ws: WebSocket, code: str = Query(""), password: str = Query(
             }))
         except: pass
 
+    # Хост оборвался и ещё может вернуться — зритель ждёт вместе с остальными
+    if not shared.get("host"):
+        try:
+            await ws.send_text(json.dumps({
+                "type": "host_state", "state": "reconnecting", "grace": HOST_GRACE,
+            }))
+        except: pass
+
     # Отправляем историю аудит-лога
-    if s.get("audit_log"):
+    audit_log = await backend.audit_tail(code)
+    if audit_log:
         try:
             await ws.send_text(json.dumps({
                 "type": "audit_history",
-                "events": s["audit_log"][-50:]
+                "events": audit_log
             }))
         except: pass
 
     # Уведомляем хоста о кол-ве зрителей
-    try:
-        await s["host"].send_text(json.dumps({
-            "type": "viewer_count", "count": cnt
-        }))
-    except: pass
+    await send_to_host(code, json.dumps({
+        "type": "viewer_count", "count": cnt
+    }))
 
     try:
         while True:
             text = await ws.receive_text()
-            msg = json.loads(text)
-            t = msg.get("type", msg.get("action", ""))
-
-            if t == "chat":
-                msg["from"] = "viewer"
-                msg["viewer_name"] = viewer_name
-                s["chat_history"].append(msg)
-                if len(s["chat_history"]) > 100:
-                    s["chat_history"] = s["chat_history"][-50:]
-                try:
-                    await s["host"].send_text(json.dumps(msg))
-                except: pass
-                for v in s["viewers"]:
-                    if v != ws:
-                        try:
-                            await v.send_text(json.dumps(msg))
-                        except: pass
-
-            elif t == "draw":
-                for v in s["viewers"]:
-                    if v != ws:
-                        try:
-                            await v.send_text(text)
-                        except: pass
-
-            elif t == "draw_clear":
-                for v in s["viewers"]:
-                    if v != ws:
-                        try:
-                            await v.send_text(text)
-                        except: pass
-
-            elif t == "cursor_pos":
-                # Ghost Cursors — рассылаем другим зрителям с именем
-                meta = s["viewer_meta"].get(ws, {})
-                msg["viewer_id"] = meta.get("id", "?")
-                msg["color"] = meta.get("color", "#fff")
-                msg["name"] = meta.get("name", "Viewer")
-                out = json.dumps(msg)
-                for v in s["viewers"]:
-                    if v != ws:
-                        try:
-                            await v.send_text(out)
-                        except: pass
-
-            elif t == "clipboard_sync":
-                try:
-                    await s["host"].send_text(json.dumps(msg))
-                except: pass
-
-            # ═══ OrbExplorer: browse request ═══
-            elif t == "browse_dir":
-                try:
-                    await s["host"].send_text(json.dumps(msg))
-                except: pass
-
-            elif t == "download_remote_file":
-                try:
-                    await s["host"].send_text(json.dumps(msg))
-                except: pass
-
-            # ═══ Task Manager Pro ═══
-            elif t == "request_processes":
-                try:
-                    await s["host"].send_text(json.dumps(msg))
-                except: pass
-
-            elif t == "kill_process":
-                if s.get("control_allowed", False):
-                    add_audit(s, "kill_process", f"PID: {msg.get('pid', '?')}")
-                    try:
-                        await s["host"].send_text(json.dumps(msg))
-                    except: pass
-
-            # ═══ Privacy Shield (viewer request) ═══
-            elif t == "privacy_shield":
-                try:
-                    await s["host"].send_text(json.dumps(msg))
-                except: pass
-
-            else:
-                # Управление (move, click, key и т.п.) → хосту
-                if s.get("control_allowed", False):
-                    host = s.get("host")
-                    if host:
-                        try:
-                            await host.send_text(text)
-                        except: pass
+            await route(VIEWER_ROUTES, s, ws, text)
 
     except (WebSocketDisconnect, Exception):
         pass
     finally:
-        if code in sessions and ws in sessions[code]["viewers"]:
-            sessions[code]["viewers"].remove(ws)
-            sessions[code]["viewer_meta"].pop(ws, None)
-            cnt = len(sessions[code]["viewers"])
-            print(f"[Hub] Viewer- {code} ({cnt})")
-            add_audit(sessions[code], "viewer_disconnect", f"{viewer_name} отключился")
-            # Сообщаем другим зрителям что этот курсор ушёл
-            for v in sessions[code]["viewers"]:
-                try:
-                    await v.send_text(json.dumps({
-                        "type": "cursor_remove",
-                        "viewer_id": viewer_id,
-                    }))
-                except: pass
-            try:
-                await sessions[code]["host"].send_text(json.dumps({
-                    "type": "viewer_count", "count": cnt
-                }))
-            except: pass
+        # Если зрителя уже убрал fan_out, уборка идёт в его задаче
+        left = remove_viewer(s, ws)
+        if left:
+            await left
 
 
 # ═══════════════════════════════════════════════════════
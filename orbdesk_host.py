@@ -6,26 +6,47 @@ OrbDesk Host Agent v2 — Оптимизированный до 60 FPS
 Управление в терминале:
     C — разрешить/запретить управление мышью/клавиатурой
     K — выгнать всех зрителей
+    T — времена стадий конвейера (p50/p95/p99), копия в orbdesk_stages.json
     Q — завершить
 """
 import asyncio
 import io
 import json
+import os
 import random
 import string
+import struct
 import sys
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
+from array import array
+from collections import deque
+from fractions import Fraction
 
 try:
     import mss
     import pyautogui
+    from PIL import Image
 except ImportError:
     print("Установите зависимости:")
     print("  pip install mss pyautogui websockets")
     sys.exit(1)
 
+try:
+    import numpy as np
+except ImportError:
+    np = None  # без numpy дельта-режим недоступен
+
+try:
+    import psutil
+except ImportError:
+    psutil = None  # без psutil дашборд видит только нагрузку самого агента
+
+try:
+    import av
+except ImportError:
+    av = None  # без PyAV видеокодек недоступен, только JPEG
+
 try:
     import websockets
 except ImportError:
@@ -44,7 +65,6 @@ try:
         jpeg = TurboJPEG()
     except Exception:
         # Если не нашлось по умолчанию, пробуем типичные пути Windows
-        import os
         possible_dll_names = ["turbojpeg.dll", "libturbojpeg.dll"]
         possible_roots = ["C:\\libjpeg-turbo64", "C:\\libjpeg-turbo", "C:\\Program Files\\libjpeg-turbo64"]
         
@@ -102,20 +122,101 @@ QUALITY = QUALITY_PROFILES[current_profile]["quality"]
 FPS = QUALITY_PROFILES[current_profile]["fps"]
 SCALE = QUALITY_PROFILES[current_profile]["scale"]
 
+# Адаптивный битрейт: лестница уровней, профиль задаёт потолок
+ABR_LADDER = [
+    {"quality": 25, "scale": 0.35, "fps": 10},
+    QUALITY_PROFILES["low"],
+    {"quality": 40, "scale": 0.50, "fps": 20},
+    QUALITY_PROFILES["medium"],
+    {"quality": 60, "scale": 0.65, "fps": 30},
+    {"quality": 70, "scale": 0.65, "fps": 45},
+    QUALITY_PROFILES["high"],
+]
+TARGET_KBPS = 4000           # целевой битрейт потока
+TARGET_SEND_MS = 40          # ws.send дольше этого — канал забит
+ABR_HIGH = 1.15              # выше target × HIGH — снижаем уровень
+ABR_LOW = 0.70               # ниже target × LOW N периодов подряд — повышаем
+ABR_UP_PERIODS = 3
+ABR_COOLDOWN = 2             # периодов без решений после смены уровня
+
+# Дельта-режим: отправляем только изменившиеся тайлы
+DELTA_MODE = np is not None
+TILE_SIZE = 64               # px, кратно 16 для JPEG 4:2:0
+KEYFRAME_INTERVAL = 2.0      # сек, не чаще — полный кадр вместо дельты
+KEYFRAME_DIRTY_RATIO = 0.5   # если изменилось больше половины — шлём полный кадр
+DELTA_MAGIC = b"ODTL"
+
+# Каждый монитор — свой поток кадров: "ODMN" | номер u8 | слой u8 | JPEG или дельта.
+# Захватываются только мониторы, на которые подписан хоть один зритель.
+MONITOR_MAGIC = b"ODMN"
+MONITOR_HEADER = struct.Struct("<4sBB")
+
+# Simulcast: из одного захвата кодируем несколько слоёв качества, хаб сам
+# выбирает слой каждому зрителю по заполненности его очереди.
+# 1 — выключено; слой 0 — настройки ABR, дальше — доли от них.
+SIMULCAST_LAYERS = 1
+LAYER_STEPS = [(1.0, 1.0), (0.6, 0.75), (0.4, 0.55)]  # (× scale, × quality)
+
+# Видеокодек: "jpeg" — каждый кадр сам по себе; "h264" — libx264 через PyAV,
+# P-кадры несут только разницу. Включается, только если у всех зрителей
+# есть WebCodecs, иначе — обычный JPEG/дельты.
+CODEC = "jpeg"
+VIDEO_GOP = 120              # кадров между ключевыми
+VIDEO_MAGIC = b"ODVC"
+VIDEO_HEADER = struct.Struct("<4sBHH")   # magic | флаги | ширина | высота, дальше Annex B
+VIDEO_KEY = 1
+if CODEC == "h264" and (av is None or np is None):
+    print("⚠️  H.264 недоступен: pip install av numpy — работаем через JPEG")
+
 # ═══ Инициализация ═══
 pyautogui.PAUSE = 0
 pyautogui.FAILSAFE = False
 
 control_allowed = True
 ws_connection = None
+resume_token = ""    # от хаба: с ним после обрыва возвращаемся в ту же сессию
 held_modifiers = set()
-current_monitor = 1  # mss monitor index (1 = primary)
+current_monitor = 1  # mss monitor index (1 = primary) — для ввода без номера монитора
+monitor_subs = {}    # viewer_id -> мониторы, которые он смотрит
+watched_monitors = ()  # объединение подписок, по возрастанию
+video_support = {}   # viewer_id -> умеет ли браузер декодировать H.264
+video_active = False  # сейчас кодируем H.264 (решает event loop, читает поток захвата)
 
 # Сессионный пароль
 SESSION_PASSWORD = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
 
-# Пул потоков для захвата экрана (не блокирует event loop)
-capture_executor = ThreadPoolExecutor(max_workers=2)
+# Кадров «в полёте» между захватом и отправкой: пока кадр N уходит в сеть,
+# поток захвата уже готовит N+1. Если отправка не успевает — тик пропускается.
+PIPELINE_DEPTH = 2
+
+# Времена стадий кадра: скользящее окно последних замеров на стадию
+STAGES = ("grab", "scale", "encode", "queue", "send")
+STAGE_WINDOW = 1024
+STAGE_REPORT_INTERVAL = 5.0  # сек, как часто отчёт уходит хабу
+STAGES_FILE = "orbdesk_stages.json"
+
+# Ввод зрителей — в своём потоке; move/scroll подряд склеиваются
+INPUT_QUEUE_SIZE = 256
+LOSSY_ACTIONS = ("move", "scroll")  # только их можно потерять при переполнении
+
+# Как часто проверять, не поменялись ли мониторы (подключили, сменили раскладку)
+MONITOR_POLL_INTERVAL = 2.0  # сек
+
+# OrbExplorer: файлы уходят бинарно, кусками, с окном кредитов от зрителя
+FILE_MAGIC = b"ODFT"
+FILE_HEADER = struct.Struct("<4sIQB")   # magic | transfer_id | offset | flags
+FILE_META, FILE_END, FILE_ERROR = 1, 2, 4
+FILE_CHUNK = 64 * 1024
+FILE_WINDOW = 512 * 1024     # байт без подтверждения — больше не шлём, кадрам хватит канала
+FILE_ACK_TIMEOUT = 30        # сек без file_ack — передача брошена
+BROWSE_LIMIT = 1000          # элементов в листинге папки
+file_transfers = {}          # transfer_id -> FileTransfer
+
+# Переподключение к хабу: пауза растёт вдвое с каждой неудачей, со случайным
+# разбросом, чтобы хосты после сбоя хаба не ломились в него одновременно.
+# Потолок меньше, чем хаб держит сессию (ORBDESK_HOST_GRACE, по умолчанию 30 с)
+RECONNECT_BASE = 0.5         # сек, первая пауза
+RECONNECT_MAX = 8.0          # сек
 
 
 def gen_code():
@@ -139,83 +240,893 @@ def get_monitor_list():
         return monitors
 
 
+# ═══ Дельта-кодирование по тайлам ═══
+
+def dirty_tiles(prev, cur, tile):
+    """Маска изменившихся тайлов (rows × cols), векторно через numpy."""
+    h, w = cur.shape[:2]
+    if cur.shape[2] == 4:
+        # BGRA: сравниваем пиксель целиком как uint32
+        ne = prev.view(np.uint32)[..., 0] != cur.view(np.uint32)[..., 0]
+    else:
+        ne = (prev != cur).any(axis=2)
+    ne = np.logical_or.reduceat(ne, np.arange(0, h, tile), axis=0)
+    return np.logical_or.reduceat(ne, np.arange(0, w, tile), axis=1)
+
+
+class DeltaEncoder:
+    """Кодирует только изменившиеся тайлы относительно прошлого кадра.
+
+    Формат дельты (little-endian):
+        "ODTL" | width u16 | height u16 | count u16
+        count × (x u16 | y u16 | len u32 | JPEG)
+    Полный кадр (keyframe) — обычный JPEG, как и раньше.
+    Статичный экран — None, ничего не отправляем.
+    """
+
+    def __init__(self, tile=TILE_SIZE):
+        self.tile = tile
+        self.prev = None
+        self.last_key = 0.0
+        self.force_key = True
+
+    def request_keyframe(self):
+        self.force_key = True
+
+    def encode(self, frame, encode_fn):
+        now = time.monotonic()
+        if self.force_key or self.prev is None or self.prev.shape != frame.shape:
+            return self._keyframe(frame, encode_fn, now)
+
+        dirty = dirty_tiles(self.prev, frame, self.tile)
+        if not dirty.any():
+            return None
+        if (dirty.mean() > KEYFRAME_DIRTY_RATIO
+                or now - self.last_key >= KEYFRAME_INTERVAL):
+            return self._keyframe(frame, encode_fn, now)
+
+        h, w = frame.shape[:2]
+        t = self.tile
+        parts = []
+        for ty, row in enumerate(dirty):
+            # Соседние грязные тайлы в строке склеиваем в один прямоугольник
+            cols = np.flatnonzero(row)
+            if not len(cols):
+                continue
+            breaks = np.flatnonzero(np.diff(cols) > 1)
+            starts = np.concatenate(([cols[0]], cols[breaks + 1]))
+            ends = np.concatenate((cols[breaks], [cols[-1]])) + 1
+            y0, y1 = ty * t, min(ty * t + t, h)
+            for c0, c1 in zip(starts, ends):
+                x0, x1 = int(c0) * t, min(int(c1) * t, w)
+                region = frame[y0:y1, x0:x1]
+                self.prev[y0:y1, x0:x1] = region
+                data = encode_fn(np.ascontiguousarray(region))
+                parts.append(struct.pack("<HHI", x0, y0, len(data)))
+                parts.append(data)
+
+        header = DELTA_MAGIC + struct.pack("<HHH", w, h, len(parts) // 2)
+        return header + b"".join(parts)
+
+    def _keyframe(self, frame, encode_fn, now):
+        if self.prev is None or self.prev.shape != frame.shape:
+            self.prev = np.empty(frame.shape, dtype=np.uint8)
+        np.copyto(self.prev, frame)
+        self.force_key = False
+        self.last_key = now
+        return encode_fn(self.prev)
+
+
+class VideoEncoder:
+    """H.264 через libx264: zerolatency, baseline, без B-кадров — пакет
+    выходит на каждый поданный кадр. Ключевой кадр — раз в VIDEO_GOP
+    или по запросу; SPS/PPS идут в потоке перед каждым ключевым.
+    Сменились размер или качество — кодек открывается заново."""
+
+    def __init__(self):
+        self.ctx = None
+        self.params = None
+        self.force_key = True
+        self.started = time.monotonic()
+        self.pts = -1
+
+    def request_keyframe(self):
+        self.force_key = True
+
+    def encode(self, frame, quality, fmt="bgra"):
+        # yuv420p требует чётных сторон — лишний пиксель справа/снизу отрезаем
+        h, w = frame.shape[0] & ~1, frame.shape[1] & ~1
+        if (h, w) != frame.shape[:2]:
+            frame = np.ascontiguousarray(frame[:h, :w])
+        crf = max(18, min(45, round(45 - quality * 0.3)))  # JPEG quality → CRF x264
+        if self.params != (w, h, crf):
+            self._open(w, h, crf)
+        vf = av.VideoFrame.from_ndarray(frame, format=fmt).reformat(format="yuv420p")
+        self.pts = max(self.pts + 1, int((time.monotonic() - self.started) * 1000))
+        vf.pts = self.pts
+        if self.force_key:
+            vf.pict_type = av.video.frame.PictureType.I
+            self.force_key = False
+        packets = self.ctx.encode(vf)
+        if not packets:
+            return None
+        flags = VIDEO_KEY if any(p.is_keyframe for p in packets) else 0
+        return VIDEO_HEADER.pack(VIDEO_MAGIC, flags, w, h) + b"".join(bytes(p) for p in packets)
+
+    def _open(self, w, h, crf):
+        ctx = av.CodecContext.create("libx264", "w")
+        ctx.width, ctx.height = w, h
+        ctx.pix_fmt = "yuv420p"
+        ctx.time_base = Fraction(1, 1000)   # pts — миллисекунды, FPS у нас плавает
+        ctx.gop_size = VIDEO_GOP
+        ctx.options = {
+            "preset": "ultrafast", "tune": "zerolatency", "profile": "baseline",
+            "crf": str(crf), "forced-idr": "1",
+        }
+        self.ctx = ctx
+        self.params = (w, h, crf)
+        self.force_key = True
+
+
+class MonitorStream:
+    """Состояние кодирования одного монитора: своя цепочка дельт (и свой
+    H.264-энкодер) на каждый слой simulcast и свой слот конвейера, чтобы
+    медленный монитор не задерживал другие."""
+
+    def __init__(self, index, layers=None):
+        layers = layers or max(1, min(SIMULCAST_LAYERS, len(LAYER_STEPS)))
+        self.index = index
+        self.encoders = [DeltaEncoder() for _ in range(layers)]
+        self.video = [VideoEncoder() for _ in range(layers)] if av is not None else []
+        self.headers = [MONITOR_HEADER.pack(MONITOR_MAGIC, index, layer) for layer in range(layers)]
+        self.slots = threading.BoundedSemaphore(PIPELINE_DEPTH)
+
+
+streams = {}  # номер монитора -> MonitorStream, пока он кому-то нужен
+
+
+def request_keyframe(monitor=None, layer=None):
+    """Полный кадр монитора и слоя (None — всех) на ближайшем тике."""
+    for stream in list(streams.values()):
+        if monitor is None or stream.index == monitor:
+            for encoders in (stream.encoders, stream.video):
+                for i, encoder in enumerate(encoders):
+                    if layer is None or i == layer:
+                        encoder.request_keyframe()
+
+
+def layer_settings(layer):
+    """(scale, quality) слоя simulcast от текущих настроек ABR."""
+    k_scale, k_quality = LAYER_STEPS[layer]
+    return SCALE * k_scale, max(10, int(QUALITY * k_quality))
+
+
+def set_subscription(viewer_id, monitors):
+    """Подписка зрителя от хаба. Пустая — зритель ушёл или ничего не смотрит."""
+    global watched_monitors
+    if monitors:
+        monitor_subs[viewer_id] = set(monitors)
+    else:
+        monitor_subs.pop(viewer_id, None)
+        video_support.pop(viewer_id, None)
+    watched = tuple(sorted(set().union(*monitor_subs.values())))
+    if watched != watched_monitors:
+        watched_monitors = watched
+        print(f"\n  🖥️ Мониторы в эфире: {', '.join(f'#{m}' for m in watched) or 'нет'}")
+    update_codec()
+
+
+def set_codec_support(viewer_id, video):
+    video_support[viewer_id] = bool(video)
+    update_codec()
+
+
+def update_codec():
+    """H.264 — если он включён, есть PyAV и его декодирует каждый, кто смотрит.
+    При переключении все мониторы начинают с полного кадра нового кодека."""
+    global video_active
+    active = (CODEC == "h264" and av is not None and np is not None and bool(monitor_subs)
+              and all(video_support.get(v) for v in monitor_subs))
+    if active != video_active:
+        video_active = active
+        request_keyframe()
+        print(f"\n  🎞️ Кодек: {'H.264' if active else 'JPEG'}")
+
+
+# ═══ Адаптивный битрейт (замкнутый контур) ═══
+
+class BitrateController:
+    """Подстраивает QUALITY/SCALE/FPS под целевой битрейт и задержку.
+
+    Раз в секунду смотрит на отправленные байты, время ws.send и
+    отчёты зрителей (recv_stats). Вниз — сразу на шаг, вверх — только
+    после ABR_UP_PERIODS спокойных периодов: полоса гистерезиса между
+    ABR_LOW и ABR_HIGH не даёт настройкам дёргаться.
+    """
+
+    def __init__(self, ceiling="medium"):
+        self.ceiling = ABR_LADDER.index(QUALITY_PROFILES[ceiling])
+        self.level = self.ceiling
+        self.bytes = 0
+        self.frames = 0
+        self.send_time = 0.0
+        self.period_start = time.monotonic()
+        self.good_periods = 0
+        self.cooldown = 0
+        self.viewers = {}  # viewer_id -> последний recv_stats
+        self.last_dropped = {}
+
+    def set_ceiling(self, profile):
+        self.ceiling = ABR_LADDER.index(QUALITY_PROFILES[profile])
+        self.level = self.ceiling
+        self.good_periods = 0
+        self.cooldown = ABR_COOLDOWN
+
+    def on_frame(self, size, send_s):
+        self.bytes += size
+        self.frames += 1
+        self.send_time += send_s
+
+    def on_viewer_stats(self, d):
+        vid = d.get("viewer_id", "?")
+        dropped = d.get("dropped", 0)
+        d["dropped_new"] = dropped - self.last_dropped.get(vid, dropped)
+        self.last_dropped[vid] = dropped
+        d["at"] = time.monotonic()
+        self.viewers[vid] = d
+
+    def settings(self):
+        return ABR_LADDER[self.level]
+
+    def update(self):
+        """Закрывает период. Возвращает dict с решением или None."""
+        now = time.monotonic()
+        elapsed = max(now - self.period_start, 1e-3)
+        kbps = self.bytes * 8 / 1000 / elapsed
+        send_ms = self.send_time * 1000 / self.frames if self.frames else 0.0
+        self.bytes = self.frames = 0
+        self.send_time = 0.0
+        self.period_start = now
+
+        # Зрители на нижних слоях simulcast не тянут вниз основной слой
+        fresh = [v for v in self.viewers.values()
+                 if now - v["at"] < 3 and not v.get("layer")]
+        viewer_drops = sum(v.get("dropped_new", 0) for v in fresh)
+        render_ms = max((v.get("render_ms", 0) for v in fresh), default=0)
+        backlog = max((v.get("backlog", 0) for v in fresh), default=0)
+        frame_ms = 1000 / ABR_LADDER[self.level]["fps"]
+
+        reason = None
+        old = self.level
+        if self.cooldown:
+            self.cooldown -= 1
+        elif (kbps > TARGET_KBPS * ABR_HIGH or send_ms > TARGET_SEND_MS
+                or viewer_drops or backlog > 2 or render_ms > frame_ms):
+            self.good_periods = 0
+            if self.level > 0:
+                self.level -= 1
+                reason = "congestion"
+        elif kbps < TARGET_KBPS * ABR_LOW and send_ms < TARGET_SEND_MS / 2:
+            self.good_periods += 1
+            if self.good_periods >= ABR_UP_PERIODS and self.level < self.ceiling:
+                self.level += 1
+                self.good_periods = 0
+                reason = "headroom"
+        else:
+            self.good_periods = 0
+
+        if self.level != old:
+            self.cooldown = ABR_COOLDOWN
+        state = {
+            "type": "abr_state",
+            "level": self.level,
+            "ceiling": self.ceiling,
+            **self.settings(),
+            "kbps": round(kbps),
+            "send_ms": round(send_ms, 1),
+            "viewer_drops": viewer_drops,
+            "render_ms": round(render_ms, 1),
+            "reason": reason,
+        }
+        return state
+
+
+abr = BitrateController(current_profile)
+
+
+# ═══ Масштабирование: усреднение по площади ═══
+
+def area_taps(n, m):
+    """Индексы и веса (фикс. точка, сумма 256) для сжатия n → m пикселей.
+
+    Каждый выходной пиксель покрывает отрезок [i·n/m, (i+1)·n/m) входа,
+    вес входного пикселя — доля его площади в этом отрезке.
+    Возвращает idx, w формы (taps, m).
+    """
+    ratio = n / m
+    start = np.arange(m) * ratio
+    end = start + ratio
+    first = np.floor(start).astype(np.intp)
+    idx = first[None, :] + np.arange(int(np.ceil(ratio)) + 1)[:, None]
+    cover = np.minimum(end[None, :], idx + 1) - np.maximum(start[None, :], idx)
+    cover = np.clip(cover, 0, None) / ratio
+    idx = np.minimum(idx, n - 1)
+    w = np.floor(cover * 256).astype(np.int32)
+    # Остаток от округления — самому «тяжёлому» тапу, чтобы сумма была ровно 256
+    w[np.argmax(cover, axis=0), np.arange(m)] += 256 - w.sum(axis=0)
+    keep = w.any(axis=1)
+    return idx[keep], w[keep].astype(np.uint16)
+
+
+class AreaResampler:
+    """Сжатие BGRA-кадра в произвольное дробное число раз.
+
+    Два прохода (строки, затем столбцы), каждый — сумма нескольких
+    сдвинутых копий с весами в uint16: 255 × 256 помещается без
+    переполнения. Все буферы выделяются один раз под размер кадра.
+    """
+
+    def __init__(self, h, w, scale, channels=4):
+        oh, ow = max(1, int(h * scale)), max(1, int(w * scale))
+        self.key = (h, w, channels, scale)
+        self.y_idx, y_w = area_taps(h, oh)
+        self.x_idx, x_w = area_taps(w, ow)
+        self.y_w = y_w[:, :, None]                       # (taps, oh, 1)
+        self.x_w = np.repeat(x_w, channels, axis=1)      # (taps, ow·c)
+        self.rows = np.empty((oh, w, channels), dtype=np.uint8)
+        self.out = np.empty((oh, ow, channels), dtype=np.uint8)
+        self.acc_r = np.empty((oh, w * channels), dtype=np.uint16)
+        self.tmp_r = np.empty_like(self.acc_r)
+        self.acc_c = np.empty((oh, ow * channels), dtype=np.uint16)
+        self.tmp_c = np.empty_like(self.acc_c)
+
+    def __call__(self, img):
+        h, w, c = img.shape
+        oh = self.out.shape[0]
+        self._pass(lambda i: np.take(img, i, axis=0).reshape(oh, w * c),
+                   self.y_idx, self.y_w, self.acc_r, self.tmp_r, self.rows)
+        self._pass(lambda i: np.take(self.rows, i, axis=1).reshape(oh, -1),
+                   self.x_idx, self.x_w, self.acc_c, self.tmp_c, self.out)
+        return self.out
+
+    @staticmethod
+    def _pass(gather, idx, weights, acc, tmp, out):
+        np.multiply(gather(idx[0]), weights[0], out=acc)
+        for k in range(1, len(idx)):
+            np.multiply(gather(idx[k]), weights[k], out=tmp)
+            acc += tmp
+        acc += 128
+        acc >>= 8
+        np.copyto(out.reshape(acc.shape), acc, casting="unsafe")
+
+
+_resamplers = {}  # (h, w, каналы, масштаб) -> AreaResampler; по одному на размер монитора
+
+
+def downscale(img, scale):
+    """Сжимает кадр, переиспользуя AreaResampler, пока размер и масштаб те же.
+    Вызывается только из потока захвата, общий буфер out успевает уйти в энкодер."""
+    key = (*img.shape, scale)
+    resampler = _resamplers.get(key)
+    if resampler is None:
+        if len(_resamplers) >= 16:
+            _resamplers.clear()  # сменился масштаб — старые размеры не нужны
+        resampler = _resamplers[key] = AreaResampler(img.shape[0], img.shape[1], scale, img.shape[2])
+    return resampler(img)
+
+
+# ═══ Времена стадий конвейера ═══
+
+class StageTimer:
+    """Скользящие окна замеров по стадиям: grab/scale/encode пишет поток
+    захвата, queue/send — event loop. У каждой стадии один писатель, так
+    что замер — запись в заранее выделенный массив, без блокировок.
+    Перцентили считаются только при отчёте."""
+
+    def __init__(self, stages=STAGES, window=STAGE_WINDOW):
+        self.window = window
+        self.samples = {st: array("d", bytes(8 * window)) for st in stages}
+        self.count = dict.fromkeys(stages, 0)
+
+    def add(self, stage, seconds):
+        n = self.count[stage]
+        self.samples[stage][n % self.window] = seconds
+        self.count[stage] = n + 1
+
+    def report(self):
+        """{стадия: {p50, p95, p99 в мс, n — замеров всего}}."""
+        out = {}
+        for stage, buf in self.samples.items():
+            n = self.count[stage]
+            vals = sorted(buf[:min(n, self.window)])
+            if not vals:
+                out[stage] = None
+                continue
+            pick = lambda q: round(vals[min(len(vals) - 1, int(q * len(vals)))] * 1000, 2)
+            out[stage] = {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "n": n}
+        return out
+
+
+stage_timer = StageTimer()
+
+
+def show_stages():
+    """T в терминале: таблица стадий и JSON-копия рядом со скриптом."""
+    report = stage_timer.report()
+    print("\n  ⏱️  Стадия      p50 мс   p95 мс   p99 мс   замеров")
+    for stage, r in report.items():
+        if r:
+            print(f"     {stage:10s} {r['p50']:8.2f} {r['p95']:8.2f} {r['p99']:8.2f}   {r['n']}")
+        else:
+            print(f"     {stage:10s}        —")
+    try:
+        with open(STAGES_FILE, "w", encoding="utf-8") as f:
+            json.dump({"at": time.time(), "fps": FPS, "quality": QUALITY, "scale": SCALE,
+                       "stages": report}, f, ensure_ascii=False, indent=2)
+        print(f"     → {os.path.abspath(STAGES_FILE)}\n")
+    except OSError as e:
+        print(f"     не удалось записать {STAGES_FILE}: {e}\n")
+
+
 # ═══ Захват экрана (оптимизированный) ═══
 
-def capture_turbo():
+def encode_turbo(arr, quality=None):
+    return jpeg.encode(
+        arr,
+        pixel_format=TJPF_BGRA,
+        quality=quality or QUALITY,
+        jpeg_subsample=TJSAMP_420,
+        flags=TJFLAG_FASTDCT
+    )
+
+
+def encode_pillow(arr, quality=None):
+    buf = io.BytesIO()
+    Image.fromarray(arr).save(buf, format="JPEG", quality=quality or QUALITY, optimize=False)
+    return buf.getvalue()
+
+
+def capture_turbo(sct, stream):
     """Захват с TurboJPEG — максимальная скорость."""
-    with mss.mss() as sct:
-        mon = sct.monitors[current_monitor]
-        shot = sct.grab(mon)
-        # mss возвращает BGRA, turbojpeg может принять его напрямую
-        raw = np.frombuffer(shot.raw, dtype=np.uint8).reshape(
-            (shot.height, shot.width, 4)
-        )
-
-        if SCALE < 1:
-            new_w = int(shot.width * SCALE)
-            new_h = int(shot.height * SCALE)
-            # Быстрый resize через numpy (nearest neighbor — моментальный)
-            raw = raw[::int(1/SCALE), ::int(1/SCALE)]
-
-        return jpeg.encode(
-            raw,
-            pixel_format=TJPF_BGRA,
-            quality=QUALITY,
-            jpeg_subsample=TJSAMP_420,
-            flags=TJFLAG_FASTDCT
-        )
-
-
-def capture_pillow():
+    mon = sct.monitors[stream.index]
+    t0 = time.perf_counter()
+    shot = sct.grab(mon)
+    # mss возвращает BGRA, turbojpeg может принять его напрямую
+    raw = np.frombuffer(shot.raw, dtype=np.uint8).reshape(
+        (shot.height, shot.width, 4)
+    )
+    t1 = time.perf_counter()
+    stage_timer.add("grab", t1 - t0)
+
+    # Все слои — из одного и того же снимка, сжатие каждый раз от оригинала
+    video = video_active and stream.video
+    frames = []
+    scale_s = encode_s = 0.0
+    for layer, encoder in enumerate(stream.encoders):
+        scale, quality = layer_settings(layer)
+        t1 = time.perf_counter()
+        # Честное дробное сжатие с усреднением — текст не рассыпается
+        frame = downscale(raw, scale) if scale < 1 else raw
+        t2 = time.perf_counter()
+        encode = lambda a: encode_turbo(a, quality)
+        if video:
+            frames.append(stream.video[layer].encode(frame, quality))
+        else:
+            frames.append(encoder.encode(frame, encode) if DELTA_MODE else encode(frame))
+        scale_s += t2 - t1
+        encode_s += time.perf_counter() - t2
+    stage_timer.add("scale", scale_s)
+    stage_timer.add("encode", encode_s)
+    return frames
+
+
+def capture_pillow(sct, stream):
     """Захват с Pillow — медленнее, но универсальный."""
-    with mss.mss() as sct:
-        mon = sct.monitors[current_monitor]
-        shot = sct.grab(mon)
-        img = Image.frombytes("RGB", shot.size, shot.bgra, "raw", "BGRX")
-        if SCALE < 1:
-            new_w = int(img.width * SCALE)
-            new_h = int(img.height * SCALE)
+    mon = sct.monitors[stream.index]
+    t0 = time.perf_counter()
+    shot = sct.grab(mon)
+    img = Image.frombytes("RGB", shot.size, shot.bgra, "raw", "BGRX")
+    t1 = time.perf_counter()
+    stage_timer.add("grab", t1 - t0)
+
+    video = video_active and stream.video
+    frames = []
+    scale_s = encode_s = 0.0
+    for layer, encoder in enumerate(stream.encoders):
+        scale, quality = layer_settings(layer)
+        t1 = time.perf_counter()
+        scaled = img
+        if scale < 1:
+            new_w = int(img.width * scale)
+            new_h = int(img.height * scale)
             # BILINEAR вместо LANCZOS — в 3x быстрее, разница минимальна
-            img = img.resize((new_w, new_h), Image.BILINEAR)
-        buf = io.BytesIO()
-        img.save(buf, format="JPEG", quality=QUALITY, optimize=False)
-        return buf.getvalue()
+            scaled = img.resize((new_w, new_h), Image.BILINEAR)
+        t2 = time.perf_counter()
+        if video:
+            frames.append(stream.video[layer].encode(np.asarray(scaled), quality, "rgb24"))
+        elif DELTA_MODE:
+            frames.append(encoder.encode(np.asarray(scaled), lambda a: encode_pillow(a, quality)))
+        else:
+            buf = io.BytesIO()
+            scaled.save(buf, format="JPEG", quality=quality, optimize=False)
+            frames.append(buf.getvalue())
+        scale_s += t2 - t1
+        encode_s += time.perf_counter() - t2
+    stage_timer.add("scale", scale_s)
+    stage_timer.add("encode", encode_s)
+    return frames
 
 
-def capture():
-    """Выбирает лучший доступный энкодер."""
+def capture(sct, stream):
+    """Кадры монитора stream по слоям (без заголовка ODMN); None — слой не изменился."""
     if USE_TURBOJPEG:
-        return capture_turbo()
-    return capture_pillow()
+        return capture_turbo(sct, stream)
+    return capture_pillow(sct, stream)
 
 
-# ═══ Обработка команд ═══
+class CaptureWorker(threading.Thread):
+    """Долгоживущий поток захвата: один mss на всё соединение.
+
+    На каждом тике захватывает мониторы из watched_monitors — те, что
+    кто-то смотрит; без подписчиков поток просто спит.
+    Готовые кадры передаются в event loop через asyncio.Queue.
+    Семафор монитора ограничивает его кадры «в полёте» (PIPELINE_DEPTH):
+    пока отправка не освободила слот, тик захвата пропускается — так
+    не тратим CPU на кадры, которые всё равно не успеют уйти,
+    и не ломаем цепочку дельт.
+    """
+
+    def __init__(self, loop):
+        super().__init__(daemon=True)
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.running = True
+        self.dropped = 0
+        self.captured = 0
+        self.capture_s = 0.0     # суммарно в захвате+масштабе+кодировании
+
+    def run(self):
+        streams.clear()  # новое соединение — все мониторы начинаются с полного кадра
+        with mss.mss() as sct:
+            next_tick = time.perf_counter()
+            while self.running:
+                watched = watched_monitors
+                for index in [i for i in streams if i not in watched]:
+                    del streams[index]  # монитор больше никто не смотрит
+                for index in watched:
+                    if index >= len(sct.monitors):
+                        continue
+                    stream = streams.get(index)
+                    if stream is None:
+                        stream = streams[index] = MonitorStream(index)
+                    if not self.grab(sct, stream):
+                        return
+
+                # Точный тайминг: если отстали — не копим долг
+                next_tick += 1.0 / FPS
+                sleep_time = next_tick - time.perf_counter()
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
+                else:
+                    next_tick = time.perf_counter()
+
+    def grab(self, sct, stream):
+        """Один кадр монитора в очередь отправки. False — event loop закрыт."""
+        if not stream.slots.acquire(blocking=False):
+            self.dropped += 1
+            return True
+        t0 = time.perf_counter()
+        try:
+            layers = capture(sct, stream)
+            self.capture_s += time.perf_counter() - t0
+            self.captured += 1
+        except Exception as e:
+            layers = ()
+            print(f"\n⚠️ Ошибка захвата: {e}")
+            time.sleep(0.5)
+        # Слои одного снимка едут одним элементом очереди и занимают один слот
+        frames = [stream.headers[i] + f for i, f in enumerate(layers) if f is not None]
+        if not frames:
+            stream.slots.release()
+            return True
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait,
+                                           (frames, time.perf_counter(), stream))
+        except RuntimeError:
+            return False
+        return True
+
+    def sent(self, stream):
+        """Кадр ушёл в сеть — освобождаем слот конвейера его монитора."""
+        stream.slots.release()
+
+    def stop(self):
+        self.running = False
+
+
+class MetricsSampler:
+    """system_metrics для дашборда, раз в секунду из цикла отправки.
+
+    Только дешёвые вызовы: cpu_percent(None) считает от прошлого
+    вызова без ожидания, сеть и стоимость кадра — разности счётчиков.
+    """
+
+    def __init__(self):
+        self.at = time.monotonic()
+        self.proc = time.process_time()
+        self.net = psutil.net_io_counters() if psutil else None
+        self.captured = 0
+        self.capture_s = 0.0
+        self.sent = 0
+        self.send_s = 0.0
+        if psutil:
+            psutil.cpu_percent(None)
+
+    def sample(self, worker, sent, send_s):
+        now = time.monotonic()
+        dt = max(now - self.at, 1e-3)
+        proc = time.process_time()
+        frames = worker.captured - self.captured
+        sends = sent - self.sent
+        m = {
+            "type": "system_metrics",
+            "proc_cpu": round((proc - self.proc) / dt * 100 / (os.cpu_count() or 1), 1),
+            "fps": round(sends / dt, 1),
+            "capture_ms": round((worker.capture_s - self.capture_s) / frames * 1000, 2) if frames else None,
+            "send_ms": round((send_s - self.send_s) / sends * 1000, 2) if sends else None,
+        }
+        if psutil:
+            vm = psutil.virtual_memory()
+            net = psutil.net_io_counters()
+            m.update({
+                "cpu": psutil.cpu_percent(None),
+                "ram": vm.percent,
+                "ram_used": round(vm.used / 2**30, 1),
+                "ram_total": round(vm.total / 2**30, 1),
+                "net_in": round((net.bytes_recv - self.net.bytes_recv) / dt / 1024, 1),   # KB/s
+                "net_out": round((net.bytes_sent - self.net.bytes_sent) / dt / 1024, 1),
+            })
+            self.net = net
+        self.at, self.proc = now, proc
+        self.captured, self.capture_s = worker.captured, worker.capture_s
+        self.sent, self.send_s = sent, send_s
+        return m
+
+
+def apply_settings(p):
+    global QUALITY, SCALE, FPS
+    if (p["quality"], p["scale"], p["fps"]) == (QUALITY, SCALE, FPS):
+        return
+    QUALITY = p["quality"]
+    SCALE = p["scale"]
+    FPS = p["fps"]
+    request_keyframe()
+
+
+# ═══ OrbExplorer ═══
+
+def resolve_path(p):
+    """Путь из браузера (всегда через /) в путь ОС. None — список дисков."""
+    p = (p or "").replace("\\", "/")
+    if os.name == "nt":
+        p = p.lstrip("/")
+        if not p:
+            return None
+        if len(p) == 2 and p[1] == ":":
+            p += "/"
+    else:
+        p = "/" + p.lstrip("/")
+    return os.path.normpath(p)
+
+
+def list_dir(p):
+    path = resolve_path(p)
+    if path is None:
+        drives = [f"{d}:" for d in string.ascii_uppercase if os.path.exists(f"{d}:\\")]
+        return {"type": "browse_result", "path": "",
+                "items": [{"name": d, "is_dir": True, "size": 0} for d in drives]}
+    items = []
+    with os.scandir(path) as it:
+        for e in it:
+            try:
+                is_dir = e.is_dir()
+                items.append({"name": e.name, "is_dir": is_dir,
+                              "size": 0 if is_dir else e.stat().st_size})
+            except OSError:
+                continue
+            if len(items) >= BROWSE_LIMIT:
+                break
+    items.sort(key=lambda i: (not i["is_dir"], i["name"].lower()))
+    return {"type": "browse_result", "path": path.replace("\\", "/"), "items": items}
+
 
-def handle_cmd(data_str):
-    """Выполняет команду управления от зрителя."""
-    global QUALITY, FPS, SCALE, current_profile, current_monitor
+def read_at(f, pos, n):
+    f.seek(pos)
+    return f.read(n)
+
+
+class FileTransfer:
+    """Отдаёт файл зрителю кусками FILE_CHUNK.
+
+    Шлём не дальше acked + FILE_WINDOW: зритель подтверждает принятое
+    (file_ack), и медленная загрузка не вытесняет кадры из канала.
+    Повторный запрос с тем же id и offset продолжает с места обрыва.
+    """
+
+    def __init__(self, ws, tid, path, offset):
+        self.ws = ws
+        self.tid = tid
+        self.path = path
+        self.pos = self.acked = offset
+        self.credit = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def header(self, flags):
+        return FILE_HEADER.pack(FILE_MAGIC, self.tid, self.pos, flags)
+
+    def ack(self, offset):
+        if offset > self.acked:
+            self.acked = offset
+            self.credit.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        f = None
+        try:
+            f = await loop.run_in_executor(None, open, self.path, "rb")
+            size = os.fstat(f.fileno()).st_size
+            meta = {"filename": os.path.basename(self.path), "size": size}
+            await self.ws.send(self.header(FILE_META) + json.dumps(meta).encode())
+            while True:
+                while self.pos >= self.acked + FILE_WINDOW:
+                    self.credit.clear()
+                    await asyncio.wait_for(self.credit.wait(), FILE_ACK_TIMEOUT)
+                chunk = await loop.run_in_executor(None, read_at, f, self.pos, FILE_CHUNK)
+                end = self.pos + len(chunk) >= size
+                await self.ws.send(self.header(FILE_END if end else 0) + chunk)
+                self.pos += len(chunk)
+                if end:
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            try:
+                await self.ws.send(self.header(FILE_ERROR) + str(e).encode())
+            except Exception:
+                pass
+        finally:
+            if f:
+                f.close()
+            if file_transfers.get(self.tid) is self:
+                del file_transfers[self.tid]
+
+    def cancel(self):
+        self.task.cancel()
+
+
+async def handle_explorer(ws, d):
+    """browse_dir / download_remote_file / file_ack / file_cancel от зрителя."""
+    t = d.get("type")
+    tid = d.get("transfer_id")
+    if t == "file_ack":
+        if tid in file_transfers:
+            file_transfers[tid].ack(d.get("offset", 0))
+        return
+    if t == "file_cancel":
+        if tid in file_transfers:
+            file_transfers.pop(tid).cancel()
+        return
     if not control_allowed:
-        # Разрешаем set_quality и set_monitor даже без контроля
+        # Файлы хоста — только при разрешённом управлении
+        await ws.send(json.dumps({"type": "browse_result", "error": "Управление запрещено хостом"}))
+        return
+    if t == "browse_dir":
         try:
-            d = json.loads(data_str)
-            a = d.get("action")
-            if a not in ("set_quality", "set_monitor"):
-                return
-        except:
-            return
-    try:
-        d = json.loads(data_str)
+            result = await asyncio.get_running_loop().run_in_executor(None, list_dir, d.get("path", ""))
+        except OSError as e:
+            result = {"type": "browse_result", "error": str(e)}
+        await ws.send(json.dumps(result))
+    elif t == "download_remote_file":
+        old = file_transfers.pop(tid, None)
+        if old:
+            old.cancel()
+        path = resolve_path(d.get("path", ""))
+        file_transfers[tid] = FileTransfer(ws, tid, path or "", d.get("offset", 0))
+        print(f"\n  📤 Файл: {path} (с {d.get('offset', 0)} байт)")
+
+
+# ═══ Обработка команд ═══
+
+INPUT_ACTIONS = ("move", "click", "dblclick", "scroll", "key", "hotkey", "keydown", "keyup", "type")
+
+
+class InputWorker(threading.Thread):
+    """Выполняет ввод зрителей в своём потоке, чтобы pyautogui не держал
+    event loop, который отправляет кадры.
+
+    Очередь ограничена INPUT_QUEUE_SIZE. Подряд идущие move склеиваются
+    в последнюю позицию, scroll — в сумму delta; клики и клавиши
+    выполняются строго в порядке прихода. При переполнении теряются
+    только move и scroll: клик или клавиша вытесняет самое старое из них,
+    а без keyup клавиша осталась бы зажатой. Координаты считаются от
+    прямоугольника монитора, который смотрит зритель (поле monitor);
+    прямоугольники берутся из mss один раз и при смене списка мониторов.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.events = deque()
+        self.cond = threading.Condition()
+        self.rects = {}           # монитор -> (left, top, width, height)
+        self.rect_stale = True
+        self.coalesced = 0
+        self.dropped = 0
+        self.running = True
+
+    def push(self, d):
         a = d.get("action")
-        sw, sh = pyautogui.size()
+        with self.cond:
+            last = self.events[-1] if self.events else None
+            if (last is not None and last.get("action") == a and a in ("move", "scroll")
+                    and last.get("monitor") == d.get("monitor")):
+                if a == "move":
+                    self.events[-1] = d
+                else:
+                    last["delta"] = last.get("delta", 0) + d.get("delta", 0)
+                self.coalesced += 1
+                return
+            if len(self.events) >= INPUT_QUEUE_SIZE:
+                if a in LOSSY_ACTIONS:
+                    self.dropped += 1
+                    return
+                for i, e in enumerate(self.events):
+                    if e.get("action") in LOSSY_ACTIONS:
+                        del self.events[i]
+                        self.dropped += 1
+                        break
+            self.events.append(d)
+            self.cond.notify()
 
+    def clear(self):
+        with self.cond:
+            self.events.clear()
+
+    def refresh_rect(self):
+        self.rect_stale = True
+
+    def run(self):
+        while self.running:
+            with self.cond:
+                if not self.events:
+                    self.cond.wait(0.5)
+                    continue
+                d = self.events.popleft()
+            if self.rect_stale:
+                self.rect_stale = False
+                with mss.mss() as sct:
+                    self.rects = {i: (m["left"], m["top"], m["width"], m["height"])
+                                  for i, m in enumerate(sct.monitors) if i}
+            try:
+                self.inject(d)
+            except Exception:
+                pass
+
+    def point(self, d):
+        rect = self.rects.get(d.get("monitor", current_monitor))
+        left, top, w, h = rect or self.rects[current_monitor]
+        return left + d["x"] * w, top + d["y"] * h
+
+    def inject(self, d):
+        a = d.get("action")
         if a == "move":
-            pyautogui.moveTo(d["x"] * sw, d["y"] * sh, _pause=False)
+            x, y = self.point(d)
+            pyautogui.moveTo(x, y, _pause=False)
         elif a == "click":
-            pyautogui.click(x=d["x"] * sw, y=d["y"] * sh,
-                            button=d.get("button", "left"))
+            x, y = self.point(d)
+            pyautogui.click(x=x, y=y, button=d.get("button", "left"))
         elif a == "dblclick":
-            pyautogui.doubleClick(x=d["x"] * sw, y=d["y"] * sh,
-                                  button=d.get("button", "left"))
+            x, y = self.point(d)
+            pyautogui.doubleClick(x=x, y=y, button=d.get("button", "left"))
         elif a == "scroll":
             pyautogui.scroll(d.get("delta", 0))
         elif a == "key":
@@ -240,23 +1151,29 @@ def handle_cmd(data_str):
             text = d.get("text", "")
             if text:
                 pyautogui.typewrite(text, interval=0.02)
-        elif a == "set_quality":
-            profile = d.get("profile", "medium")
-            if profile in QUALITY_PROFILES:
-                current_profile = profile
-                p = QUALITY_PROFILES[profile]
-                QUALITY = p["quality"]
-                SCALE = p["scale"]
-                FPS = p["fps"]
-                print(f"\n  📊 Качество: {profile.upper()} (Q={QUALITY}, Scale={SCALE}, FPS={FPS})")
-        elif a == "set_monitor":
-            idx = d.get("index", 1)
-            with mss.mss() as sct:
-                if 1 <= idx < len(sct.monitors):
-                    current_monitor = idx
-                    print(f"\n  🖥️ Монитор: #{idx}")
-    except:
-        pass
+
+    def stop(self):
+        self.running = False
+
+
+input_worker = InputWorker()
+
+
+def handle_cmd(d):
+    """Команда от зрителя: ввод — в очередь InputWorker, настройки — сразу."""
+    global current_profile
+    a = d.get("action")
+    if a in INPUT_ACTIONS:
+        if control_allowed:
+            input_worker.push(d)
+    elif a == "set_quality":
+        # Профиль теперь потолок для адаптивного битрейта
+        profile = d.get("profile", "medium")
+        if profile in QUALITY_PROFILES:
+            current_profile = profile
+            abr.set_ceiling(profile)
+            apply_settings(abr.settings())
+            print(f"\n  📊 Качество: {profile.upper()} (Q={QUALITY}, Scale={SCALE}, FPS={FPS})")
 
 
 # ═══ Терминальный контроль ═══
@@ -268,6 +1185,8 @@ def keyboard_listener():
             cmd = input().strip().lower()
             if cmd == "c":
                 control_allowed = not control_allowed
+                if not control_allowed:
+                    input_worker.clear()
                 status = "✅ РАЗРЕШЕНО" if control_allowed else "🔒 ЗАПРЕЩЕНО"
                 print(f"\n  Управление: {status}\n")
                 if ws_connection:
@@ -285,6 +1204,8 @@ def keyboard_listener():
                         ws_connection.send(json.dumps({"type": "kick"})),
                         loop
                     )
+            elif cmd == "t":
+                show_stages()
             elif cmd == "q":
                 print("\n  👋 Завершение...\n")
                 for mod in list(held_modifiers):
@@ -317,7 +1238,6 @@ async def run():
         HUB_URL = HUB_URL.replace("http://", "ws://")
 
     code = gen_code()
-    url = f"{HUB_URL}/ws/host?code={code}"
 
     monitors = get_monitor_list()
     encoder = "TurboJPEG ⚡" if USE_TURBOJPEG else "Pillow 🐢"
@@ -334,99 +1254,191 @@ async def run():
     print("╠══════════════════════════════════════════════╣")
     print("║   C — вкл/выкл управление мышью             ║")
     print("║   K — выгнать зрителей                      ║")
+    print("║   T — времена стадий кадра                  ║")
     print("║   Q — завершить                             ║")
     print("╚══════════════════════════════════════════════╝")
     print()
 
     t = threading.Thread(target=keyboard_listener, daemon=True)
     t.start()
+    input_worker.start()
 
+    attempt = 0
+    lost_at = None   # когда оборвалась связь — чтобы знать, сколько длилось восстановление
     while True:
         try:
             print(f"🔗 Подключение к {HUB_URL}...")
 
-            import urllib.request
-            http_base = HUB_URL.replace("wss://", "https://").replace("ws://", "http://")
-            try:
-                req = urllib.request.urlopen(f"{http_base}/session/create")
-                _ = req.read()
-            except:
-                pass
+            if not resume_token:
+                import urllib.request
+                http_base = HUB_URL.replace("wss://", "https://").replace("ws://", "http://")
+                try:
+                    req = urllib.request.urlopen(f"{http_base}/session/create")
+                    _ = req.read()
+                except:
+                    pass
 
+            # Тот же код и токен: хаб всё это время держит зрителей в сессии
+            url = f"{HUB_URL}/ws/host?code={code}"
+            if resume_token:
+                url += f"&token={resume_token}"
             async with websockets.connect(url, max_size=10_000_000) as ws:
                 ws_connection = ws
+                attempt = 0
                 print(f"✅ Подключено! Управление: {'✅ РАЗРЕШЕНО' if control_allowed else '🔒 ЗАПРЕЩЕНО'}")
+                if lost_at is not None:
+                    print(f"⏱️ Связь восстановлена за {time.monotonic() - lost_at:.2f} сек")
+                    lost_at = None
                 print()
 
                 # Отправляем пароль и список мониторов хабу
                 await ws.send(json.dumps({"type": "set_password", "password": SESSION_PASSWORD}))
                 await ws.send(json.dumps({"type": "monitor_list", "monitors": monitors}))
+                input_worker.refresh_rect()
 
                 async def receive():
+                    global resume_token, control_allowed
                     try:
                         async for msg in ws:
                             try:
                                 d = json.loads(msg)
-                                if d.get("type") == "viewer_count":
+                                if d.get("type") == "session_resume":
+                                    resume_token = d.get("token") or ""
+                                elif d.get("type") == "viewer_count":
                                     print(f"  👥 Зрителей: {d['count']}")
-                                elif d.get("action"):
-                                    handle_cmd(msg)
+                                elif d.get("type") == "request_keyframe":
+                                    request_keyframe(d.get("monitor"), d.get("layer"))
+                                elif d.get("type") == "monitor_subscriptions":
+                                    set_subscription(d.get("viewer_id"), d.get("monitors", []))
+                                elif d.get("type") == "codec_support":
+                                    set_codec_support(d.get("viewer_id"), d.get("video"))
+                                elif d.get("type") == "recv_stats":
+                                    abr.on_viewer_stats(d)
+                                elif d.get("type") == "control_toggled":
+                                    # Управление переключили с дашборда
+                                    control_allowed = bool(d.get("allowed"))
+                                    if not control_allowed:
+                                        input_worker.clear()
+                                    status = "✅ РАЗРЕШЕНО" if control_allowed else "🔒 ЗАПРЕЩЕНО"
+                                    print(f"\n  Управление (дашборд): {status}\n")
+                                elif d.get("type") in ("browse_dir", "download_remote_file",
+                                                       "file_ack", "file_cancel"):
+                                    await handle_explorer(ws, d)
+                                elif "type" not in d and d.get("action"):
+                                    # Команда зрителя — только без type
+                                    handle_cmd(d)
                             except:
-                                handle_cmd(msg)
+                                pass
                     except:
                         pass
 
                 recv = asyncio.create_task(receive())
 
-                # ═══ Пайплайн: захват в потоке, отправка асинхронно ═══
+                # ═══ Пайплайн: захват+кодирование в своём потоке, отправка здесь ═══
+                worker = CaptureWorker(loop)
+                worker.start()
                 frame_count = 0
+                last_size = 0
                 fps_timer = time.time()
-                last_time = time.perf_counter()
+                sampler = MetricsSampler()
+                stages_sent = time.monotonic()
+                monitors_checked = time.monotonic()
+                frames_sent = 0
+                send_total = 0.0
 
                 try:
                     while True:
-                        # Захват + кодирование в отдельном потоке
-                        frame = await loop.run_in_executor(capture_executor, capture)
+                        # Ждём готовый кадр; таймаут — чтобы статистика шла и на статичном экране
+                        try:
+                            frames, ready, stream = await asyncio.wait_for(worker.queue.get(), 1.0)
+                            stage_timer.add("queue", time.perf_counter() - ready)
+                        except asyncio.TimeoutError:
+                            frames = None
 
-                        # Отправка кадра
-                        await ws.send(frame)
+                        if frames is not None:
+                            t_send = time.perf_counter()
+                            try:
+                                for frame in frames:
+                                    await ws.send(frame)
+                            finally:
+                                worker.sent(stream)
+                            send_s = time.perf_counter() - t_send
+                            size = sum(map(len, frames))
+                            stage_timer.add("send", send_s)
+                            # ABR смотрит на весь исходящий канал — все слои вместе
+                            abr.on_frame(size, send_s)
+                            frames_sent += 1
+                            send_total += send_s
+                            frame_count += 1
+                            last_size = size
 
                         # FPS-счётчик (одна строка с \r чтобы не спамить)
-                        frame_count += 1
                         now = time.time()
                         elapsed = now - fps_timer
                         if elapsed >= 1.0:
                             real_fps = frame_count / elapsed
-                            size_kb = len(frame) / 1024
-                            sys.stdout.write(f"\r  📈 {real_fps:.1f} FPS | {size_kb:.0f} KB/кадр | {current_profile.upper()}   ")
+                            size_kb = last_size / 1024
+                            sys.stdout.write(f"\r  📈 {real_fps:.1f} FPS | {size_kb:.0f} KB/кадр | "
+                                             f"пропущено {worker.dropped} | {current_profile.upper()} Q={QUALITY} x{SCALE}   ")
                             sys.stdout.flush()
                             frame_count = 0
                             fps_timer = now
 
-                        # Точный тайминг
-                        target_interval = 1.0 / FPS
-                        curr_time = time.perf_counter()
-                        work_time = curr_time - last_time
-                        sleep_time = target_interval - work_time
-                        
-                        if sleep_time > 0:
-                            # Вычитаем 1-2мс на накладные расходы asyncio
-                            await asyncio.sleep(max(0, sleep_time - 0.001))
-                        
-                        last_time = time.perf_counter()
+                            # Адаптивный битрейт: решение раз в секунду
+                            state = abr.update()
+                            apply_settings(abr.settings())
+                            if state["reason"]:
+                                print(f"\n  🎚️ ABR: {state['reason']} → Q={QUALITY} Scale={SCALE} FPS={FPS} "
+                                      f"({state['kbps']} kbps, send {state['send_ms']} ms)")
+                            await ws.send(json.dumps(state))
+                            await ws.send(json.dumps(sampler.sample(worker, frames_sent, send_total)))
+                            if time.monotonic() - stages_sent >= STAGE_REPORT_INTERVAL:
+                                stages_sent = time.monotonic()
+                                await ws.send(json.dumps({"type": "stage_timing",
+                                                          "stages": stage_timer.report()}))
+
+                            # Сменились мониторы — новый список зрителям, новые прямоугольники
+                            # вводу и новый поток захвата: mss запоминает мониторы при открытии
+                            if time.monotonic() - monitors_checked >= MONITOR_POLL_INTERVAL:
+                                monitors_checked = time.monotonic()
+                                fresh = await asyncio.to_thread(get_monitor_list)
+                                if fresh != monitors:
+                                    monitors = fresh
+                                    print(f"\n  🖥️ Мониторы изменились: {len(monitors)}")
+                                    await ws.send(json.dumps({"type": "monitor_list",
+                                                              "monitors": monitors}))
+                                    input_worker.refresh_rect()
+                                    worker.stop()
+                                    await asyncio.to_thread(worker.join, 1.0)
+                                    worker = CaptureWorker(loop)
+                                    worker.start()
 
                 except:
                     recv.cancel()
                     raise
+                finally:
+                    worker.stop()
+                    input_worker.clear()  # ввод от ушедших зрителей уже не нужен
+                    monitor_subs.clear()  # и их подписки на мониторы
+                    video_support.clear()
+                    set_subscription(None, ())
+                    for transfer in list(file_transfers.values()):
+                        transfer.cancel()
+                    file_transfers.clear()
 
         except KeyboardInterrupt:
             print("\n👋 Остановлено.")
             break
         except Exception as e:
             ws_connection = None
+            if lost_at is None:
+                lost_at = time.monotonic()
+            delay = min(RECONNECT_MAX, RECONNECT_BASE * 2 ** min(attempt, 10))
+            delay = random.uniform(delay / 2, delay)
+            attempt += 1
             print(f"⚠️ Отключено: {e}")
-            print("🔄 Переподключение через 3 сек...")
-            await asyncio.sleep(3)
+            print(f"🔄 Переподключение через {delay:.1f} сек...")
+            await asyncio.sleep(delay)
 
 
 if __name__ == "__main__":
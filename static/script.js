@@ -159,7 +159,9 @@ async function checkSessionForPassword(code) {
 // FPS & Adaptive Flow
 // ═══════════════════════════════════════════════════════
 let frameCount = 0, lastFpsUpdate = performance.now(), measuredFps = 0;
-let fpsHistory = [], autoQualityEnabled = true, currentQualityProfile = 'medium';
+let currentQualityProfile = 'medium';
+// Качество подбирает хост (адаптивный битрейт), зритель только отчитывается
+let renderTimeSum = 0, renderedFrames = 0, framesPending = 0;
 
 function updateFpsCounter() {
     frameCount++;
@@ -170,14 +172,20 @@ function updateFpsCounter() {
         const fpsEl = document.getElementById('info-fps');
         if (fpsEl) fpsEl.textContent = measuredFps;
         updateConnectionIndicator(measuredFps);
-        fpsHistory.push(measuredFps);
-        if (fpsHistory.length > 10) fpsHistory.shift();
-        if (autoQualityEnabled && fpsHistory.length >= 5) {
-            const avgFps = fpsHistory.reduce((a, b) => a + b, 0) / fpsHistory.length;
-            autoAdjustQuality(avgFps);
-        }
+        sendRecvStats();
     }
 }
+function sendRecvStats() {
+    send({
+        type: 'recv_stats', fps: measuredFps, backlog: framesPending,
+        render_ms: renderedFrames ? Math.round(renderTimeSum / renderedFrames * 10) / 10 : 0,
+    });
+    renderTimeSum = 0; renderedFrames = 0;
+}
+function updateAbrState(msg) {
+    const el = document.getElementById('info-bitrate');
+    if (el) el.textContent = `${msg.kbps} kbps`;
+}
 function updateConnectionIndicator(fps) {
     const indicator = document.getElementById('connection-indicator');
     const text = document.getElementById('ci-text');
@@ -187,19 +195,111 @@ function updateConnectionIndicator(fps) {
     else if (fps >= 12) { indicator.classList.add('medium'); text.textContent = `${fps} FPS`; }
     else { indicator.classList.add('bad'); text.textContent = `${fps} FPS`; }
 }
-function autoAdjustQuality(avgFps) {
-    if (currentQualityProfile === 'high' && avgFps < 20) switchQuality('medium');
-    else if (currentQualityProfile === 'medium' && avgFps < 10) switchQuality('low');
-    else if (currentQualityProfile === 'low' && avgFps > 25) switchQuality('medium');
+
+// ═══════════════════════════════════════════════════════
+// Кадры: полный JPEG или дельта из тайлов
+// ═══════════════════════════════════════════════════════
+// Дельта (little-endian): "ODTL" | width u16 | height u16 | count u16
+//                         count × (x u16 | y u16 | len u32 | JPEG)
+const DELTA_MAGIC = 0x4c54444f; // "ODTL"
+// Кадр монитора: "ODMN" | номер u8 | слой u8 | JPEG или дельта. Смотрим один монитор — остальные не приходят.
+// Слой simulcast выбирает хаб; у слоя своё разрешение — холст подстроится по полному кадру
+const MONITOR_MAGIC = 0x4e4d444f; // "ODMN"
+// Видео H.264: "ODVC" | флаги u8 | ширина u16 | высота u16 | Annex B. Хост шлёт его,
+// только если все зрители сообщили, что умеют WebCodecs; иначе — JPEG
+const VIDEO_MAGIC = 0x4356444f; // "ODVC"
+const VIDEO_CODEC = 'avc1.42E033'; // Constrained Baseline, уровень 5.1
+let videoDecoder = null;
+let videoSize = '';
+let viewedMonitor = 1;
+let frameChain = Promise.resolve();
+
+function frameMonitor(buf) {
+    if (buf.byteLength < 6 || new DataView(buf).getUint32(0, true) !== MONITOR_MAGIC) return [viewedMonitor, 0];
+    return [new Uint8Array(buf, 4, 1)[0], 6];
+}
+
+function decodeJpeg(data) {
+    return createImageBitmap(new Blob([data], { type: 'image/jpeg' }));
+}
+
+function resizeScreen(w, h) {
+    if (canvas.width === w && canvas.height === h) return;
+    canvas.width = w; canvas.height = h;
+    drawCanvas.width = w; drawCanvas.height = h;
+    redrawBoard();
+    const resEl = document.getElementById('info-resolution');
+    if (resEl) resEl.textContent = `${w}×${h}`;
+}
+
+async function videoSupported() {
+    if (!('VideoDecoder' in window)) return false;
+    try {
+        return (await VideoDecoder.isConfigSupported({ codec: VIDEO_CODEC, optimizeForLatency: true })).supported;
+    } catch { return false; }
+}
+
+function openVideoDecoder(w, h) {
+    if (videoDecoder && videoDecoder.state !== 'closed') videoDecoder.close();
+    videoDecoder = new VideoDecoder({
+        output: (frame) => {
+            resizeScreen(frame.displayWidth, frame.displayHeight);
+            ctx.drawImage(frame, 0, 0);
+            frame.close();
+        },
+        error: () => {
+            // Декодер сломался — просим хост вернуться к JPEG
+            videoDecoder = null;
+            send({ type: 'codec_support', video: false });
+        },
+    });
+    videoDecoder.configure({ codec: VIDEO_CODEC, codedWidth: w, codedHeight: h, optimizeForLatency: true });
+    videoSize = `${w}x${h}`;
+}
+
+function decodeVideo(view, buf, base) {
+    const key = (view.getUint8(4) & 1) === 1;
+    const w = view.getUint16(5, true), h = view.getUint16(7, true);
+    // Декодер (пере)открываем только на ключевом кадре — с него начинается поток
+    if (key && (!videoDecoder || videoDecoder.state === 'closed' || videoSize !== `${w}x${h}`)) {
+        openVideoDecoder(w, h);
+    }
+    if (!videoDecoder || videoDecoder.state !== 'configured') return;
+    videoDecoder.decode(new EncodedVideoChunk({
+        type: key ? 'key' : 'delta',
+        timestamp: Math.round(performance.now() * 1000),
+        data: new Uint8Array(buf, base + 9),
+    }));
 }
-function switchQuality(profile) {
-    currentQualityProfile = profile;
-    send({ action: 'set_quality', profile });
-    const qs = document.getElementById('quality-selector');
-    qs.querySelectorAll('.q-btn').forEach(b => b.classList.remove('active'));
-    const btn = qs.querySelector(`[data-quality="${profile}"]`);
-    if (btn) btn.classList.add('active');
-    showToast(`📊 Авто-качество: ${{ 'low': 'Низкое', 'medium': 'Среднее', 'high': 'Высокое' }[profile]}`);
+
+async function renderFrame(buf, base = 0) {
+    const view = new DataView(buf, base);
+    if (view.byteLength >= 9 && view.getUint32(0, true) === VIDEO_MAGIC) {
+        decodeVideo(view, buf, base);
+        return;
+    }
+    if (view.byteLength < 10 || view.getUint32(0, true) !== DELTA_MAGIC) {
+        const img = await decodeJpeg(new Uint8Array(buf, base));
+        resizeScreen(img.width, img.height);
+        ctx.drawImage(img, 0, 0);
+        img.close();
+        return;
+    }
+    const w = view.getUint16(4, true), h = view.getUint16(6, true);
+    const count = view.getUint16(8, true);
+    // Дельта к другому разрешению бесполезна — ждём keyframe
+    if (canvas.width !== w || canvas.height !== h) return;
+    const tiles = [];
+    let off = 10;
+    for (let i = 0; i < count; i++) {
+        const x = view.getUint16(off, true), y = view.getUint16(off + 2, true);
+        const len = view.getUint32(off + 4, true);
+        off += 8;
+        tiles.push({ x, y, data: new Uint8Array(buf, base + off, len) });
+        off += len;
+    }
+    const bitmaps = await Promise.all(tiles.map(t => decodeJpeg(t.data)));
+    bitmaps.forEach((bmp, i) => { ctx.drawImage(bmp, tiles[i].x, tiles[i].y); bmp.close(); });
 }
 
 // ═══════════════════════════════════════════════════════
@@ -248,25 +348,25 @@ async function connectViewer() {
         showToast('✅ Подключено!');
         playConnect();
         addAuditLocal('viewer_connect', `${myViewerName} подключился`);
+        resumeDownloads();
+        videoSupported().then(video => send({ type: 'codec_support', video }));
+        // После переподключения хаб снова подпишет на основной — возвращаем свой
+        if (viewedMonitor !== 1) send({ type: 'subscribe_monitors', monitors: [viewedMonitor] });
     };
 
     ws.onmessage = (e) => {
         if (e.data instanceof ArrayBuffer) {
+            if (isFileChunk(e.data)) { handleFileData(e.data); return; }
+            const [monitor, base] = frameMonitor(e.data);
+            if (monitor !== viewedMonitor) return;  // ещё идут кадры прежнего монитора
             updateFpsCounter();
-            const blob = new Blob([e.data], { type: 'image/jpeg' });
-            const url = URL.createObjectURL(blob);
-            const img = new Image();
-            img.onload = () => {
-                if (canvas.width !== img.width || canvas.height !== img.height) {
-                    canvas.width = img.width; canvas.height = img.height;
-                    drawCanvas.width = img.width; drawCanvas.height = img.height;
-                    const resEl = document.getElementById('info-resolution');
-                    if (resEl) resEl.textContent = `${img.width}×${img.height}`;
-                }
-                ctx.drawImage(img, 0, 0);
-                URL.revokeObjectURL(url);
-            };
-            img.src = url;
+            // Кадры рисуем строго по очереди: дельта не должна обогнать keyframe
+            framesPending++;
+            frameChain = frameChain.then(async () => {
+                const t0 = performance.now();
+                await renderFrame(e.data, base);
+                renderTimeSum += performance.now() - t0; renderedFrames++;
+            }).catch(() => { }).finally(() => { framesPending--; });
         } else {
             try { handleServerMessage(JSON.parse(e.data)); } catch { }
         }
@@ -311,21 +411,24 @@ function handleServerMessage(msg) {
             break;
         case 'monitor_list': renderMonitorSelector(msg.monitors || []); break;
         case 'chat': addChatMessage(msg); playChat(); break;
-        case 'draw': drawRemoteShape(msg); break;
-        case 'draw_clear': drawCtx.clearRect(0, 0, drawCanvas.width, drawCanvas.height); break;
+        case 'draw_snapshot': boardShapes = msg.shapes; redrawBoard(); break;
+        case 'draw_batch': msg.shapes.forEach(sh => { boardShapes.push(sh); drawShape(sh); }); break;
+        case 'draw_clear': boardShapes = []; drawCtx.clearRect(0, 0, drawCanvas.width, drawCanvas.height); break;
         case 'viewer_identity': myViewerId = msg.viewer_id; myViewerName = msg.name || 'Viewer'; break;
-        case 'cursor_pos': updateGhostCursor(msg); break;
+        case 'cursor_meta': msg.cursors.forEach(setCursorMeta); break;
+        case 'cursor_batch': msg.cursors.forEach(([id, x, y]) => updateGhostCursor(id, x, y)); break;
         case 'cursor_remove': removeGhostCursor(msg.viewer_id); break;
         case 'clipboard_sync': handleClipboardReceive(msg.text); break;
         case 'screenshot_result': showScreenshot(msg.data); break;
         case 'privacy_shield': handlePrivacyShield(msg.enabled); break;
-        case 'audit_event': auditEvents.push(msg); renderAuditLog(); break;
+        case 'host_state': handleHostState(msg.state); break;
+        case 'audit_batch':
         case 'audit_history':
             if (msg.events) { msg.events.forEach(e => auditEvents.push(e)); renderAuditLog(); }
             break;
         case 'process_list': renderProcessList(msg.processes || []); break;
         case 'browse_result': renderExplorerResult(msg); break;
-        case 'file_chunk': handleFileChunk(msg); break;
+        case 'abr_state': updateAbrState(msg); break;
     }
 }
 
@@ -351,22 +454,22 @@ let lastMove = 0, lastCursorSend = 0;
 canvas.addEventListener('mousemove', (e) => {
     if (drawingMode) return;
     const now = Date.now();
-    if (now - lastCursorSend > 100) {
+    if (now - lastCursorSend > 33) { // хаб всё равно шлёт курсоры пачкой ~30 раз в секунду
         send({ type: 'cursor_pos', x: coords(e).x, y: coords(e).y });
         lastCursorSend = now;
     }
     if (!controlAllowed) return;
-    if (now - lastMove > 50) { sendControl({ action: 'move', ...coords(e) }); lastMove = now; }
+    if (now - lastMove > 50) { sendControl({ action: 'move', ...coords(e), monitor: viewedMonitor }); lastMove = now; }
 });
 canvas.addEventListener('mousedown', (e) => {
     if (drawingMode || !controlAllowed) return;
     const btn = e.button === 0 ? 'left' : (e.button === 2 ? 'right' : 'middle');
-    sendControl({ action: 'click', ...coords(e), button: btn });
+    sendControl({ action: 'click', ...coords(e), button: btn, monitor: viewedMonitor });
 });
 canvas.addEventListener('dblclick', (e) => {
     if (drawingMode || !controlAllowed) return;
     e.preventDefault();
-    sendControl({ action: 'dblclick', ...coords(e), button: 'left' });
+    sendControl({ action: 'dblclick', ...coords(e), button: 'left', monitor: viewedMonitor });
 });
 canvas.addEventListener('wheel', (e) => {
     if (drawingMode || !controlAllowed) return;
@@ -481,22 +584,28 @@ document.getElementById('quality-selector').addEventListener('click', (e) => {
     btn.classList.add('active');
     currentQualityProfile = btn.dataset.quality;
     send({ action: 'set_quality', profile: btn.dataset.quality });
-    showToast(`📊 Качество: ${{ 'low': 'Низкое (15 FPS)', 'medium': 'Среднее (30 FPS)', 'high': 'Высокое (60 FPS)' }[btn.dataset.quality]}`);
+    showToast(`📊 Качество: ${{ 'low': 'Низкое (до 15 FPS)', 'medium': 'Среднее (до 30 FPS)', 'high': 'Высокое (до 60 FPS)' }[btn.dataset.quality]}`);
 });
 
 function renderMonitorSelector(monitors) {
     const container = document.getElementById('monitor-selector');
     if (!monitors.length) { container.innerHTML = '<span class="monitor-info">1 монитор</span>'; return; }
     container.innerHTML = '';
-    monitors.forEach((m, i) => {
+    if (!monitors.some(m => m.index === viewedMonitor)) {
+        viewedMonitor = monitors[0].index;
+        send({ type: 'subscribe_monitors', monitors: [viewedMonitor] });
+    }
+    monitors.forEach((m) => {
         const btn = document.createElement('button');
-        btn.className = 'monitor-btn' + (i === 0 ? ' active' : '');
+        btn.className = 'monitor-btn' + (m.index === viewedMonitor ? ' active' : '');
         btn.dataset.index = m.index;
         btn.innerHTML = `<span class="mon-icon">🖥️</span><span class="mon-label">#${m.index} (${m.width}×${m.height})</span>`;
         btn.addEventListener('click', () => {
             container.querySelectorAll('.monitor-btn').forEach(b => b.classList.remove('active'));
             btn.classList.add('active');
-            send({ action: 'set_monitor', index: m.index });
+            viewedMonitor = m.index;
+            // Хост захватывает монитор, только пока на него кто-то подписан
+            send({ type: 'subscribe_monitors', monitors: [m.index] });
             showToast(`🖥️ Монитор #${m.index}`);
         });
         container.appendChild(btn);
@@ -575,37 +684,86 @@ function handlePrivacyShield(enabled) {
     showToast(enabled ? '🛡️ Экран скрыт хостом' : '🛡️ Экран доступен');
 }
 
+// Хост оборвался: хаб держит сессию и подписки, пока он не вернётся
+function handleHostState(state) {
+    const reconnecting = state === 'reconnecting';
+    document.getElementById('session-status').textContent = reconnecting ? 'Хост переподключается...' : 'В сети';
+    showToast(reconnecting ? '📡 Связь с хостом потеряна, ждём...' : '✅ Хост снова на связи');
+    if (reconnecting) playNotify();
+}
+
 // ═══════════════════════════════════════════════════════
 // 👻 Ghost Cursors (с именами)
 // ═══════════════════════════════════════════════════════
-const ghostCursors = {};
+const ghostCursors = {}; // viewer_id -> { el, from, to, t0, dt }
+const cursorMeta = {};   // viewer_id -> { color, name } — приходит один раз при входе
 const ghostLayer = document.getElementById('ghost-cursors-layer');
+let ghostAnimating = false;
 
-function updateGhostCursor(msg) {
-    let cursor = ghostCursors[msg.viewer_id];
-    if (!cursor) {
-        cursor = document.createElement('div');
-        cursor.className = 'ghost-cursor';
-        cursor.innerHTML = `
+function createGhostCursor(id) {
+    const meta = cursorMeta[id] || { color: '#fff', name: id };
+    const el = document.createElement('div');
+    el.className = 'ghost-cursor';
+    el.innerHTML = `
             <svg width="16" height="20" viewBox="0 0 16 20" fill="none">
-                <path d="M0 0L16 12L8 12L12 20L8 18L4 12L0 16V0Z" fill="${msg.color}" stroke="#000" stroke-width="1"/>
+                <path d="M0 0L16 12L8 12L12 20L8 18L4 12L0 16V0Z" fill="${meta.color}" stroke="#000" stroke-width="1"/>
             </svg>
-            <span class="ghost-label" style="background:${msg.color}">${escapeHtml(msg.name || msg.viewer_id)}</span>
+            <span class="ghost-label" style="background:${meta.color}">${escapeHtml(meta.name || id)}</span>
         `;
-        ghostLayer.appendChild(cursor);
-        ghostCursors[msg.viewer_id] = cursor;
-    }
+    ghostLayer.appendChild(el);
+    return el;
+}
+
+function setCursorMeta(m) {
+    cursorMeta[m.viewer_id] = { color: m.color, name: m.name };
+    const c = ghostCursors[m.viewer_id];
+    if (c) { c.el.remove(); c.el = createGhostCursor(m.viewer_id); drawGhostCursor(c, performance.now()); }
+}
+
+function ghostPosition(c, now) {
+    const k = Math.min(1, (now - c.t0) / c.dt);
+    return { x: c.from.x + (c.to.x - c.from.x) * k, y: c.from.y + (c.to.y - c.from.y) * k, k };
+}
+
+function drawGhostCursor(c, now) {
+    const p = ghostPosition(c, now);
     const rect = canvas.getBoundingClientRect();
     const layerRect = ghostLayer.getBoundingClientRect();
-    const x = rect.left - layerRect.left + msg.x * rect.width;
-    const y = rect.top - layerRect.top + msg.y * rect.height;
-    cursor.style.transform = `translate(${x}px, ${y}px)`;
+    const x = rect.left - layerRect.left + p.x * rect.width;
+    const y = rect.top - layerRect.top + p.y * rect.height;
+    c.el.style.transform = `translate(${x}px, ${y}px)`;
+    return p.k < 1;
+}
+
+function animateGhostCursors() {
+    const now = performance.now();
+    let moving = false;
+    for (const c of Object.values(ghostCursors)) moving = drawGhostCursor(c, now) || moving;
+    ghostAnimating = moving;
+    if (moving) requestAnimationFrame(animateGhostCursors);
+}
+
+// Позиции приходят пачками раз в тик хаба — плавно ведём курсор от текущей точки к новой
+function updateGhostCursor(id, x, y) {
+    if (id === myViewerId) return;
+    const now = performance.now();
+    let c = ghostCursors[id];
+    if (!c) {
+        c = ghostCursors[id] = { el: createGhostCursor(id), from: { x, y }, to: { x, y }, t0: now, dt: 1 };
+    } else {
+        const p = ghostPosition(c, now);
+        c.dt = Math.min(200, Math.max(16, now - c.t0));
+        c.from = { x: p.x, y: p.y }; c.to = { x, y }; c.t0 = now;
+    }
+    if (!ghostAnimating) { ghostAnimating = true; requestAnimationFrame(animateGhostCursors); }
 }
 function removeGhostCursor(viewerId) {
-    const cursor = ghostCursors[viewerId];
-    if (cursor) { cursor.style.opacity = '0'; setTimeout(() => { cursor.remove(); delete ghostCursors[viewerId]; }, 300); }
+    const c = ghostCursors[viewerId];
+    delete ghostCursors[viewerId];
+    delete cursorMeta[viewerId];
+    if (c) { c.el.style.opacity = '0'; setTimeout(() => c.el.remove(), 300); }
 }
-function clearGhostCursors() { Object.keys(ghostCursors).forEach(id => { ghostCursors[id].remove(); delete ghostCursors[id]; }); }
+function clearGhostCursors() { Object.keys(ghostCursors).forEach(id => { ghostCursors[id].el.remove(); delete ghostCursors[id]; }); }
 
 // ═══════════════════════════════════════════════════════
 // 📁 OrbDrop — File Drag & Drop
@@ -621,17 +779,64 @@ viewportContainer.addEventListener('drop', async (e) => {
     const files = e.dataTransfer.files;
     if (!files.length || !sessionCode) return;
     for (const file of files) {
-        if (file.size > 50 * 1024 * 1024) { showToast(`❌ ${file.name} слишком большой (макс. 50 MB)`); continue; }
         showToast(`📤 Отправка: ${file.name}...`);
-        const formData = new FormData(); formData.append('file', file);
         try {
-            const resp = await fetch(`/api/upload/${sessionCode}`, { method: 'POST', body: formData });
-            if (resp.ok) { const data = await resp.json(); showToast(`✅ ${file.name} отправлен (${data.size_kb} KB)`); playFile(); }
-            else showToast(`❌ Ошибка отправки ${file.name}`);
-        } catch { showToast(`❌ Ошибка сети при отправке ${file.name}`); }
+            const data = await uploadFile(file);
+            showToast(`✅ ${file.name} отправлен (${data.size_kb} KB)`); playFile();
+        } catch (err) { showToast(`❌ ${file.name}: ${err.message}`); }
     }
 });
 
+// Загрузка кусками с докачкой: init → PUT по смещению → finalize
+const UPLOAD_RETRIES = 5;
+const UPLOAD_HASH_LIMIT = 256 * 1024 * 1024; // целиком хэшируем только небольшие файлы
+
+async function sha256Hex(buf) {
+    if (!crypto.subtle) return null;  // только в защищённом контексте
+    const digest = await crypto.subtle.digest('SHA-256', buf);
+    return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+}
+
+async function uploadJson(resp) {
+    const data = await resp.json().catch(() => ({}));
+    if (!resp.ok && resp.status !== 409) throw new Error(data.error || `HTTP ${resp.status}`);
+    return data;
+}
+
+async function uploadFile(file) {
+    const base = `/api/upload/${sessionCode}`;
+    const init = await uploadJson(await fetch(`${base}/init`, {
+        method: 'POST', headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, size: file.size }),
+    }));
+    const url = `${base}/${init.upload_id}`;
+    let offset = 0, retries = 0;
+    while (offset < file.size) {
+        const part = file.slice(offset, offset + init.part_size);
+        try {
+            const buf = await part.arrayBuffer();
+            const headers = {};
+            const hash = await sha256Hex(buf);
+            if (hash) headers['X-Chunk-SHA256'] = hash;
+            const data = await uploadJson(await fetch(`${url}?offset=${offset}`, { method: 'PUT', headers, body: buf }));
+            offset = data.offset;
+            retries = 0;
+        } catch (err) {
+            // Обрыв связи — спрашиваем хаб, докуда дошло, и продолжаем оттуда
+            if (++retries > UPLOAD_RETRIES) throw err;
+            await new Promise(r => setTimeout(r, 500 * 2 ** retries));
+            try { offset = (await uploadJson(await fetch(url))).offset; } catch { }
+        }
+    }
+    const sha256 = file.size <= UPLOAD_HASH_LIMIT ? await sha256Hex(await file.arrayBuffer()) : null;
+    const done = await uploadJson(await fetch(`${url}/finalize`, {
+        method: 'POST', headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ sha256 }),
+    }));
+    if (!done.file_id) throw new Error(done.error || 'Загрузка не завершена');
+    return done;
+}
+
 // ═══ Screenshot Modal ═══
 function showScreenshot(base64Data) {
     const modal = document.getElementById('screenshot-modal');
@@ -734,7 +939,7 @@ document.querySelectorAll('.draw-tool-btn').forEach(btn => {
                 // Place sticky at center
                 const cx = 0.5, cy = 0.5;
                 drawSticky(cx, cy, text, drawColor);
-                send({ type: 'draw', tool: 'sticky', x: cx, y: cy, text, color: drawColor });
+                sendDraw({ tool: 'sticky', x: cx, y: cy, text, color: drawColor });
             }
             // Reset to pen
             document.querySelector('[data-tool="pen"]').classList.add('active');
@@ -757,6 +962,7 @@ document.querySelectorAll('.draw-size').forEach(btn => {
     });
 });
 document.getElementById('draw-clear').addEventListener('click', () => {
+    boardShapes = [];
     drawCtx.clearRect(0, 0, drawCanvas.width, drawCanvas.height);
     send({ type: 'draw_clear' });
 });
@@ -777,7 +983,7 @@ drawCanvas.addEventListener('mousemove', (e) => {
 
     if (currentDrawTool === 'pen') {
         drawLine(lastDrawX, lastDrawY, x, y, drawColor, drawSize);
-        send({ type: 'draw', tool: 'pen', x1: lastDrawX, y1: lastDrawY, x2: x, y2: y, color: drawColor, size: drawSize });
+        sendDraw({ tool: 'pen', x1: lastDrawX, y1: lastDrawY, x2: x, y2: y, color: drawColor, size: drawSize });
         lastDrawX = x; lastDrawY = y;
     }
     // For arrow and rect, we preview on mouseup
@@ -791,10 +997,10 @@ drawCanvas.addEventListener('mouseup', (e) => {
 
     if (currentDrawTool === 'arrow') {
         drawArrow(drawStartX, drawStartY, endX, endY, drawColor, drawSize);
-        send({ type: 'draw', tool: 'arrow', x1: drawStartX, y1: drawStartY, x2: endX, y2: endY, color: drawColor, size: drawSize });
+        sendDraw({ tool: 'arrow', x1: drawStartX, y1: drawStartY, x2: endX, y2: endY, color: drawColor, size: drawSize });
     } else if (currentDrawTool === 'rect') {
         drawRect(drawStartX, drawStartY, endX, endY, drawColor, drawSize);
-        send({ type: 'draw', tool: 'rect', x1: drawStartX, y1: drawStartY, x2: endX, y2: endY, color: drawColor, size: drawSize });
+        sendDraw({ tool: 'rect', x1: drawStartX, y1: drawStartY, x2: endX, y2: endY, color: drawColor, size: drawSize });
     }
 });
 drawCanvas.addEventListener('mouseleave', () => { isDrawing = false; });
@@ -837,6 +1043,32 @@ function drawSticky(x, y, text, color) {
     drawCtx.textBaseline = 'middle';
     drawCtx.fillText(text, px, py);
 }
+// Фигуры от хаба: перо приходит ломаной points [x1, y1, x2, y2, ...]
+let boardShapes = [];
+function drawShape(sh) {
+    if (!sh.points) { drawRemoteShape(sh); return; }
+    const w = drawCanvas.width, h = drawCanvas.height, p = sh.points;
+    drawCtx.beginPath(); drawCtx.moveTo(p[0] * w, p[1] * h);
+    for (let i = 2; i < p.length; i += 2) drawCtx.lineTo(p[i] * w, p[i + 1] * h);
+    drawCtx.strokeStyle = sh.color; drawCtx.lineWidth = sh.size;
+    drawCtx.lineCap = 'round'; drawCtx.lineJoin = 'round'; drawCtx.stroke();
+}
+// Свои фигуры хаб обратно не присылает — храним их сами, иначе redrawBoard
+// их сотрёт. Отрезки пера подряд дописываются в одну ломаную, как на хабе
+function sendDraw(sh) {
+    send({ type: 'draw', ...sh });
+    const last = boardShapes[boardShapes.length - 1];
+    if (sh.tool !== 'pen') boardShapes.push(sh);
+    else if (last && last.points && last.color === sh.color && last.size === sh.size
+        && last.points[last.points.length - 2] === sh.x1 && last.points[last.points.length - 1] === sh.y1) {
+        last.points.push(sh.x2, sh.y2);
+    } else boardShapes.push({ tool: 'pen', color: sh.color, size: sh.size, points: [sh.x1, sh.y1, sh.x2, sh.y2] });
+}
+// Смена разрешения стирает холст — рисуем доску заново
+function redrawBoard() {
+    drawCtx.clearRect(0, 0, drawCanvas.width, drawCanvas.height);
+    boardShapes.forEach(drawShape);
+}
 function drawRemoteShape(msg) {
     const tool = msg.tool || 'pen';
     if (tool === 'pen') drawLine(msg.x1, msg.y1, msg.x2, msg.y2, msg.color, msg.size);
@@ -895,7 +1127,7 @@ function renderExplorerResult(msg) {
     list.querySelectorAll('.explorer-file').forEach(el => {
         el.addEventListener('click', () => {
             if (confirm(`Скачать ${el.querySelector('.explorer-name').textContent}?`)) {
-                send({ type: 'download_remote_file', path: el.dataset.path });
+                startDownload(el.dataset.path);
                 showToast('📥 Загрузка...');
             }
         });
@@ -921,15 +1153,66 @@ function formatSize(bytes) {
     return (bytes / (1024 * 1024 * 1024)).toFixed(1) + ' GB';
 }
 
-function handleFileChunk(msg) {
-    if (msg.error) { showToast(`❌ ${msg.error}`); return; }
-    // Trigger download
-    const link = document.createElement('a');
-    link.href = `data:application/octet-stream;base64,${msg.data}`;
-    link.download = msg.filename || 'file';
-    link.click();
-    showToast(`✅ ${msg.filename} скачан!`);
-    playFile();
+// Файлы с хоста идут бинарно: 'ODFT' | transfer_id u32 | offset u64 | flags u8 | данные
+const FILE_MAGIC = 0x5446444f; // 'ODFT' little-endian
+const FILE_HEADER_SIZE = 17;
+const FILE_META = 1, FILE_END = 2, FILE_ERROR = 4;
+const FILE_ACK_STEP = 128 * 1024; // подтверждаем принятое, хост шлёт не дальше окна
+const downloads = {}; // transfer_id -> { path, filename, size, parts, received, acked }
+
+function isFileChunk(buf) {
+    return buf.byteLength >= FILE_HEADER_SIZE && new DataView(buf).getUint32(0, true) === FILE_MAGIC;
+}
+
+function startDownload(path) {
+    const id = crypto.getRandomValues(new Uint32Array(1))[0];
+    downloads[id] = { path, filename: 'file', size: 0, parts: [], received: 0, acked: 0 };
+    send({ type: 'download_remote_file', path, transfer_id: id, offset: 0 });
+}
+
+function resumeDownloads() {
+    // После переподключения продолжаем с того места, где оборвалось
+    for (const [id, d] of Object.entries(downloads)) {
+        d.acked = d.received;
+        send({ type: 'download_remote_file', path: d.path, transfer_id: Number(id), offset: d.received });
+    }
+}
+
+function handleFileData(buf) {
+    const dv = new DataView(buf);
+    const id = dv.getUint32(4, true);
+    const offset = Number(dv.getBigUint64(8, true));
+    const flags = dv.getUint8(16);
+    const d = downloads[id];
+    if (!d) return;
+    const payload = buf.slice(FILE_HEADER_SIZE);
+
+    if (flags & FILE_ERROR) {
+        delete downloads[id];
+        showToast(`❌ ${new TextDecoder().decode(payload)}`);
+        return;
+    }
+    if (flags & FILE_META) {
+        const meta = JSON.parse(new TextDecoder().decode(payload));
+        d.filename = meta.filename || 'file'; d.size = meta.size;
+        return;
+    }
+    if (offset !== d.received) return; // дубль после докачки
+    d.parts.push(payload);
+    d.received += payload.byteLength;
+
+    if (flags & FILE_END) {
+        delete downloads[id];
+        const url = URL.createObjectURL(new Blob(d.parts));
+        const link = document.createElement('a');
+        link.href = url; link.download = d.filename; link.click();
+        setTimeout(() => URL.revokeObjectURL(url), 10000);
+        showToast(`✅ ${d.filename} скачан!`);
+        playFile();
+    } else if (d.received - d.acked >= FILE_ACK_STEP) {
+        d.acked = d.received;
+        send({ type: 'file_ack', transfer_id: id, offset: d.received });
+    }
 }
 
 // ═══════════════════════════════════════════════════════
@@ -0,0 +1,50 @@
+"""
+Общее для тестов: main.py импортируется из корня репозитория, журнал
+аудита пишется во временную папку, FakeSocket заменяет WebSocket
+в ws_host / ws_viewer.
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # main.py монтирует static/ относительно текущей папки
+os.environ.setdefault("ORBDESK_AUDIT_DB", os.path.join(tempfile.gettempdir(), "orbdesk-test-audit.db"))
+
+from fastapi import WebSocketDisconnect  # noqa: E402
+
+
+class FakeSocket:
+    """WebSocket для обработчиков хаба: входящие — из очереди (str — текст,
+    bytes — кадр, None — обрыв), исходящие тексты — в список sent."""
+
+    def __init__(self):
+        self.inbox = asyncio.Queue()
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def close(self, code=1000, reason=None):
+        self.inbox.put_nowait(None)
+
+    async def receive(self):
+        await asyncio.sleep(0)
+        data = await self.inbox.get()
+        if data is None:
+            raise WebSocketDisconnect()
+        if isinstance(data, bytes):
+            return {"type": "websocket.receive", "bytes": data}
+        return {"type": "websocket.receive", "text": data}
+
+    async def receive_text(self):
+        return (await self.receive())["text"]
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        pass
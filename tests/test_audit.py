@@ -0,0 +1,28 @@
+"""
+Журнал аудита: остановка дописывает последнюю пачку, старые события
+писатель удаляет сам.
+
+    python -m pytest tests
+"""
+import asyncio
+import time
+
+import main
+
+
+async def write_and_close(log, entries):
+    for entry in entries:
+        log.add("515151", entry)
+    await log.close()
+
+
+def test_close_flushes_and_prunes(tmp_path):
+    log = main.AuditLog(str(tmp_path / "audit" / "audit.db"))
+    now = time.time()
+    old = now - main.AUDIT_RETENTION - 60
+    asyncio.run(write_and_close(log, [
+        {"type": "viewer_connect", "detail": "old", "time": old},
+        {"type": "viewer_connect", "detail": "new", "time": now},
+    ]))
+    events = log.query("515151", 0, now + 1, 0, 10)
+    assert [e["detail"] for e in events] == ["new"]
@@ -0,0 +1,51 @@
+"""
+Шина между воркерами: при заторе теряются только кадры, служебные
+сообщения доходят все; кадры не публикуются, если их некому читать.
+
+    python -m pytest tests
+"""
+import asyncio
+
+import pytest
+
+import main
+
+
+async def flood(extra):
+    bus = main.MemoryBackend(distributed=True)
+    got = []
+    await bus.subscribe("c", got.append)
+    for i in range(main.BUS_QUEUE_SIZE + extra):
+        bus.publish("c", b"F%d" % i, droppable=True)
+    bus.publish("c", b"S")
+    await asyncio.sleep(0.01)
+    return got, bus.dropped
+
+
+def test_control_messages_survive_frame_flood():
+    got, dropped = asyncio.run(flood(10))
+    assert dropped == 10
+    assert len(got) == main.BUS_QUEUE_SIZE + 1
+    assert got[-1] == b"S"
+
+
+async def listeners():
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    host = main.RedisBackend(fakeredis.FakeAsyncRedis(server=server))
+    mirror = main.RedisBackend(fakeredis.FakeAsyncRedis(server=server))
+    seen = []
+    await host.subscribe("v", lambda p: None)
+    assert host.has_listeners("v")  # пока PUBLISH не ответил — считаем, что есть
+    host.publish("v", b"T")
+    await asyncio.sleep(0.05)
+    seen.append(host.has_listeners("v"))
+    await mirror.subscribe("v", lambda p: None)
+    host.publish("v", b"T")
+    await asyncio.sleep(0.05)
+    seen.append(host.has_listeners("v"))
+    return seen
+
+
+def test_frames_wait_for_other_worker():
+    assert asyncio.run(listeners()) == [False, True]
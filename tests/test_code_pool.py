@@ -0,0 +1,34 @@
+"""
+CodePool: каждый код выдаётся один раз, пока его не вернули; чужой
+формат и повторный возврат пул не портят.
+
+    python -m pytest tests
+"""
+import main
+
+
+def test_random_codes_are_unique_until_exhausted():
+    pool = main.CodePool(digits=2)
+    codes = {pool.take() for _ in range(100)}
+    assert len(codes) == 100
+    assert all(len(c) == 2 and c.isdigit() for c in codes)
+    assert pool.take() is None
+
+
+def test_take_exact_code():
+    pool = main.CodePool(digits=2)
+    assert pool.take("07") == "07"
+    assert pool.take("07") is None          # уже занят
+    for bad in ("7", "007", "ab"):
+        assert pool.take(bad) is None
+    assert pool.size == 99
+
+
+def test_release_returns_code_once():
+    pool = main.CodePool(digits=2)
+    code = pool.take()
+    pool.release(code)
+    pool.release(code)                      # второй возврат ничего не меняет
+    pool.release("xx")
+    assert pool.size == 100
+    assert len({pool.take() for _ in range(100)}) == 100
@@ -0,0 +1,82 @@
+"""
+Хост-агент: DeltaEncoder шлёт только изменившиеся тайлы, AreaResampler
+сжимает кадр без сдвига яркости. Нужны зависимости агента (mss, pyautogui).
+
+    python -m pytest tests
+"""
+import struct
+
+import pytest
+
+np = pytest.importorskip("numpy")
+for dep in ("mss", "pyautogui", "PIL", "websockets"):
+    pytest.importorskip(dep)
+
+import orbdesk_host as host  # noqa: E402
+
+
+def raw(region):
+    return region.tobytes()
+
+
+def blank(h=128, w=256):
+    return np.zeros((h, w, 4), dtype=np.uint8)
+
+
+def test_delta_carries_only_dirty_tiles():
+    enc = host.DeltaEncoder(tile=64)
+    frame = blank()
+    assert enc.encode(frame, raw) == frame.tobytes()       # первый — полный
+    assert enc.encode(frame.copy(), raw) is None           # ничего не изменилось
+
+    frame = frame.copy()
+    frame[70, 130] = 255                                   # тайл (2, 1)
+    out = enc.encode(frame, raw)
+    assert out[:4] == host.DELTA_MAGIC
+    w, h, count = struct.unpack_from("<HHH", out, 4)
+    assert (w, h, count) == (256, 128, 1)
+    x, y, n = struct.unpack_from("<HHI", out, 10)
+    assert (x, y, n) == (128, 64, 64 * 64 * 4)
+    assert enc.encode(frame.copy(), raw) is None           # prev уже обновлён
+
+
+def test_adjacent_tiles_merge_into_one_rect():
+    enc = host.DeltaEncoder(tile=64)
+    enc.encode(blank(), raw)
+    frame = blank()
+    frame[0, 10] = frame[0, 100] = 255                     # тайлы (0, 0) и (1, 0)
+    out = enc.encode(frame, raw)
+    assert struct.unpack_from("<H", out, 8)[0] == 1
+    assert struct.unpack_from("<HHI", out, 10) == (0, 0, 128 * 64 * 4)
+
+
+def test_keyframe_on_request_and_resize():
+    enc = host.DeltaEncoder(tile=64)
+    frame = blank()
+    enc.encode(frame, raw)
+    enc.request_keyframe()
+    assert enc.encode(frame, raw) == frame.tobytes()
+    bigger = blank(192)
+    assert enc.encode(bigger, raw) == bigger.tobytes()
+
+
+def test_resampler_keeps_flat_image_flat():
+    img = np.full((90, 160, 4), 200, dtype=np.uint8)
+    out = host.AreaResampler(90, 160, 0.75)(img)
+    assert out.shape == (67, 120, 4)
+    assert (out == 200).all()
+
+
+def test_resampler_halves_like_box_filter():
+    rng = np.random.default_rng(1)
+    img = rng.integers(0, 256, (64, 96, 4), dtype=np.uint8)
+    out = host.AreaResampler(64, 96, 0.5)(img)
+    box = img.reshape(32, 2, 48, 2, 4).mean(axis=(1, 3))
+    # Два прохода с округлением в 8 бит — не дальше одного уровня
+    assert np.abs(out.astype(float) - box).max() <= 1
+
+
+def test_downscale_reuses_resampler():
+    img = blank(64, 64)
+    first = host.downscale(img, 0.5)
+    assert host.downscale(img, 0.5) is first
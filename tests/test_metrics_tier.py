@@ -0,0 +1,35 @@
+"""
+MetricsTier: точки одного интервала усредняются, кольцо хранит
+последние size интервалов.
+
+    python -m pytest tests
+"""
+import main
+
+N = len(main.METRIC_FIELDS)
+
+
+def point(cpu, ram=None):
+    return [cpu, ram] + [None] * (N - 2)
+
+
+def test_points_in_one_step_are_averaged():
+    tier = main.MetricsTier(step=10, size=4)
+    tier.add(100, point(1.0, 50.0))
+    tier.add(105, point(3.0))
+    tier.add(110, point(5.0))   # новый интервал закрывает прошлый
+    out = tier.since(0)
+    assert out["t"] == [100.0]
+    assert out["cpu"] == [2.0]
+    assert out["ram"] == [50.0]
+    assert out["fps"] == [None]
+
+
+def test_ring_keeps_newest_steps():
+    tier = main.MetricsTier(step=1, size=3)
+    for t in range(10):
+        tier.add(t, point(float(t)))
+    out = tier.since(0)
+    assert out["t"] == [6.0, 7.0, 8.0]
+    assert out["cpu"] == [6.0, 7.0, 8.0]
+    assert tier.since(7)["t"] == [8.0]
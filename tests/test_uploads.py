@@ -0,0 +1,82 @@
+"""
+Загрузки OrbDrop: лимиты проверяются до чтения тела, кривые запросы —
+400, а не 500.
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+import time
+
+from fastapi.testclient import TestClient
+
+import main
+
+CODE = "717171"
+client = TestClient(main.app)
+
+
+def setup_module():
+    # Сессия «с хостом» — только запись в реестре, сокет для загрузок не нужен
+    asyncio.run(main.backend.update(CODE, {"host": main.WORKER_ID}))
+
+
+def teardown_module():
+    asyncio.run(main.backend.delete(CODE))
+    main.shutil.rmtree(os.path.join(main.UPLOAD_DIR, CODE), ignore_errors=True)
+
+
+def test_single_shot_upload_checks_length_before_body(monkeypatch):
+    monkeypatch.setattr(main, "UPLOAD_MAX_FILE", 1024)
+    big = b"x" * (1024 + main.UPLOAD_FORM_OVERHEAD + 1)
+    r = client.post(f"/api/upload/{CODE}", files={"file": ("big.bin", big)})
+    assert r.status_code == 413
+    r = client.post(f"/api/upload/{CODE}", files={"file": ("small.txt", b"hello")})
+    assert r.status_code == 200, r.text
+
+
+def test_single_shot_upload_needs_content_length():
+    r = client.post(f"/api/upload/{CODE}", content=iter([b"chunked"]),
+                    headers={"Content-Type": "multipart/form-data; boundary=x"})
+    assert r.status_code == 411
+
+
+def test_init_rejects_bad_size():
+    for body in ({"filename": "a", "size": "abc"}, {"filename": "a", "size": -5},
+                 {"filename": "a", "size": None}, {"filename": 5, "size": 10}, [1, 2]):
+        r = client.post(f"/api/upload/{CODE}/init", json=body)
+        assert r.status_code == 400, (body, r.status_code)
+    r = client.post(f"/api/upload/{CODE}/init", content=b"not json")
+    assert r.status_code == 400
+    r = client.post(f"/api/upload/{CODE}/init", json={"filename": "a", "size": 10})
+    assert r.status_code == 200
+    upload_id = r.json()["upload_id"]
+    client.delete(f"/api/upload/{CODE}/{upload_id}")
+
+
+def test_download_rejects_foreign_code():
+    for code in ("%2E%2E", "%2e%2e", "..", "12345", "999999"):
+        r = client.get(f"/api/download_file/{code}/orbdesk")
+        assert r.status_code == 404, (code, r.status_code)
+    r = client.post(f"/api/upload/{CODE}", files={"file": ("note.txt", b"hi")})
+    file_id = r.json()["file_id"]
+    r = client.get(f"/api/download_file/{CODE}/{file_id}")
+    assert r.status_code == 200 and r.content == b"hi"
+
+
+def test_abandoned_upload_releases_quota(monkeypatch):
+    code = "717172"
+    asyncio.run(main.backend.update(code, {"host": main.WORKER_ID}))
+    try:
+        r = client.post(f"/api/upload/{code}/init", json={"filename": "a", "size": 100})
+        assert r.status_code == 200
+        assert asyncio.run(main.backend.get(code))["upload_bytes"] == 100
+        # В индексе у сессии ничего нет — чистильщик всё равно находит её папку
+        assert code not in main.file_index
+        monkeypatch.setattr(main, "UPLOAD_TTL", -1)
+        asyncio.run(main.sweep_once(time.time()))
+        assert asyncio.run(main.backend.get(code))["upload_bytes"] == 0
+        assert not os.listdir(os.path.join(main.UPLOAD_DIR, code))
+    finally:
+        asyncio.run(main.backend.delete(code))
+        main.shutil.rmtree(os.path.join(main.UPLOAD_DIR, code), ignore_errors=True)
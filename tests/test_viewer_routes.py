@@ -0,0 +1,103 @@
+"""
+Зритель не может выдать себя за хаб: служебные сообщения хаба хосту
+(session_resume, request_keyframe, monitor_subscriptions) от зрителя
+отбрасываются, а codec_support уходит хосту только с его собственным id.
+
+    python -m pytest tests
+"""
+import asyncio
+import json
+
+import main
+from conftest import FakeSocket
+
+
+class DeadSocket(FakeSocket):
+    """Зритель, у которого оборвалась связь: отправка кадров падает."""
+
+    async def send_bytes(self, data):
+        raise ConnectionResetError
+
+
+async def relay(code, forged):
+    """Зритель шлёт forged, затем обычное движение мыши; что дошло до хоста."""
+    host, viewer = FakeSocket(), FakeSocket()
+    tasks = [asyncio.create_task(main.ws_host(host, code=code, token=""))]
+    await asyncio.sleep(0.05)
+    tasks.append(asyncio.create_task(main.ws_viewer(viewer, code=code, password="", name="Mallory")))
+    await asyncio.sleep(0.05)
+    viewer_id = next(m["viewer_id"] for m in viewer.sent if m.get("type") == "viewer_identity")
+    host.sent.clear()
+    for msg in forged:
+        viewer.inbox.put_nowait(json.dumps(msg))
+    viewer.inbox.put_nowait(json.dumps({"action": "move", "x": 0.5, "y": 0.5}))
+    for _ in range(100):
+        if any(m.get("action") == "move" for m in host.sent):
+            break
+        await asyncio.sleep(0.01)
+    received = list(host.sent)
+    viewer.inbox.put_nowait(None)
+    host.inbox.put_nowait(None)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return viewer_id, received
+
+
+def test_viewer_cannot_inject_hub_messages():
+    forged = [
+        {"type": "session_resume", "token": "stolen"},
+        {"type": "request_keyframe", "monitor": 1, "layer": 0},
+        {"type": "monitor_subscriptions", "viewer_id": "victim", "monitors": [1, 2]},
+        {"type": "viewer_count", "count": 99},
+        {"type": "made_up", "action": "move"},
+    ]
+    _, received = asyncio.run(relay("313131", forged))
+    kinds = {m.get("type") for m in received}
+    assert not kinds & {"session_resume", "request_keyframe", "viewer_count", "made_up"}
+    assert not any(m.get("viewer_id") == "victim" for m in received)
+    assert any(m.get("action") == "move" for m in received)
+
+
+def test_typed_messages_cannot_carry_input():
+    forged = [
+        {"type": "clipboard_sync", "action": "hotkey", "keys": ["win", "r"]},
+        {"type": "chat", "action": "type", "text": "calc"},
+        {"type": "request_processes", "action": "click", "x": 0.5, "y": 0.5},
+    ]
+    _, received = asyncio.run(relay("313134", forged))
+    assert not any("type" in m and "action" in m for m in received)
+    assert any(m.get("action") == "move" for m in received)
+
+
+def test_codec_support_carries_own_viewer_id():
+    viewer_id, received = asyncio.run(relay("313132", [
+        {"type": "codec_support", "viewer_id": "victim", "video": True},
+    ]))
+    support = [m for m in received if m.get("type") == "codec_support"]
+    assert support == [{"type": "codec_support", "viewer_id": viewer_id, "video": True}]
+
+
+async def dead_viewers(code, n):
+    """n зрителей умирают на кадрах хоста; сколько зрителей осталось в реестре."""
+    host = FakeSocket()
+    tasks = [asyncio.create_task(main.ws_host(host, code=code, token=""))]
+    await asyncio.sleep(0.05)
+    viewers = [DeadSocket() for _ in range(n)]
+    for v in viewers:
+        tasks.append(asyncio.create_task(main.ws_viewer(v, code=code, password="", name="Dead")))
+    await asyncio.sleep(0.05)
+    # Первый кадр валит отправщиков, следующие застают их мёртвыми
+    for _ in range(3):
+        host.inbox.put_nowait(b"\xff\xd8 frame")
+        await asyncio.sleep(0.05)
+    for v in viewers:
+        v.inbox.put_nowait(None)
+    await asyncio.sleep(0.05)
+    left = (await main.backend.get(code)).get("viewers")
+    local = len(main.sessions[code].viewers)
+    host.inbox.put_nowait(None)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return left, local
+
+
+def test_dead_viewers_leave_registry():
+    assert asyncio.run(dead_viewers("313133", 5)) == (0, 0)
@@ -0,0 +1,105 @@
+"""
+ViewerSender: переполненная очередь теряет кадры, но дельты без полного
+кадра до зрителя не доходят; умерший сокет и close() останавливают отправщик.
+
+    python -m pytest tests
+"""
+import asyncio
+
+import main
+from conftest import FakeSocket
+
+
+class FrameSocket(FakeSocket):
+    """Запоминает отправленные кадры."""
+
+    def __init__(self):
+        super().__init__()
+        self.frames = []
+
+    async def send_bytes(self, data):
+        self.frames.append(data)
+
+
+class BrokenSocket(FakeSocket):
+    async def send_bytes(self, data):
+        raise ConnectionResetError
+
+
+async def overflow_with_deltas():
+    ws = FrameSocket()
+    sender = main.ViewerSender(ws, main.RelayStats(), maxsize=2)
+    sender.subscribe({1})
+    assert sender.push(b"key1", 1) == set()
+    assert sender.push(b"delta1", 1, keyframe=False) == set()
+    # Очередь полна: дельта не влезает — всё выброшено, ждём полный кадр
+    assert sender.push(b"delta2", 1, keyframe=False) == {1}
+    assert sender.need_keyframe == {1}
+    assert sender.push(b"delta3", 1, keyframe=False) == {1}
+    assert sender.push(b"key2", 1) == set()
+    await asyncio.sleep(0.01)
+    sender.close()
+    return ws.frames, sender
+
+
+def test_deltas_after_overflow_wait_for_keyframe():
+    frames, sender = asyncio.run(overflow_with_deltas())
+    assert frames == [b"key2"]
+    assert sender.dropped == 4
+    assert sender.overflows == 1
+    assert sender.queued_bytes == 0
+
+
+async def overflow_with_keyframe():
+    ws = FrameSocket()
+    sender = main.ViewerSender(ws, main.RelayStats(), maxsize=2)
+    sender.subscribe({1, 2})
+    sender.push(b"key1", 1)
+    sender.push(b"key2", 2)
+    # Полный кадр монитора 1 вытесняет старые; монитору 2 нужен новый полный
+    lost = sender.push(b"key1b", 1)
+    await asyncio.sleep(0.01)
+    sender.close()
+    return ws.frames, lost
+
+
+def test_keyframe_replaces_queued_frames():
+    frames, lost = asyncio.run(overflow_with_keyframe())
+    assert frames == [b"key1b"]
+    assert lost == {2}
+
+
+async def dead_socket():
+    sender = main.ViewerSender(BrokenSocket(), main.RelayStats())
+    sender.subscribe({1})
+    sender.push(b"key", 1)
+    await asyncio.sleep(0.01)
+    return sender.alive, sender.task.done()
+
+
+def test_send_error_marks_sender_dead():
+    assert asyncio.run(dead_socket()) == (False, True)
+
+
+async def closed_sender():
+    sender = main.ViewerSender(FrameSocket(), main.RelayStats())
+    sender.close()
+    await asyncio.sleep(0)
+    return sender.alive, sender.task.cancelled()
+
+
+def test_close_stops_task():
+    assert asyncio.run(closed_sender()) == (False, True)
+
+
+async def flood_messages(limit):
+    sender = main.ViewerSender(FrameSocket(), main.RelayStats())
+    for i in range(limit + 3):
+        sender.push_message(f"m{i}")
+    sender.close()
+    return sender.dropped_messages
+
+
+def test_message_queue_is_bounded(monkeypatch):
+    monkeypatch.setattr(main, "VIEWER_MESSAGE_LIMIT", 5)
+    assert asyncio.run(flood_messages(5)) == 3
@@ -0,0 +1,35 @@
+"""
+Доска держит не больше max_points координат — и тогда, когда вся она
+один длинный незаконченный росчерк.
+
+    python -m pytest tests
+"""
+import main
+
+
+def stroke(n):
+    """n отрезков пера, каждый начинается там, где кончился предыдущий."""
+    for i in range(n):
+        yield {"type": "draw", "tool": "pen", "color": "#ff6b6b", "size": 3,
+               "x1": i / 10000, "y1": 0.5, "x2": (i + 1) / 10000, "y2": 0.5}
+
+
+def test_single_long_stroke_is_capped():
+    board = main.Whiteboard(max_points=1000)
+    for op in stroke(5000):
+        board.add("a", op)
+    assert board.points <= 1000
+    assert board.points == sum(len(sh["points"]) for sh in board.shapes)
+    # Остались последние куски росчерка, без разрывов между ними
+    shapes = list(board.shapes)
+    assert shapes[-1]["points"][-2:] == [0.5, 0.5]
+    for prev, cur in zip(shapes, shapes[1:]):
+        assert prev["points"][-2:] == cur["points"][:2]
+
+
+def test_oversized_polyline_keeps_newest_points():
+    board = main.Whiteboard(max_points=1000)
+    points = [v for i in range(2000) for v in (i / 2000, 0.25)]
+    board.add("a", {"tool": "pen", "color": "#fff", "size": 2, "points": points})
+    assert board.points <= 1000
+    assert board.shapes[-1]["points"][-2:] == [round(1999 / 2000, 4), 0.25]